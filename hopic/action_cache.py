@@ -0,0 +1,168 @@
+# Copyright (c) 2021 - 2021 TomTom N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Content-addressed cache of the outputs of variants, to skip building variants of which none of the inputs changed.
+
+The outputs of every entry are stored as plain files, in a directory named after its key, along with the entry's JSON
+manifest listing those files. That directory gets created atomically, by renaming it, such that incomplete entries are
+never used.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+import stat
+import tempfile
+from typing import (
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from .types import PathLike
+
+log = logging.getLogger(__name__)
+
+_files_dir = "action-cache-files"
+_manifest_name = "manifest.json"
+
+
+def matching_files(base: Path, patterns: Iterable[str]) -> List[str]:
+    """
+    Returns the paths, relative to base, of all files matching the patterns, or contained in matching directories.
+    """
+
+    files = set()
+    for pattern in patterns:
+        for path in base.glob(pattern):
+            if path.is_dir():
+                files.update(str(file.relative_to(base)) for file in path.rglob("*") if file.is_file())
+            elif path.is_file():
+                files.add(str(path.relative_to(base)))
+    return sorted(files)
+
+
+def digest_files(base: Path, patterns: Iterable[str]) -> List[Tuple[str, bool, str]]:
+    """
+    Describes the content of all files matching the patterns by their path, executable bit and hash.
+    """
+
+    digests = []
+    for name in matching_files(base, patterns):
+        path = base / name
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        digests.append((name, bool(path.stat().st_mode & stat.S_IXUSR), digest.hexdigest()))
+    return digests
+
+
+def _entry_dir(directory: PathLike, key: str) -> Path:
+    return Path(directory) / _files_dir / key[:2] / key[2:]
+
+
+def store(directory: PathLike, key: str, outputs: Mapping[str, Tuple[Path, Sequence[str]]]) -> Optional[int]:
+    """
+    Stores copies of the files matching the output patterns, relative to their base directory.
+
+    Failure to store is not fatal: the cache is an optimization only. Returns the number of stored files, or None when
+    storing failed.
+    """
+
+    entry = _entry_dir(directory, key)
+    manifest: Dict[str, List[str]] = {}
+    try:
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        tmpdir = Path(tempfile.mkdtemp(dir=entry.parent, prefix=f".{entry.name}.", suffix=".tmp"))
+        try:
+            for name, (base, patterns) in outputs.items():
+                manifest[name] = matching_files(base, patterns)
+                for file in manifest[name]:
+                    dst = tmpdir / name / file
+                    dst.parent.mkdir(parents=True, exist_ok=True)
+                    shutil.copy2(base / file, dst)
+            with open(tmpdir / _manifest_name, "w", encoding="UTF-8") as f:
+                json.dump(manifest, f)
+            try:
+                os.rename(tmpdir, entry)
+            except OSError:
+                # Stored concurrently by another build of the same inputs, which is presumed to have the same outputs
+                if not entry.is_dir():
+                    raise
+                shutil.rmtree(tmpdir)
+        except BaseException:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            raise
+    except OSError as exc:
+        log.warning("failed to store outputs in action cache: %s", exc)
+        return None
+
+    return sum(len(files) for files in manifest.values())
+
+
+def _is_valid_manifest(manifest, destinations: Mapping[str, Path]) -> bool:
+    """
+    Checks that the manifest only lists relative paths, contained in known destinations.
+    """
+
+    if not isinstance(manifest, dict) or manifest.keys() - destinations.keys():
+        return False
+    for files in manifest.values():
+        if not isinstance(files, list):
+            return False
+        for file in files:
+            if not isinstance(file, str) or os.path.isabs(file) or os.pardir in Path(file).parts:
+                return False
+    return True
+
+
+def restore(directory: PathLike, key: str, destinations: Mapping[str, Path]) -> Optional[int]:
+    """
+    Restores the outputs stored for the key into the given base directories.
+
+    Returns the number of restored files, or None when nothing usable is stored for the key.
+    """
+
+    entry = _entry_dir(directory, key)
+    try:
+        with open(entry / _manifest_name, encoding="UTF-8") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as exc:
+        log.warning("ignoring unreadable action cache entry %s: %s", entry, exc)
+        return None
+
+    if not _is_valid_manifest(manifest, destinations):
+        log.warning("ignoring invalid action cache entry %s", entry)
+        return None
+    if not all((entry / name / file).is_file() for name, files in manifest.items() for file in files):
+        log.warning("ignoring incomplete action cache entry %s", entry)
+        return None
+
+    for name, files in manifest.items():
+        for file in files:
+            dst = destinations[name] / file
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(entry / name / file, dst)
+    return sum(len(files) for files in manifest.values())
@@ -14,13 +14,18 @@
 
 import copy
 from decimal import Decimal
+import errno
 from gzip import GzipFile
+import io
+import logging
 import os
 import shutil
 import sys
 import tarfile
 from tarfile import TarFile
 
+log = logging.getLogger(__name__)
+
 
 class ArInfo(object):
     """Represents a single member in an ar archive."""
@@ -251,12 +256,150 @@ def __exit__(self, type, value, traceback):
         self.close()
 
 
-def normalize(filename, fileobj=None, outname='', outfileobj=None, source_date_epoch=0):
+def _normalize_tarinfo(member, source_date_epoch):
+    # Clamping mtime to source_date_epoch ensures that source files are the only sources of timestamps, not build time
+    mtime = min(Decimal(member.pax_headers.pop("mtime", member.mtime)), source_date_epoch)
+    # Store in PAX header if it needs sub-integer precision
+    if int(mtime) != mtime:
+        member.mtime = int(mtime)
+        member.pax_headers["mtime"] = f"{mtime:f}"
+    else:
+        member.mtime = int(mtime)
+        member.pax_headers.pop("mtime", None)
+
+    # Don't store atime or ctime. These are just too volatile.
+    member.pax_headers.pop("atime", None)
+    member.pax_headers.pop("ctime", None)
+
+    # Prevent including the account details of the account used to execute the build
+    if member.uid == os.getuid() or member.gid == os.getgid():
+        member.uid = 0
+        member.gid = 0
+    member.uname = ''
+    member.gname = ''
+
+
+def _copy_data(in_fd, out_fd, offset, count):
+    """
+    Copies count bytes, starting at offset, from in_fd to the current position of out_fd.
+
+    Prefers system calls that don't require copying the data to and from user space.
+    """
+    end = offset + count
+    for method in ("copy_file_range", "sendfile"):
+        if not hasattr(os, method):
+            continue
+        try:
+            while offset < end:
+                if method == "copy_file_range":
+                    copied = os.copy_file_range(in_fd, out_fd, end - offset, offset)
+                else:
+                    copied = os.sendfile(out_fd, in_fd, offset, end - offset)
+                if not copied:
+                    raise IOError("unexpected end of data")
+                offset += copied
+            return
+        except OSError as exc:
+            # Not supported for this combination of kernel, file systems and/or file types
+            if exc.errno not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF):
+                raise
+
+    while offset < end:
+        buf = os.pread(in_fd, min(end - offset, 1024 * 1024), offset)
+        if not buf:
+            raise IOError("unexpected end of data")
+        offset += len(buf)
+        view = memoryview(buf)
+        while view:
+            view = view[os.write(out_fd, view):]
+
+
+class _UnsortedArchiveError(Exception):
+    pass
+
+
+def _normalize_sorted_tar(filename, outfile, *, compress, compression_level, source_date_epoch):
+    """
+    Normalize a tar archive, that's already sorted, in a single pass.
+
+    Avoids keeping the member list in memory and, when neither archive is compressed, copies member data with zero-copy
+    system calls. Produces exactly the same output as sorting would.
+
+    Raises _UnsortedArchiveError as soon as encountering a member that requires sorting, or another form of rewriting.
+    """
+
+    archivefile = outfile
+    if compress:
+        archivefile = GzipFile(filename='', mode='wb', compresslevel=compression_level, fileobj=outfile, mtime=source_date_epoch)
+
+    try:
+        with TarFile.open(filename) as in_archive, \
+                TarFile.open('', fileobj=archivefile, format=tarfile.PAX_FORMAT, mode='w', encoding='UTF-8') as out_archive:
+            zero_copy = not compress and isinstance(in_archive.fileobj, io.BufferedReader)
+
+            previous_name = None
+            while True:
+                member = in_archive.next()
+                if member is None:
+                    break
+                # Only the current member is needed, so drop them from the member lists to keep memory usage constant
+                in_archive.members.clear()
+                out_archive.members.clear()
+
+                if previous_name is not None and member.name < previous_name:
+                    raise _UnsortedArchiveError(f"{member.name!r} is not sorted after {previous_name!r}")
+                if member.issparse():
+                    raise _UnsortedArchiveError(f"{member.name!r} is a sparse file")
+                previous_name = member.name
+
+                _normalize_tarinfo(member, source_date_epoch)
+
+                if not member.isfile():
+                    out_archive.addfile(member)
+                elif not zero_copy:
+                    out_archive.addfile(member, in_archive.extractfile(member))
+                else:
+                    # Equivalent to TarFile.addfile, without copying data through user space
+                    buf = member.tobuf(out_archive.format, out_archive.encoding, out_archive.errors)
+                    outfile.write(buf)
+                    outfile.flush()
+                    _copy_data(in_archive.fileobj.fileno(), outfile.fileno(), member.offset_data, member.size)
+                    blocks, remainder = divmod(member.size, tarfile.BLOCKSIZE)
+                    if remainder > 0:
+                        outfile.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+                        blocks += 1
+                    out_archive.offset += len(buf) + blocks * tarfile.BLOCKSIZE
+    finally:
+        if compress:
+            archivefile.close()
+
+
+def normalize(filename, fileobj=None, outname='', outfileobj=None, source_date_epoch=0, compression_level=9):
     """Make the given file as close to reproducible as possible. Mostly be clamping timestamps to source_date_epoch."""
     if (fileobj is None or outfileobj is None) and not os.path.isfile(filename):
         return
 
     if filename.suffix == ".tar" or filename.suffixes[-2:] == [".tar", ".gz"]:
+        # Python >= 3.9 is required for major/minor device numbers to be written the same way as the work-around below
+        if fileobj is None and outfileobj is None and sys.version_info >= (3, 9, 0):
+            outname = filename.with_suffix(filename.suffix + ".tmp")
+            try:
+                with open(outname, 'wb') as outfile:
+                    _normalize_sorted_tar(
+                        filename,
+                        outfile,
+                        compress=filename.suffix == ".gz",
+                        compression_level=compression_level,
+                        source_date_epoch=source_date_epoch,
+                    )
+            except _UnsortedArchiveError as exc:
+                log.debug("rewriting %s completely: %s", filename, exc)
+                outname = ''
+            else:
+                os.utime(outname, (source_date_epoch, source_date_epoch))
+                os.rename(outname, filename)
+                return
+
         if outfileobj is None:
             archivefile = outfile = open(filename.with_suffix(filename.suffix + ".tmp"), 'wb')
         else:
@@ -266,7 +409,7 @@ def normalize(filename, fileobj=None, outname='', outfileobj=None, source_date_e
                 compress = False
                 if filename.suffix == ".gz":
                     compress = True
-                    archivefile = GzipFile(filename=outname, mode='wb', compresslevel=9, fileobj=outfile, mtime=source_date_epoch)
+                    archivefile = GzipFile(filename=outname, mode='wb', compresslevel=compression_level, fileobj=outfile, mtime=source_date_epoch)
 
                 with TarFile.open(outname, fileobj=archivefile, format=tarfile.PAX_FORMAT, mode='w', encoding='UTF-8') as out_archive:
                     if sys.version_info < (3, 9, 0):
@@ -331,26 +474,7 @@ def write_archivefile(data):
 
                     # Sorting the file list ensures that we don't depend on the order that files appear on disk
                     for member in sorted(in_archive, key=lambda x: x.name):
-                        # Clamping mtime to source_date_epoch ensures that source files are the only sources of timestamps, not build time
-                        mtime = min(Decimal(member.pax_headers.pop("mtime", member.mtime)), source_date_epoch)
-                        # Store in PAX header if it needs sub-integer precision
-                        if int(mtime) != mtime:
-                            member.mtime = int(mtime)
-                            member.pax_headers["mtime"] = f"{mtime:f}"
-                        else:
-                            member.mtime = int(mtime)
-                            member.pax_headers.pop("mtime", None)
-
-                        # Don't store atime or ctime. These are just too volatile.
-                        member.pax_headers.pop("atime", None)
-                        member.pax_headers.pop("ctime", None)
-
-                        # Prevent including the account details of the account used to execute the build
-                        if member.uid == os.getuid() or member.gid == os.getgid():
-                            member.uid = 0
-                            member.gid = 0
-                        member.uname = ''
-                        member.gname = ''
+                        _normalize_tarinfo(member, source_date_epoch)
 
                         fileobj = (in_archive.extractfile(member) if member.isfile() else None)
                         out_archive.addfile(member, fileobj)
@@ -386,7 +510,14 @@ def write_archivefile(data):
                 pkg_member.perm = 0o100644
 
                 with out_pkg.appendfile(pkg_member) as outfile:
-                    normalize(pkg_member.name, fileobj=pkg_member, outname=pkg_member.name, outfileobj=outfile, source_date_epoch=source_date_epoch)
+                    normalize(
+                        pkg_member.name,
+                        fileobj=pkg_member,
+                        outname=pkg_member.name,
+                        outfileobj=outfile,
+                        source_date_epoch=source_date_epoch,
+                        compression_level=compression_level,
+                    )
             else:
                 in_pkg.close()
                 out_pkg.close()
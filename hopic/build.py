@@ -12,12 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import logging
 import os
 import re
 import shlex
 import subprocess
 import sys
+import threading
 from configparser import (
     NoSectionError,
 )
@@ -83,6 +85,112 @@ def add(self, volume_image):
         self.containers.add(container_id)
 
 
+class DockerExecContainers(object):
+    """
+    This context manager class manages a set of long-lived Docker containers to execute multiple commands in with 'docker exec'.
+
+    A container is shared between all commands that use the same image and container creation arguments, including
+    commands executing concurrently in different threads.
+    """
+    def __init__(self):
+        self.containers = {}
+        self.entrypoints = {}
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, ex_type, ex_value, tb):
+        if self.containers:
+            log.info('Cleaning up Docker containers: %s', ' '.join(self.containers.values()))
+            try:
+                echo_cmd(subprocess.check_call, ['docker', 'rm', '--force', '--volumes'] + list(self.containers.values()))
+            except subprocess.CalledProcessError as e:
+                log.error('Could not remove all Docker containers, command failed with exit code %d', e.returncode)
+            self.containers.clear()
+
+    def __iter__(self):
+        return iter(self.containers.values())
+
+    def has_entrypoint(self, image) -> bool:
+        with self._lock:
+            image = str(image)
+            try:
+                return self.entrypoints[image]
+            except KeyError:
+                pass
+
+            inspect_cmd = ['docker', 'image', 'inspect', '--format={{json .Config.Entrypoint}}', image]
+            try:
+                entrypoint = echo_cmd(subprocess.check_output, inspect_cmd)
+            except subprocess.CalledProcessError:
+                # Inspecting only works for images that are present locally
+                try:
+                    echo_cmd(subprocess.check_call, ['docker', 'pull', image], stdout=sys.__stderr__)
+                    entrypoint = echo_cmd(subprocess.check_output, inspect_cmd)
+                except subprocess.CalledProcessError as e:
+                    log.exception('Command fatally terminated with exit code %d', e.returncode)
+                    sys.exit(e.returncode)
+
+            self.entrypoints[image] = bool(json.loads(entrypoint))
+            return self.entrypoints[image]
+
+    def get(self, image, args: Sequence[str]) -> Optional[str]:
+        """
+        Returns the ID of a running container for the given image and creation arguments, starting it if necessary.
+
+        Returns None for images that have an entrypoint, because 'docker exec' wouldn't execute it.
+        """
+
+        with self._lock:
+            key = (str(image), tuple(args))
+            try:
+                return self.containers[key]
+            except KeyError:
+                pass
+
+            if self.has_entrypoint(image):
+                log.info('Not reusing Docker container for image %s because it has an entrypoint', image)
+                return None
+
+            log.info('Creating new Docker container for image %s', image)
+            try:
+                container_id = echo_cmd(subprocess.check_output, [
+                    'docker',
+                    'run',
+                    '--detach',
+                    '--rm',
+                    # Forwards signals to the idle process, allowing 'docker stop' to stop the container immediately
+                    '--init',
+                    '--entrypoint=tail',
+                    *args,
+                    str(image),
+                    '-f',
+                    '/dev/null',
+                ]).strip()
+            except subprocess.CalledProcessError as e:
+                log.exception('Command fatally terminated with exit code %d', e.returncode)
+                sys.exit(e.returncode)
+
+            # Container ID's consist of 64 hex characters
+            if not re.match('^[0-9a-fA-F]{64}$', container_id):
+                log.error('Unable to create Docker container for %s', image)
+                sys.exit(1)
+
+            self.containers[key] = container_id
+            return container_id
+
+    def discard(self, container_id: str) -> None:
+        """
+        Forgets about the given container, for when it has been stopped by other means.
+        """
+
+        with self._lock:
+            for key, value in list(self.containers.items()):
+                if value == container_id:
+                    del self.containers[key]
+
+
 class HopicGitInfo(NamedTuple):
     # fmt: off
     submit_commit        : Optional[git.Commit] = None
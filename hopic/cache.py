@@ -0,0 +1,121 @@
+# Copyright (c) 2021 - 2021 TomTom N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import logging
+import os
+import pickle
+import sys
+import tempfile
+from pathlib import Path
+from typing import (
+    Any,
+    Optional,
+)
+
+from .types import PathLike
+
+log = logging.getLogger(__name__)
+
+
+def cache_dir() -> Path:
+    """
+    Returns the directory that Hopic uses for persistent, content-addressed caches.
+
+    This is ``$HOPIC_CACHE_DIR`` when set, otherwise a ``hopic`` directory in the XDG cache directory.
+    """
+
+    try:
+        return Path(os.environ["HOPIC_CACHE_DIR"])
+    except KeyError:
+        pass
+
+    xdg_cache_home = os.environ.get("XDG_CACHE_HOME")
+    if not xdg_cache_home:
+        xdg_cache_home = os.path.join(os.path.expanduser("~"), ".cache")
+    return Path(xdg_cache_home) / "hopic"
+
+
+def cache_key(*parts: Any) -> str:
+    """
+    Computes a key from the repr() of the given parts.
+
+    Callers are responsible for only passing parts with a stable, content-describing, representation.
+    """
+
+    digest = hashlib.sha256()
+    # Pickles aren't guaranteed to be loadable by other Python versions
+    digest.update(repr(sys.version_info[:2]).encode("UTF-8"))
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("UTF-8")
+        elif not isinstance(part, bytes):
+            part = repr(part).encode("UTF-8")
+        digest.update(len(part).to_bytes(8, "little"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def _entry_path(namespace: str, key: str, directory: Optional[PathLike]) -> Path:
+    return Path(cache_dir() if directory is None else directory) / namespace / key[:2] / f"{key[2:]}.pickle"
+
+
+def load(namespace: str, key: str, *, directory: Optional[PathLike] = None) -> Any:
+    """
+    Loads the cached value stored for the given key.
+
+    Raises :class:`KeyError` when no (usable) value is stored.
+    """
+
+    path = _entry_path(namespace, key, directory)
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        raise KeyError(key)
+    except Exception as exc:
+        log.debug("ignoring unusable cache entry %s: %s", path, exc)
+        raise KeyError(key) from exc
+
+
+def store(namespace: str, key: str, value: Any, *, directory: Optional[PathLike] = None) -> bool:
+    """
+    Stores the given value for the given key.
+
+    Failure to store is not fatal: caches are an optimization only. Returns whether the value got stored.
+    """
+
+    path = _entry_path(namespace, key, directory)
+    try:
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as exc:
+        log.debug("not caching unpicklable value for %s: %s", path, exc)
+        return False
+
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file and rename it to ensure concurrent readers never observe a partial file
+        fd, tmpname = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmpname, path)
+        except BaseException:
+            os.unlink(tmpname)
+            raise
+    except OSError as exc:
+        log.debug("failed to store cache entry %s: %s", path, exc)
+        return False
+
+    return True
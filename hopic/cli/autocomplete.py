@@ -19,11 +19,6 @@
     determine_config_file_name,
 )
 
-from ..config_reader import (
-        expand_vars,
-        read as read_config,
-    )
-
 
 def _option_from_args(args, option):
     try:
@@ -35,6 +30,12 @@ def _option_from_args(args, option):
 
 
 def _config_from_args(args):
+    # Imported here because it's expensive and only needed when actually completing
+    from ..config_reader import (
+        expand_vars,
+        read as read_config,
+    )
+
     workspace = _option_from_args(args, "--workspace")
     if workspace is not None:
         workspace = Path(workspace)
@@ -14,23 +14,43 @@
 
 from datetime import datetime
 import logging
+import json
 import os
+import queue
 import shlex
+import shutil
 import signal
 import stat
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import typing
 import urllib.parse
+from collections import (
+    ChainMap,
+    OrderedDict,
+)
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from contextlib import (
+    ExitStack,
+    contextmanager,
+)
 from collections.abc import (
     Mapping,
     Sequence,
 )
+from pathlib import Path
 from typing import (
+    Any,
     Dict,
     List,
+    Optional,
+    Tuple,
 )
 
 import click
@@ -42,33 +62,45 @@
     extensions,
 )
 from .utils import (
+    get_package_version,
     is_publish_branch,
 )
 
 from .. import (
+    action_cache,
+    cache,
     credentials,
     binary_normalize,
+    git_bundle,
+    trace,
 )
 from ..build import (
     FatalSignal,
     DockerContainers,
+    DockerExecContainers,
     volume_spec_to_docker_param,
     HopicGitInfo,
 )
 from ..config_reader import (
     CredentialEncoding,
     CredentialType,
+    JSONEncoder,
     RunOnChange,
     expand_docker_volume_spec,
     expand_vars,
+    referenced_vars,
 )
 from ..errors import (
+    ArtifactNormalizationError,
     MissingCredentialVarError,
     MissingFileError,
     StepTimeoutExpiredError,
     UnknownPhaseError,
 )
-from ..execution import echo_cmd_click as echo_cmd
+from ..execution import (
+    echo_cmd_click as echo_cmd,
+    format_cmd,
+)
 from ..git_time import (
     restore_mtime_from_git,
     to_git_time,
@@ -76,28 +108,72 @@
 from ..types import PathLike
 from .global_obj import initialize_global_variables_from_config
 
+PACKAGE : str = __package__.split('.')[0]
+
 log = logging.getLogger(__name__)
 
 
-@click.pass_context
-def build_variant(
-    ctx,
-    variant,
-    cmds,
-    hopic_git_info,
-    *,
-    exec_stdout=None,
-    cwd: str = "${WORKSPACE}",
-):
-    cfg = ctx.obj.config
-
-    images = cfg['image']
+def _normalize_artifact(artifact: Path, *, source_date_epoch: int, compression_level: int) -> Tuple[int, float]:
+    start = time.monotonic()
     try:
-        image = images[variant]
-    except KeyError:
-        image = images.get('default', None)
+        size = artifact.stat().st_size
+    except OSError:
+        size = 0
+    binary_normalize.normalize(artifact, source_date_epoch=source_date_epoch, compression_level=compression_level)
+    return size, time.monotonic() - start
 
-    docker_in_docker = False
+
+def _normalize_artifacts(artifacts: typing.Mapping[Path, int], *, source_date_epoch: int) -> None:
+    """
+    Normalizes the given artifacts, each with its own compression level.
+
+    Artifacts are normalized concurrently, by a pool of processes, when there's more than one of them. Every artifact is
+    processed even when some of them fail, after which the failures get reported together.
+    """
+
+    start = time.monotonic()
+    results = OrderedDict()
+    failures = OrderedDict()
+    jobs = min(len(artifacts), os.cpu_count() or 1)
+    with trace.span("normalize-artifacts", artifacts=len(artifacts), jobs=jobs):
+        if jobs > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                futures = [
+                    (artifact, executor.submit(
+                        _normalize_artifact, artifact, source_date_epoch=source_date_epoch, compression_level=compression_level))
+                    for artifact, compression_level in artifacts.items()
+                ]
+                # Collect in submission order to keep reporting deterministic
+                for artifact, future in futures:
+                    try:
+                        results[artifact] = future.result()
+                    except Exception as exc:
+                        failures[artifact] = exc
+        else:
+            for artifact, compression_level in artifacts.items():
+                try:
+                    results[artifact] = _normalize_artifact(artifact, source_date_epoch=source_date_epoch, compression_level=compression_level)
+                except Exception as exc:
+                    failures[artifact] = exc
+
+    for artifact, (size, duration) in results.items():
+        log.debug("normalized %s (%d bytes) in %.3f seconds", artifact, size, duration)
+    if results:
+        log.info(
+            "normalized %d artifact(s) (%d bytes) in %.3f seconds using %d process(es)",
+            len(results),
+            sum(size for size, _ in results.values()),
+            time.monotonic() - start,
+            jobs,
+        )
+    if failures:
+        raise ArtifactNormalizationError(OrderedDict((str(artifact), exc) for artifact, exc in failures.items()))
+
+
+def _variant_volume_vars(ctx, hopic_git_info) -> Tuple[Dict[str, Any], Optional[datetime]]:
+    """
+    Returns the variables to expand in a variant's commands and the time of the commit that gets built.
+    """
 
     volume_vars = ctx.obj.volume_vars.copy()
     if hopic_git_info.submit_ref is not None:
@@ -122,13 +198,315 @@ def build_variant(
     if hopic_git_info.target_commit and hopic_git_info.autosquashed_commit:
         volume_vars["AUTOSQUASHED_COMMITS"] = f"{hopic_git_info.target_commit}..{hopic_git_info.autosquashed_commit}"
 
+    return volume_vars, git_commit_time
+
+
+# Options that make a variant depend on, or affect, more than its inputs and outputs
+_action_cache_excluded_options = (
+    'docker-in-docker',
+    'volumes-from',
+    'with-credentials',
+    'worktrees',
+)
+
+
+def _image_id(image: str) -> Optional[str]:
+    try:
+        image_id = echo_cmd(
+            subprocess.check_output,
+            ('docker', 'image', 'inspect', '--format={{.Id}}', image),
+            stderr=subprocess.DEVNULL,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    # Nothing gets executed for dry runs
+    if not isinstance(image_id, str):
+        return None
+    return image_id.strip()
+
+
+def _without_host_paths(ctx, value: str) -> str:
+    """
+    Replaces the host paths of the workspace, code and configuration directories with placeholders.
+
+    This allows build nodes that check out in different directories to share action cache entries.
+    """
+
+    paths = {
+        '<workspace>': ctx.obj.workspace,
+        '<code-dir>': ctx.obj.code_dir,
+        '<config-dir>': getattr(ctx.obj, 'config_dir', None),
+    }
+    # Longest first to replace subdirectories before the directories containing them
+    for placeholder, path in sorted(paths.items(), key=lambda item: -len(str(item[1] or ''))):
+        if path is not None:
+            value = value.replace(str(path), placeholder)
+    return value
+
+
+def _action_cache_key(ctx, phase: str, variant: str, cmds: Sequence, hopic_git_info) -> Optional[str]:
+    """
+    Computes the key of a variant's outputs in the action cache, or None when the variant cannot be cached.
+
+    The key consists of the variant's commands with the values of all variables they refer to, the images they execute
+    in, the passed through environment and the content of the files matching the variant's `cache-inputs`. Host paths of
+    the workspace aren't part of it. Neither are the version and SOURCE_DATE_EPOCH, unless referred to, because these
+    change with every commit.
+    """
+
+    cfg = ctx.obj.config
+    name = f"{phase}.{variant}"
+
+    images = cfg['image']
+    image = images.get(variant, images.get('default'))
+    used_images = set() if image is None else {str(image)}
+    inputs: List[str] = []
+    foreach = None
+    for cmd in cmds:
+        for option in _action_cache_excluded_options:
+            if cmd.get(option):
+                log.debug("not using the action cache for %s because it uses `%s`", name, option)
+                return None
+        if cmd.get('run-on-change', RunOnChange.default) != RunOnChange.always:
+            log.debug("not using the action cache for %s because it doesn't always run", name)
+            return None
+        inputs.extend(cmd.get('cache-inputs', ()))
+        if cmd.get('image') is not None:
+            used_images.add(str(cmd['image']))
+        foreach = cmd.get('foreach', foreach)
+    if not inputs:
+        return None
+
+    image_ids = []
+    for image in sorted(used_images):
+        image_id = _image_id(image)
+        if image_id is None:
+            log.debug("not using the action cache for %s because image %s isn't available locally", name, image)
+            return None
+        image_ids.append((image, image_id))
+
+    volume_vars, _ = _variant_volume_vars(ctx, hopic_git_info)
+    var_names = referenced_vars(cmds) | referenced_vars(cfg['volumes'])
+    variables = sorted((var, _without_host_paths(ctx, repr(volume_vars.get(var)))) for var in var_names)
+    environment = sorted((var, os.environ.get(var)) for var in cfg['pass-through-environment-vars'])
+
+    foreach_items: typing.Sequence = ()
+    if foreach == 'SOURCE_COMMIT':
+        foreach_items = [str(commit) for commit in hopic_git_info.source_commits]
+    elif foreach == 'AUTOSQUASHED_COMMIT':
+        foreach_items = [str(commit) for commit in hopic_git_info.autosquashed_commits]
+
+    return cache.cache_key(
+        get_package_version(PACKAGE),
+        phase,
+        variant,
+        _without_host_paths(ctx, json.dumps(cmds, cls=JSONEncoder)),
+        _without_host_paths(ctx, json.dumps(cfg['volumes'], cls=JSONEncoder)),
+        variables,
+        environment,
+        image_ids,
+        foreach_items,
+        action_cache.digest_files(ctx.obj.code_dir, inputs),
+    )
+
+
+def _action_cache_outputs(ctx, cmds: Sequence, hopic_git_info) -> Dict[str, Tuple[Path, List[str]]]:
+    """
+    Returns the patterns of a variant's outputs per directory they're relative to.
+    """
+
+    volume_vars, _ = _variant_volume_vars(ctx, hopic_git_info)
+    code_patterns = []
+    workspace_patterns = []
+    for cmd in cmds:
+        for artifact_key in ('archive', 'fingerprint'):
+            if artifact_key in cmd:
+                code_patterns.extend(artifact['pattern'].replace('(*)', '*') for artifact in cmd[artifact_key]['artifacts'])
+        if 'junit' in cmd:
+            code_patterns.extend(cmd['junit']['test-results'])
+        if 'stash' in cmd:
+            stash_dir = cmd['stash'].get('dir', '')
+            workspace_patterns.extend(
+                os.path.join(stash_dir, pattern.strip()) for pattern in cmd['stash']['includes'].split(',') if pattern.strip())
+
+    def expand(pattern):
+        try:
+            return expand_vars(volume_vars, pattern)
+        except KeyError:
+            # Building will report this
+            return pattern
+
+    return {
+        'code': (ctx.obj.code_dir, [expand(pattern) for pattern in code_patterns]),
+        'workspace': (ctx.obj.workspace, [expand(pattern) for pattern in workspace_patterns]),
+    }
+
+
+@contextmanager
+def _commit_checkout(workspace: Path, commit, *, lock: threading.Lock) -> typing.Iterator[Path]:
+    """
+    Checks out the commit in a temporary worktree of the workspace's repository.
+    """
+
+    tmpdir = Path(tempfile.mkdtemp(prefix='hopic-foreach-'))
+    tree = tmpdir / 'tree'
+    try:
+        with git.Repo(workspace) as repo:
+            # Git doesn't support modifying the list of worktrees concurrently
+            with lock:
+                repo.git.worktree('add', '--detach', str(tree), str(commit))
+            try:
+                yield tree
+            finally:
+                with lock:
+                    repo.git.worktree('remove', '--force', str(tree))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+class _ProcessGroup:
+    """
+    Keeps track of processes executing concurrently, to be able to terminate all of them.
+
+    Commands terminated because of a fatal signal raise FatalSignal in the thread that executed them, such that it
+    cleans up after them, e.g. by stopping their Docker container, just like when executing serially.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._processes: typing.Set[subprocess.Popen] = set()
+        self.signal: Optional[int] = None
+
+    @property
+    def terminated(self) -> bool:
+        return self.signal is not None
+
+    def check_call(self, *popenargs, timeout=None, **kwargs) -> int:
+        with subprocess.Popen(*popenargs, **kwargs) as process:
+            with self._lock:
+                if self.terminated:
+                    process.terminate()
+                self._processes.add(process)
+            try:
+                returncode = process.wait(timeout=timeout)
+            except BaseException:
+                process.kill()
+                raise
+            finally:
+                with self._lock:
+                    self._processes.discard(process)
+        if self.signal is not None:
+            raise FatalSignal(self.signal)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, popenargs[0] if popenargs else kwargs['args'])
+        return 0
+
+    def terminate(self, signum: int) -> None:
+        with self._lock:
+            self.signal = signum
+            for process in self._processes:
+                process.terminate()
+
+
+def _execute_foreach_concurrently(ctx, execute, foreach_items: Sequence, *, foreach: str, jobs: int, stdout=None) -> None:
+    """
+    Executes a command for multiple items concurrently.
+
+    The output of each item is buffered and written in the order of the items. Failing items don't stop the others,
+    instead they're all reported when done.
+    """
+
+    processes = _ProcessGroup()
+
+    def execute_item(foreach_item):
+        if processes.terminated:
+            return b'', None
+        with tempfile.TemporaryFile() as output, ctx.scope(cleanup=False):
+            error = None
+            try:
+                execute(foreach_item, stdout=output, stderr=subprocess.STDOUT, check_call=processes.check_call)
+            except Exception as exc:
+                error = exc
+            output.seek(0)
+            return output.read(), error
+
+    def signal_handler(signum, frame):
+        log.warning('Received fatal signal %d', signum)
+        raise FatalSignal(signum)
+
+    log.info("executing for %d items of %s with up to %d jobs", len(foreach_items), foreach, jobs)
+    failures = []
+    old_handlers = dict((num, signal.signal(num, signal_handler)) for num in (signal.SIGINT, signal.SIGTERM))
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    try:
+        futures = [executor.submit(execute_item, foreach_item) for foreach_item in foreach_items]
+        for foreach_item, future in zip(foreach_items, futures):
+            output, error = future.result()
+            log.info("output for %s=%s:", foreach, foreach_item)
+            if stdout is not None:
+                stdout.write(output.decode('UTF-8', errors='replace'))
+                stdout.flush()
+            else:
+                click.echo(output, nl=False)
+            if error is not None:
+                failures.append((foreach_item, error))
+    except FatalSignal as exc:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        processes.terminate(exc.signal)
+        # Lets every item clean up after itself
+        executor.shutdown(wait=True)
+        ctx.exit(128 + exc.signal)
+    finally:
+        executor.shutdown(wait=True)
+        for num, old_handler in old_handlers.items():
+            signal.signal(num, old_handler)
+
+    for foreach_item, error in failures:
+        if isinstance(error, subprocess.CalledProcessError):
+            log.error("Command for %s=%s fatally terminated with exit code %d", foreach, foreach_item, error.returncode)
+        else:
+            log.error("Command for %s=%s failed: %s", foreach, foreach_item, error)
+    if failures:
+        log.error("failed for %d of %d items of %s", len(failures), len(foreach_items), foreach)
+        error = failures[0][1]
+        if isinstance(error, subprocess.CalledProcessError):
+            ctx.exit(error.returncode)
+        raise error
+
+
+@click.pass_context
+def build_variant(
+    ctx,
+    variant,
+    cmds,
+    hopic_git_info,
+    *,
+    exec_stdout=None,
+    cwd: str = "${WORKSPACE}",
+    phase: Optional[str] = None,
+):
+    cfg = ctx.obj.config
+
+    images = cfg['image']
+    try:
+        image = images[variant]
+    except KeyError:
+        image = images.get('default', None)
+
+    docker_in_docker = False
+    reuse_container = False
+
+    volume_vars, git_commit_time = _variant_volume_vars(ctx, hopic_git_info)
+
     mandatory_artifacts = []
     mandatory_junit = []
     optional_artifacts = []
     worktree_commits: Dict[PathLike, List[str]] = {}
     variant_credentials = {}
     extra_docker_run_args = []
-    with DockerContainers() as volumes_from:
+    worktree_lock = threading.Lock()
+    with DockerContainers() as volumes_from, DockerExecContainers() as exec_containers:
         # If the branch is not allowed to publish, skip the publish phase. If run_on_change is set to 'always', phase will be run anyway regardless of
         # this condition. For build phase, run_on_change is set to 'always' by default, so build will always happen.
         is_publish_allowed = is_publish_branch(ctx, hopic_git_info)
@@ -213,10 +591,8 @@ def build_variant(
                 except (KeyError, TypeError):
                     pass
                 else:
-                    if artifact_key == "junit":
-                        new_artifacts = opt["test-results"]
-                    else:
-                        new_artifacts = (artifact["pattern"].replace("(*)", "*") for artifact in opt["artifacts"])
+                    compression_level = opt.get("compression-level", 9)
+                    new_artifacts = ((artifact["pattern"].replace("(*)", "*"), compression_level) for artifact in opt["artifacts"])
                     if opt["allow-missing"]:
                         optional_artifacts.extend(new_artifacts)
                     else:
@@ -249,6 +625,8 @@ def build_variant(
                 foreach = cmd['foreach']
             except KeyError:
                 pass
+            foreach_jobs = cmd.get('foreach-jobs', 1)
+            foreach_checkout = cmd.get('foreach-checkout', False)
 
             try:
                 scoped_volumes = expand_docker_volume_spec(ctx.obj.config_dir,
@@ -286,6 +664,11 @@ def build_variant(
             except KeyError:
                 pass
 
+            try:
+                reuse_container = cmd['docker-reuse-container']
+            except KeyError:
+                pass
+
             try:
                 with_credentials = cmd['with-credentials']
             except (KeyError, TypeError):
@@ -353,8 +736,17 @@ def build_variant(
             elif foreach == 'AUTOSQUASHED_COMMIT':
                 foreach_items = hopic_git_info.autosquashed_commits
 
-            for foreach_item in foreach_items:
-                cfg_vars = volume_vars.copy()
+            def execute(foreach_item, *, stdout=exec_stdout, stderr=None, check_call=None):
+                with ExitStack() as checkout:
+                    code_dir = None
+                    if foreach_checkout and foreach_item is not None:
+                        code_dir = checkout.enter_context(_commit_checkout(ctx.obj.workspace, foreach_item, lock=worktree_lock))
+                        code_dir /= ctx.obj.code_dir.relative_to(ctx.obj.workspace)
+                    execute_in(code_dir, foreach_item, stdout=stdout, stderr=stderr, check_call=check_call)
+
+            def execute_in(code_dir, foreach_item, *, stdout, stderr, check_call):
+                # Layered on top of the variables and environment shared by all items, instead of copying those
+                cfg_vars = ChainMap({}, volume_vars)
                 if foreach in (
                             'SOURCE_COMMIT',
                             'AUTOSQUASHED_COMMIT',
@@ -368,44 +760,48 @@ def build_variant(
                         now = datetime.utcnow().replace(tzinfo=tzutc())
                     duration = now - git_commit_time
                     cfg_vars["BUILD_DURATION"] = f"{duration.total_seconds():.6f}"
+                host_vars = ctx.obj.volume_vars
+                cmd_volumes = volumes
+                if code_dir is not None:
+                    host_vars = ChainMap({'WORKSPACE': str(code_dir)}, host_vars)
+                    if image is None:
+                        cfg_vars['WORKSPACE'] = str(code_dir)
+                    elif '/code' in volumes:
+                        cmd_volumes = OrderedDict(volumes)
+                        cmd_volumes['/code'] = {**volumes['/code'], 'source': str(code_dir)}
 
-                final_env = env.copy()
-                for k, v in cmd_env.items():
-                    if v is None and k in final_env:
-                        del final_env[k]
-                    else:
-                        final_env[k] = expand_vars(cfg_vars, v)
+                # A value of None removes the variable from the environment
+                final_env = ChainMap({k: None if v is None else expand_vars(cfg_vars, v) for k, v in cmd_env.items()}, env)
                 final_cmd = [expand_vars(cfg_vars, arg) for arg in cmd]
 
                 if final_cmd == [":"]:
                     # NOP: skip. This command, on *nix, would always do nothing and return with exit code 0. So abuse it for a NOP.
-                    continue
+                    return
+                traced_cmd = format_cmd(final_cmd, variant_credentials)
 
                 # Handle execution inside docker
                 cidfile = None
+                exec_container = None
                 try:
                     if image is not None:
+                        container_env = {k: v for k, v in final_env.items() if v is not None}
                         uid, gid = os.getuid(), os.getgid()
-                        fd, cidfile = tempfile.mkstemp(prefix='hopic-docker-run-cid-', suffix='.txt')
-                        os.close(fd)
-                        # Docker wants this file to not exist (yet) when starting a container
-                        os.unlink(cidfile)
-                        docker_run = [
-                            "docker",
-                            "run",
-                            "--rm",
-                            f"--cidfile={cidfile}",
+                        container_args = [
                             "--net=host",
                             "--cap-add=SYS_PTRACE",
-                            f"--tmpfs={final_env['HOME']}:exec,uid={uid},gid={gid}",
+                            f"--tmpfs={container_env['HOME']}:exec,uid={uid},gid={gid}",
                             f"--user={uid}:{gid}",
+                        ]
+                        command_args = [
                             f"--workdir={expand_vars(volume_vars, cwd)}",
-                            *(f"--env={k}={v}" for k, v in final_env.items()),
+                            *(f"--env={k}={v}" for k, v in container_env.items()),
                         ]
 
-                        if all(hasattr(fd, 'isatty') and fd.isatty() for fd in [sys.stderr, sys.stdout, sys.stdin]):
-                            docker_run += ['--tty']
+                        # Captured output, of concurrently executing items, isn't a terminal
+                        if stderr is None and all(hasattr(fd, 'isatty') and fd.isatty() for fd in [sys.stderr, sys.stdout, sys.stdin]):
+                            command_args += ['--tty']
 
+                        container_mounts = []
                         if docker_in_docker:
                             try:
                                 sock = '/var/run/docker.sock'
@@ -414,50 +810,91 @@ def build_variant(
                                 log.error("Docker in Docker access requested but cannot access Docker socket: %s", e)
                             else:
                                 if stat.S_ISSOCK(st.st_mode):
-                                    docker_run += [f"--volume={sock}:{sock}"]
+                                    container_mounts += [f"--volume={sock}:{sock}"]
                                     # Give group access to the socket if it's group accessible but not world accessible
                                     if st.st_mode & 0o0060 == 0o0060 and st.st_mode & 0o0006 != 0o0006:
-                                        docker_run += [f"--group-add={st.st_gid}"]
+                                        container_mounts += [f"--group-add={st.st_gid}"]
 
-                        for volume in volumes.values():
-                            docker_run += ['--volume={}'.format(volume_spec_to_docker_param(volume))]
+                        for volume in cmd_volumes.values():
+                            container_mounts += ['--volume={}'.format(volume_spec_to_docker_param(volume))]
 
                         for volume_from in volumes_from:
-                            docker_run += ['--volumes-from=' + volume_from]
-
-                        docker_run += extra_docker_run_args
-                        docker_run.append(str(image))
-                        final_cmd = docker_run + final_cmd
-                    new_env = os.environ.copy()
-                    if image is None:
-                        new_env.update(final_env)
-                        for k, v in cmd_env.items():
-                            if v is None and k in new_env:
-                                del new_env[k]
+                            container_mounts += ['--volumes-from=' + volume_from]
+
+                        container_mounts += extra_docker_run_args
+
+                        # A reused container doesn't have the commit's checkout mounted
+                        if reuse_container and not ctx.obj.dry_run and code_dir is None:
+                            exec_container = exec_containers.get(image, [*container_args, *container_mounts])
+
+                        if exec_container is not None:
+                            final_cmd = [
+                                "docker",
+                                "exec",
+                                f"--user={uid}:{gid}",
+                                *command_args,
+                                exec_container,
+                                *final_cmd,
+                            ]
+                        else:
+                            fd, cidfile = tempfile.mkstemp(prefix='hopic-docker-run-cid-', suffix='.txt')
+                            os.close(fd)
+                            # Docker wants this file to not exist (yet) when starting a container
+                            os.unlink(cidfile)
+                            final_cmd = [
+                                "docker",
+                                "run",
+                                "--rm",
+                                f"--cidfile={cidfile}",
+                                *container_args,
+                                *command_args,
+                                *container_mounts,
+                                str(image),
+                                *final_cmd,
+                            ]
+                    # Only gets materialized, once, when executing
+                    new_env = os.environ if image is not None else ChainMap(*final_env.maps, os.environ)
 
                     def signal_handler(signum, frame):
                         log.warning('Received fatal signal %d', signum)
                         raise FatalSignal(signum)
 
-                    old_handlers = dict((num, signal.signal(num, signal_handler)) for num in (signal.SIGINT, signal.SIGTERM))
+                    old_handlers = {}
+                    if threading.current_thread() is threading.main_thread():
+                        # Otherwise the thread that started this one handles signals
+                        old_handlers = dict((num, signal.signal(num, signal_handler)) for num in (signal.SIGINT, signal.SIGTERM))
                     try:
-                        echo_cmd(
-                            subprocess.check_call,
-                            final_cmd,
-                            env=new_env,
-                            cwd=expand_vars(ctx.obj.volume_vars, cwd),
-                            obfuscate=variant_credentials,
-                            timeout=timeout,
-                            stdout=exec_stdout,
-                        )
-                    except subprocess.CalledProcessError as e:
-                        log.error("Command fatally terminated with exit code %d", e.returncode)
-                        ctx.exit(e.returncode)
+                        with trace.command(
+                            traced_cmd,
+                            # Usage of concurrently executing children cannot be attributed to a single one of them
+                            resource_usage=check_call is None,
+                            phase=phase,
+                            variant=variant,
+                            image=None if image is None else str(image),
+                            container=None if image is None else "exec" if exec_container is not None else "run",
+                            foreach=None if foreach_item is None else str(foreach_item),
+                        ):
+                            echo_cmd(
+                                subprocess.check_call if check_call is None else check_call,
+                                final_cmd,
+                                env=new_env,
+                                cwd=expand_vars(host_vars, cwd),
+                                obfuscate=variant_credentials,
+                                timeout=timeout,
+                                stdout=stdout,
+                                **({} if stderr is None else {'stderr': stderr}),
+                            )
                     except (FatalSignal, subprocess.TimeoutExpired) as exc:
-                        if cidfile and os.path.isfile(cidfile):
+                        cid = None
+                        if exec_container is not None:
+                            # Terminating 'docker exec' doesn't terminate the command inside the container, stopping the container does
+                            cid = exec_container
+                            exec_containers.discard(exec_container)
+                        elif cidfile and os.path.isfile(cidfile):
                             # If we're being signalled to shut down ensure the spawned docker container also gets cleaned up.
                             with open(cidfile) as f:
                                 cid = f.read()
+                        if cid:
                             try:
                                 # Will also remove the container due to the '--rm' it was started with.
                                 echo_cmd(subprocess.check_call, ('docker', 'stop', cid))
@@ -476,8 +913,9 @@ def signal_handler(signum, frame):
                         else:
                             assert isinstance(exc, subprocess.TimeoutExpired)
                             raise StepTimeoutExpiredError(timeout, cmd=" ".join(cmd))
-                    for num, old_handler in old_handlers.items():
-                        signal.signal(num, old_handler)
+                    finally:
+                        for num, old_handler in old_handlers.items():
+                            signal.signal(num, old_handler)
                 finally:
                     if cidfile:
                         try:
@@ -485,13 +923,23 @@ def signal_handler(signum, frame):
                         except FileNotFoundError:
                             pass
 
+            if foreach_jobs > 1 and len(foreach_items) > 1 and not ctx.obj.dry_run:
+                _execute_foreach_concurrently(ctx, execute, foreach_items, foreach=foreach, jobs=foreach_jobs, stdout=exec_stdout)
+            else:
+                for foreach_item in foreach_items:
+                    try:
+                        execute(foreach_item)
+                    except subprocess.CalledProcessError as e:
+                        log.error("Command fatally terminated with exit code %d", e.returncode)
+                        ctx.exit(e.returncode)
+
             with git.Repo(ctx.obj.workspace) as repo:
                 source_commit = repo.head.commit
                 if changed_files:
                     repo.index.add(expand_vars(volume_vars, f) for f in changed_files)
 
             for subdir, worktree in worktrees.items():
-                with git.Repo(ctx.obj.workspace / subdir) as repo:
+                with trace.span("commit-worktree", worktree=str(subdir)), git.Repo(ctx.obj.workspace / subdir) as repo:
                     worktree_commits.setdefault(subdir, [
                         str(repo.head.commit),
                         str(repo.head.commit),
@@ -539,32 +987,37 @@ def signal_handler(signum, frame):
                 else:
                     refspecs = []
 
-                bundle_commits = []
+                bundle_refs = []
+                bundle_excludes = []
                 for subdir, (base_commit, submit_commit) in worktree_commits.items():
                     worktree_ref = ctx.obj.config['scm']['git']['worktrees'][subdir]
                     if worktree_ref in repo.heads:
                         repo.heads[worktree_ref].set_commit(submit_commit, logmsg='Prepare for git-bundle')
                     else:
                         repo.create_head(worktree_ref, submit_commit)
-                    bundle_commits.append(f"{base_commit}..{worktree_ref}")
+                    bundle_refs.append(worktree_ref)
+                    bundle_excludes.append(base_commit)
                     refspecs.append(f"{submit_commit}:{worktree_ref}")
-                repo.git.bundle('create', ctx.obj.workspace / 'worktree-transfer.bundle', *bundle_commits)
+                git_bundle.create(repo, ctx.obj.workspace / 'worktree-transfer.bundle', bundle_refs, exclude=bundle_excludes)
 
                 git_cfg.set_value(section, 'refspecs', ' '.join(shlex.quote(refspec) for refspec in refspecs))
 
         # Post-processing to make these artifacts as reproducible as possible
-        for artifact_pattern in optional_artifacts:
+        # Matched artifacts are deduplicated because they may not be normalized concurrently with themselves
+        artifacts_to_normalize: Dict[Path, int] = OrderedDict()
+        for artifact_pattern, compression_level in optional_artifacts:
             for artifact in ctx.obj.code_dir.glob(artifact_pattern):
-                binary_normalize.normalize(artifact, source_date_epoch=ctx.obj.source_date_epoch)
+                artifacts_to_normalize.setdefault(artifact, compression_level)
 
         pattern_matched = False
-        mandatory_artifacts = [expand_vars(volume_vars, exp) for exp in mandatory_artifacts]
-        for pattern in mandatory_artifacts:
+        mandatory_artifacts = [(expand_vars(volume_vars, exp), compression_level) for exp, compression_level in mandatory_artifacts]
+        for pattern, compression_level in mandatory_artifacts:
             for artifact in ctx.obj.code_dir.glob(pattern):
                 pattern_matched = True
-                binary_normalize.normalize(artifact, source_date_epoch=ctx.obj.source_date_epoch)
+                artifacts_to_normalize.setdefault(artifact, compression_level)
+        _normalize_artifacts(artifacts_to_normalize, source_date_epoch=ctx.obj.source_date_epoch)
         if mandatory_artifacts and not pattern_matched:
-            raise MissingFileError(f"none of these mandatory artifact patterns matched a file: {mandatory_artifacts}")
+            raise MissingFileError(f"none of these mandatory artifact patterns matched a file: {[pattern for pattern, _ in mandatory_artifacts]}")
 
         pattern_matched = False
         mandatory_junit = [expand_vars(volume_vars, exp) for exp in mandatory_junit]
@@ -576,18 +1029,215 @@ def signal_handler(signum, frame):
             raise MissingFileError(f"none of these mandatory junit patterns matched a file: {mandatory_junit}")
 
 
+class _VariantTask:
+    """
+    A single variant of a single phase, scheduled for execution in a separate Hopic process.
+    """
+
+    def __init__(self, phase: str, variant: str, *, dependencies: typing.AbstractSet[Tuple[str, str]], exclusive: bool):
+        self.phase = phase
+        self.variant = variant
+        self.dependencies = dependencies
+        self.exclusive = exclusive
+        self.process: Optional[subprocess.Popen] = None
+
+    @property
+    def key(self) -> Tuple[str, str]:
+        return (self.phase, self.variant)
+
+    @property
+    def name(self) -> str:
+        return f"{self.phase}.{self.variant}"
+
+    @property
+    def exit_code(self) -> int:
+        assert self.process is not None
+        returncode = self.process.returncode
+        return returncode if returncode >= 0 else 128 - returncode
+
+    def start(self, cmd: Sequence[str], *, finished: queue.Queue, output_lock: threading.Lock, color: Optional[bool]) -> None:
+        log.info("starting %s", click.style(self.name, fg='cyan'))
+        self.process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        prefix = click.style(f"[{self.name}]", fg='cyan')
+
+        def forward(stream, err):
+            for line in stream:
+                line = line.decode('UTF-8', errors='replace').rstrip('\r\n')
+                # Output whole lines only, to prevent interleaving output of different variants within a single line
+                with output_lock:
+                    click.echo(f"{prefix} {line}", err=err, color=color)
+            stream.close()
+
+        def wait(readers):
+            for reader in readers:
+                reader.join()
+            self.process.wait()
+            finished.put(self)
+
+        readers = [
+            threading.Thread(target=forward, args=(self.process.stdout, False), daemon=True),
+            threading.Thread(target=forward, args=(self.process.stderr, True), daemon=True),
+        ]
+        for reader in readers:
+            reader.start()
+        threading.Thread(target=wait, args=(readers,), daemon=True).start()
+
+
+def _variant_task_command(ctx, phase: str, variant: str, *, action_cache_dir: Optional[str] = None) -> List[str]:
+    """
+    Builds the command line that makes a new Hopic process build just the given variant with the same global options.
+    """
+
+    params = ctx.find_root().params
+    cmd = [sys.executable, '-m', PACKAGE, '--color=always']
+    if params.get('config') is not None:
+        cmd.append(f"--config={params['config']}")
+    if params.get('trace_file') is not None:
+        cmd.append(f"--trace={params['trace_file']}")
+    if params.get('workspace') is not None:
+        cmd.append(f"--workspace={ctx.obj.workspace}")
+    for var in params.get('whitelisted_var', ()):
+        cmd.append(f"--whitelisted-var={var}")
+    if params.get('publishable_version'):
+        cmd.append('--publishable-version')
+    if not params.get('config_cache', True):
+        cmd.append('--no-config-cache')
+    for logger, option in (
+        (PACKAGE, '--verbosity'),
+        ('git', '--git-verbosity'),
+    ):
+        level = logging.getLogger(logger).level
+        if level != logging.NOTSET:
+            cmd.append(f"{option}={logging.getLevelName(level)}")
+
+    cmd.extend(('build', f"--phase={phase}", f"--variant={variant}"))
+    if action_cache_dir is not None:
+        cmd.append(f"--action-cache={action_cache_dir}")
+    return cmd
+
+
+def _build_concurrently(
+    ctx,
+    variants: Sequence[Tuple[str, str, Sequence]],
+    *,
+    jobs: int,
+    keep_going: bool,
+    action_cache_dir: Optional[str] = None,
+) -> None:
+    phase_names = list(ctx.obj.config['phases'])
+    tasks: Dict[Tuple[str, str], _VariantTask] = OrderedDict()
+    for phasename, curvariant, cmds in variants:
+        previous_phase = phase_names[phase_names.index(phasename) - 1] if phase_names.index(phasename) > 0 else None
+        if all(cmd.get('wait-on-full-previous-phase', True) for cmd in cmds):
+            dependencies = frozenset(key for key in tasks if key[0] != phasename)
+        else:
+            # The configuration reader guarantees that the previous phase contains this variant and nothing that other variants depend on
+            dependencies = frozenset(key for key in tasks if key == (previous_phase, curvariant))
+
+        # Worktrees and changed files get committed to the shared repository, which cannot happen concurrently
+        exclusive = any('worktrees' in cmd or cmd.get('changed-files') for cmd in cmds)
+
+        task = _VariantTask(phasename, curvariant, dependencies=dependencies, exclusive=exclusive)
+        tasks[task.key] = task
+
+    pending = list(tasks.values())
+    running: Dict[Tuple[str, str], _VariantTask] = OrderedDict()
+    succeeded = set()
+    failed: Dict[Tuple[str, str], _VariantTask] = OrderedDict()
+    skipped = set()
+    stopping = False
+    finished: queue.Queue = queue.Queue()
+    output_lock = threading.Lock()
+
+    def stop_running():
+        for task in running.values():
+            if task.process.poll() is None:
+                # Lets the variant clean up after itself, e.g. stop its Docker container
+                task.process.terminate()
+
+    def signal_handler(signum, frame):
+        log.warning('Received fatal signal %d', signum)
+        raise FatalSignal(signum)
+
+    old_handlers = dict((num, signal.signal(num, signal_handler)) for num in (signal.SIGINT, signal.SIGTERM))
+    try:
+        while pending or running:
+            for task in list(pending):
+                if stopping:
+                    break
+                if task.dependencies & (failed.keys() | skipped):
+                    log.error("not building %s because a variant it depends on failed", task.name)
+                    pending.remove(task)
+                    skipped.add(task.key)
+                    continue
+                if len(running) >= jobs or not task.dependencies <= succeeded:
+                    continue
+                if running and task.exclusive:
+                    # Start nothing else before it, to prevent starving it
+                    break
+                if any(other.exclusive for other in running.values()):
+                    break
+
+                pending.remove(task)
+                task.start(_variant_task_command(ctx, task.phase, task.variant, action_cache_dir=action_cache_dir), finished=finished, output_lock=output_lock, color=ctx.color)
+                running[task.key] = task
+
+            if not running:
+                break
+
+            task = finished.get()
+            del running[task.key]
+            if task.exit_code == 0:
+                log.info("finished %s", click.style(task.name, fg='cyan'))
+                succeeded.add(task.key)
+                continue
+
+            log.error("%s failed with exit code %d", task.name, task.exit_code)
+            failed[task.key] = task
+            if not keep_going and not stopping:
+                stopping = True
+                stop_running()
+    except FatalSignal as exc:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        stop_running()
+        for task in running.values():
+            task.process.wait()
+        ctx.exit(128 + exc.signal)
+    finally:
+        for num, old_handler in old_handlers.items():
+            signal.signal(num, old_handler)
+
+    if failed:
+        not_built = [task.name for task in pending] + [tasks[key].name for key in skipped]
+        if not_built:
+            log.error("variants not built: %s", ", ".join(not_built))
+        log.error("failed variants: %s", ", ".join(task.name for task in failed.values()))
+        ctx.exit(next(iter(failed.values())).exit_code)
+
+
 @click.command()
-@click.option('--phase'  , '-p', metavar='<phase>'  , multiple=True, help='''Build phase to execute''', autocompletion=autocomplete.phase_from_config)
-@click.option('--variant', '-v', metavar='<variant>', multiple=True, help='''Configuration variant to build''', autocompletion=autocomplete.variant_from_config)
-@click.option('--dry-run', '-n', is_flag=True, default=False, help='''Print commands from the configured phases and variants, but do not execute them''')
+@click.option('--phase'     , '-p', metavar='<phase>'  , multiple=True, help='''Build phase to execute''', autocompletion=autocomplete.phase_from_config)
+@click.option('--variant'   , '-v', metavar='<variant>', multiple=True, help='''Configuration variant to build''', autocompletion=autocomplete.variant_from_config)
+@click.option('--dry-run'   , '-n', is_flag=True, default=False, help='''Print commands from the configured phases and variants, but do not execute them''')
+@click.option('--jobs'      , '-j', type=click.IntRange(min=1), default=1, show_default=True, help='''Number of variants to build concurrently''')
+@click.option('--keep-going', '-k', is_flag=True, default=False, help='''Keep building variants that don't depend on a failed variant when building concurrently''')
+@click.option('--action-cache', 'action_cache_dir', metavar='<directory>', envvar='HOPIC_ACTION_CACHE', type=click.Path(file_okay=False, dir_okay=True, resolve_path=True), help='''Restore outputs of variants with unchanged `cache-inputs` from, and store them in, this directory''')  # noqa: E501
 @click.pass_context
-def build(ctx, phase, variant, dry_run):
+def build(ctx, phase, variant, dry_run, jobs, keep_going, action_cache_dir):
     """
     Build for the specified commit.
 
     This defaults to building all variants for all phases.
     It's possible to limit building to either all variants for a single phase, all phases for a single variant or a
     single variant for a single phase.
+
+    With multiple jobs, variants of a phase are built concurrently, each in a separate process with its output prefixed
+    by its name. Variants wait for all variants of the previous phases, unless they disable
+    `wait-on-full-previous-phase`, in which case they only wait for the same variant in the previous phase.
+
+    With an action cache, variants that declare `cache-inputs` aren't built when the cache contains the outputs of an
+    earlier build with the same inputs. Those outputs get restored instead.
     """
     # Ensure any required extensions are available
     initialize_global_variables_from_config(extensions.install_extensions.callback())
@@ -602,6 +1252,7 @@ def build(ctx, phase, variant, dry_run):
     if unknown_phases:
         raise UnknownPhaseError(phase=unknown_phases)
 
+    variants = []
     for phasename, curphase in ctx.obj.config['phases'].items():
         if phase and phasename not in phase:
             continue
@@ -614,4 +1265,37 @@ def build(ctx, phase, variant, dry_run):
             if variant and curvariant not in variant:
                 continue
 
-            build_variant(variant=curvariant, cmds=cmds, hopic_git_info=hopic_git_info)
+            variants.append((phasename, curvariant, cmds))
+
+    if jobs > 1 and len(variants) > 1 and not dry_run:
+        _build_concurrently(ctx, variants, jobs=jobs, keep_going=keep_going, action_cache_dir=action_cache_dir)
+        return
+
+    if dry_run:
+        action_cache_dir = None
+    hits = misses = 0
+    for phasename, curvariant, cmds in variants:
+        with trace.span(f"{phasename}.{curvariant}", "variant", phase=phasename, variant=curvariant) as trace_args:
+            key = None
+            if action_cache_dir is not None:
+                key = _action_cache_key(ctx, phasename, curvariant, cmds, hopic_git_info)
+            if key is not None:
+                outputs = _action_cache_outputs(ctx, cmds, hopic_git_info)
+                restored = action_cache.restore(action_cache_dir, key, {name: base for name, (base, _) in outputs.items()})
+                if restored is not None:
+                    log.info("restored %d file(s) of %s from the action cache", restored, click.style(f"{phasename}.{curvariant}", fg='cyan'))
+                    trace_args["action_cache"] = "hit"
+                    hits += 1
+                    continue
+                trace_args["action_cache"] = "miss"
+                misses += 1
+
+            build_variant(variant=curvariant, cmds=cmds, hopic_git_info=hopic_git_info, phase=phasename)
+
+            if key is not None:
+                stored = action_cache.store(action_cache_dir, key, outputs)
+                if stored is not None:
+                    log.debug("stored %d file(s) of %s in the action cache", stored, f"{phasename}.{curvariant}")
+
+    if hits or misses:
+        log.info("action cache: %d hit(s), %d miss(es)", hits, misses)
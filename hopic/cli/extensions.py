@@ -14,13 +14,19 @@
 
 import importlib
 import logging
+import os
 import re
+import stat
 import subprocess
 import sys
 import tempfile
 from pathlib import Path
 from textwrap import dedent
 from typing import (
+    TYPE_CHECKING,
+    Iterable,
+    List,
+    Mapping,
     Optional,
 )
 
@@ -28,6 +34,11 @@
 
 import click
 
+if TYPE_CHECKING:
+    # Expensive to import, so only imported when needed at run time
+    from pkg_resources import Requirement
+
+from .. import cache as hopic_cache
 from ..config_reader import (
     get_entry_points,
     read as read_config,
@@ -86,9 +97,107 @@ def installer(pip_cfg):
         determine_config_file_name(ctx),
         ctx.obj.volume_vars,
         installer,
+        cache=ctx.obj.config_cache,
     )
 
 
+def _canonical_name(name: str) -> str:
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def _parse_constraints(constraints_text: str) -> Optional[Mapping[str, List["Requirement"]]]:
+    """
+    Parses the content of a constraints file, returns None if it contains anything that we cannot evaluate ourselves.
+    """
+
+    from pkg_resources import Requirement
+
+    constraints = {}
+    for line in constraints_text.splitlines():
+        line = re.sub(r"(?:^|\s)#.*$", "", line).strip()
+        if not line:
+            continue
+        try:
+            req = Requirement.parse(line)
+        except ValueError:
+            return None
+        constraints.setdefault(_canonical_name(req.project_name), []).append(req)
+    return constraints
+
+
+def _requirement_satisfied(requirement: "Requirement", constraints: Mapping[str, List["Requirement"]], extras: Iterable[str] = ("",), _seen=None) -> bool:
+    """
+    Determines whether the given requirement, and everything it depends on, is satisfied by the installed packages.
+    """
+
+    if requirement.marker is not None and not any(requirement.marker.evaluate({"extra": extra}) for extra in extras):
+        return True
+
+    # The origin of an installed package cannot be compared against a URL
+    if getattr(requirement, "url", None):
+        return False
+
+    try:
+        version = metadata.version(requirement.project_name)
+    except metadata.PackageNotFoundError:
+        return False
+
+    name = _canonical_name(requirement.project_name)
+    for req in (requirement, *constraints.get(name, ())):
+        if getattr(req, "url", None) or version not in req:
+            return False
+
+    seen = set() if _seen is None else _seen
+    key = (name, frozenset(requirement.extras))
+    if key in seen:
+        return True
+    seen.add(key)
+
+    from pkg_resources import Requirement
+
+    dependency_extras = ("", *requirement.extras)
+    for dependency in metadata.requires(requirement.project_name) or ():
+        try:
+            dependency = Requirement.parse(dependency)
+        except ValueError:
+            return False
+        if not _requirement_satisfied(dependency, constraints, dependency_extras, seen):
+            return False
+
+    return True
+
+
+def _package_satisfied(package: str, constraints: Mapping[str, List["Requirement"]]) -> bool:
+    from pkg_resources import Requirement
+
+    try:
+        requirement = Requirement.parse(package)
+    except ValueError:
+        # Anything that isn't a requirement specifier (e.g. a path or URL) is left for pip to interpret
+        return False
+    return _requirement_satisfied(requirement, constraints)
+
+
+def _environment_fingerprint():
+    """
+    Describes the state of all installation directories.
+
+    Installing or removing packages modifies these directories, which changes this fingerprint.
+    """
+
+    fingerprint = []
+    for path in sys.path:
+        if not path:
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            fingerprint.append((path, st.st_mtime_ns))
+    return (sys.executable, sys.prefix, tuple(fingerprint))
+
+
 def install_extensions_with_config(pip_cfg, input_constraints_file: Optional[str], *, upgrade: bool):
     if not pip_cfg:
         return
@@ -130,7 +239,27 @@ def install_extensions_with_config(pip_cfg, input_constraints_file: Optional[str
         if upgrade:
             base_cmd.append("--upgrade")
 
+        # Upgrading requires consulting the package indices, otherwise we only need pip when something is missing
+        constraints = None if upgrade else _parse_constraints(constraints_text)
+
         for spec in pip_cfg:
+            packages = spec['packages']
+            if constraints is not None:
+                stamp = hopic_cache.cache_key(spec, constraints_text, _environment_fingerprint())
+                try:
+                    hopic_cache.load("pip-install", stamp)
+                except KeyError:
+                    pass
+                else:
+                    log.debug("skipping installation of already installed extensions: %s", ", ".join(packages))
+                    continue
+
+                packages = [package for package in packages if not _package_satisfied(package, constraints)]
+                if not packages:
+                    log.info("requirements already satisfied: %s", ", ".join(spec['packages']))
+                    hopic_cache.store("pip-install", stamp, True)
+                    continue
+
             cmd = base_cmd.copy()
 
             from_index = spec.get('from-index')
@@ -139,7 +268,7 @@ def install_extensions_with_config(pip_cfg, input_constraints_file: Optional[str
             for index in spec['with-extra-index']:
                 cmd.extend(['--extra-index-url', index])
 
-            cmd.extend(spec['packages'])
+            cmd.extend(packages)
 
             try:
                 echo_cmd(subprocess.check_call, cmd, stdout=sys.__stderr__)
@@ -178,6 +307,10 @@ def try_int(s):
                     )
                 raise
 
+            if constraints is not None:
+                importlib.invalidate_caches()
+                hopic_cache.store("pip-install", hopic_cache.cache_key(spec, constraints_text, _environment_fingerprint()), True)
+
     # Ensure newly installed packages can be imported
     importlib.invalidate_caches()
     get_entry_points.cache_clear()
@@ -12,31 +12,35 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import importlib
 import logging
 import os
 from pathlib import Path
+from typing import (
+    Any,
+    Dict,
+    Mapping,
+    Optional,
+    Tuple,
+)
 
 import click
 import click_log
-import git
 
 from . import autocomplete
+from .. import trace
 from .utils import (
         get_package_version,
     )
-from ..config_reader import (
-        read as read_config,
-    )
-
-from .global_obj import (
-    set_path_variables,
-    set_version_variables
-)
 
 PACKAGE : str = __package__.split('.')[0]
 
 log = logging.getLogger(__name__)
 
+# Global state determined by a server, along with the inputs it got determined from, for reuse by its forked children
+_preserved_state: Optional[Tuple[Tuple[Any, ...], Dict[str, Any]]] = None
+_STATE_KEY = "hopic.global_state_key"
+
 
 class OptionContext(object):
     def __init__(self):
@@ -89,17 +93,85 @@ def register_dependent_attribute(self, name, dependency):
         self._missing_parameters[name] = self._missing_parameters[dependency]
 
 
-@click.group(context_settings=dict(help_option_names=('-h', '--help')))
+class LazyGroup(click.Group):
+    """
+    Imports the modules implementing subcommands only when those are needed.
+
+    This keeps startup cheap for anything that doesn't need all of them, e.g. --version, --help and auto completion.
+    """
+
+    def __init__(self, *args, lazy_commands: Mapping[str, Tuple[str, str]], **kwargs):
+        super().__init__(*args, **kwargs)
+        # command name -> ('<module relative to this package>:<attribute>', short help)
+        self.lazy_commands = lazy_commands
+
+    def list_commands(self, ctx):
+        return sorted(frozenset(super().list_commands(ctx)) | frozenset(self.lazy_commands))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name not in self.commands and cmd_name in self.lazy_commands:
+            module_name, attribute = self.lazy_commands[cmd_name][0].split(":")
+            cmd = getattr(importlib.import_module(module_name, __package__), attribute)
+            self.add_command(cmd, cmd_name)
+        return super().get_command(ctx, cmd_name)
+
+    def format_commands(self, ctx, formatter):
+        # Describe commands that aren't imported yet with their short help only, to not import them just for --help
+        commands = []
+        for subcommand in self.list_commands(ctx):
+            cmd = self.commands.get(subcommand)
+            if cmd is None and subcommand in self.lazy_commands:
+                cmd = click.Command(subcommand, help=self.lazy_commands[subcommand][1])
+            if cmd is None or cmd.hidden:
+                continue
+            commands.append((subcommand, cmd))
+
+        if commands:
+            limit = formatter.width - 6 - max(len(subcommand) for subcommand, _ in commands)
+            with formatter.section("Commands"):
+                formatter.write_dl([(subcommand, cmd.get_short_help_str(limit)) for subcommand, cmd in commands])
+
+
+@click.group(
+    cls=LazyGroup,
+    context_settings=dict(help_option_names=('-h', '--help')),
+    lazy_commands={
+        "build"                 : (".build:build"                       , "Build for the specified commit."),
+        "checkout-source-tree"  : (".commands:checkout_source_tree"     , "Checks out a source tree of the specified remote's ref to the workspace."),
+        "getinfo"               : (".commands:getinfo"                  , "Display meta-data associated with each (or the specified) variant in each (or the specified) phase."),
+        "install-extensions"    : (".extensions:install_extensions"     , ""),
+        "may-publish"           : (".commands:may_publish"              , "Check if the target branch name is allowed to be published, according to publish-from-branch in the config file."),
+        "prepare-source-tree"   : (".commands:prepare_source_tree"      , "Prepares the source tree for building a change performed by a subcommand."),
+        "serve"                 : (".serve:serve"                       , "Serve Hopic commands from a resident process, to avoid startup costs."),
+        "show-config"           : (".commands:show_config"              , "Diagnostic helper command to display the configuration after processing."),
+        "show-env"              : (".commands:show_env"                 , "Diagnostic helper command to display the execution environment."),
+        "submit"                : (".commands:submit"                   , "Submit the changes created by prepare-source-tree to the target remote."),
+        "unbundle"              : (".commands:unbundle"                 , "Unbundle the specified git bundle and setup all included refs for pushing."),
+        "unbundle-worktrees"    : (".commands:unbundle_worktrees"       , "Unbundle a git bundle and fast-forward all the configured worktrees that are included in it."),
+    },
+)
 @click.option('--color'          , type=click.Choice(('always', 'auto', 'never'))                                                  , default='auto'      , show_default=True)  # noqa: E501
 @click.option('--config'         , type=click.Path(exists=False, file_okay=True , dir_okay=False, readable=True, resolve_path=True), default=lambda: None, show_default='${WORKSPACE}/hopic-ci-config.yaml')  # noqa: E501
 @click.option('--workspace'      , type=click.Path(exists=False, file_okay=False, dir_okay=True)                                   , default=lambda: None, show_default='git work tree of config file or current working directory')  # noqa: E501
 @click.option('--whitelisted-var', multiple=True                                                                                   , default=['CT_DEVENV_HOME'], hidden=True)  # noqa: E501
 @click.option('--publishable-version', is_flag=True                                                                                , default=False, hidden=True, help='''Indicate if change is publishable or not''')  # noqa: E501
+@click.option('--config-cache/--no-config-cache', envvar='HOPIC_CONFIG_CACHE'                                                        , default=True, show_default=True, help='''Reuse the processed configuration from Hopic's persistent cache when its inputs didn't change''')  # noqa: E501
+@click.option('--trace'          , 'trace_file', type=click.Path(exists=False, file_okay=True , dir_okay=False, writable=True, resolve_path=True), envvar='HOPIC_TRACE', help='''Append a trace of the time spent, and resources used, by Hopic and executed commands to this file''')  # noqa: E501
 @click.version_option(get_package_version(PACKAGE))
 @click_log.simple_verbosity_option(PACKAGE                 , envvar='HOPIC_VERBOSITY', autocompletion=autocomplete.click_log_verbosity)
 @click_log.simple_verbosity_option('git', '--git-verbosity', envvar='GIT_VERBOSITY'  , autocompletion=autocomplete.click_log_verbosity)
 @click.pass_context
-def main(ctx, color, config, workspace, whitelisted_var, publishable_version):
+def main(ctx, color, config, workspace, whitelisted_var, publishable_version, config_cache, trace_file):
+    # Imported here to avoid paying for them when not executing any subcommand
+    import git
+    from ..config_reader import (
+            read as read_config,
+        )
+    from .global_obj import (
+        set_path_variables,
+        set_version_variables
+    )
+
     if color == 'always':
         ctx.color = True
     elif color == 'never':
@@ -110,6 +182,11 @@ def main(ctx, color, config, workspace, whitelisted_var, publishable_version):
 
     click_log.basic_config()
 
+    if trace_file is not None:
+        trace.enable(trace_file)
+    else:
+        trace.disable()
+
     ctx.obj = OptionContext()
     for param in ctx.command.params:
         ctx.obj.register_parameter(ctx=ctx, param=param)
@@ -152,6 +229,7 @@ def exception_raiser(ctx, param):
     workspace = Path.cwd() / workspace
     ctx.obj.workspace = workspace
     ctx.obj.publishable_version = publishable_version
+    ctx.obj.config_cache = config_cache
     ctx.obj.volume_vars = {}
 
     ctx.obj.register_dependent_attribute('code_dir', 'workspace')
@@ -161,6 +239,20 @@ def exception_raiser(ctx, param):
     if config is not None:
         ctx.obj.config_file = config
     ctx.obj.register_dependent_attribute('config_file', 'config')
+
+    state_key = (
+        workspace,
+        config,
+        publishable_version,
+        config_cache,
+        tuple((var, os.environ.get(var)) for var in whitelisted_var),
+    )
+    ctx.meta[_STATE_KEY] = state_key
+    if _preserved_state is not None and _preserved_state[0] == state_key and ctx.invoked_subcommand != 'checkout-source-tree':
+        log.debug("reusing configuration and version determined by server")
+        ctx.obj._opts.update(_preserved_state[1])
+        return
+
     config = set_path_variables(workspace)
 
     for var in whitelisted_var:
@@ -186,5 +278,17 @@ def exception_raiser(ctx, param):
             except IOError:
                 pass
             else:
-                cfg = ctx.obj.config = read_config(config, ctx.obj.volume_vars)
-    set_version_variables(config, config=cfg)
+                with trace.span("read-config", config=str(config)):
+                    cfg = ctx.obj.config = read_config(config, ctx.obj.volume_vars, cache=config_cache)
+    with trace.span("determine-version"):
+        set_version_variables(config, config=cfg)
+
+
+def preserve_global_state(ctx: click.Context) -> None:
+    """
+    Makes the configuration, version and other global state determined by this process available to commands executed
+    in forked copies of it, when those get invoked with the same global options and whitelisted variables.
+    """
+
+    global _preserved_state
+    _preserved_state = (ctx.meta[_STATE_KEY], dict(ctx.obj._opts))
@@ -0,0 +1,291 @@
+# Copyright (c) 2021 - 2021 TomTom N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import logging
+import os
+from pathlib import Path
+import signal
+import socket
+import struct
+import sys
+import time
+import traceback
+from typing import (
+    Any,
+    Optional,
+    Set,
+    Tuple,
+)
+
+import click
+import git
+
+from .. import client
+from .extensions import _environment_fingerprint
+from .main import preserve_global_state
+
+PACKAGE : str = __package__.split('.')[0]
+
+log = logging.getLogger(__name__)
+
+# Set when a server replaces itself while holding an accepted, but not yet served, connection
+_CONN_FD_ENV_VAR = "HOPIC_SERVE_CONN_FD"
+
+
+def _state_fingerprint(workspace: Path, config_file: Optional[Path]) -> Tuple[Any, ...]:
+    """
+    Describes the state that, when changed, invalidates what a server has loaded.
+
+    That's the checked out commit, the index, the configuration file and the installed packages.
+    """
+
+    paths = [workspace / "hopic-ci-config.yaml", workspace / ".ci" / "hopic-ci-config.yaml"]
+    if config_file is not None:
+        paths.append(config_file)
+    try:
+        with git.Repo(workspace) as repo:
+            git_dir = Path(repo.git_dir)
+            common_dir = Path(repo.common_dir)
+            paths.extend((git_dir / "HEAD", git_dir / "index", common_dir / "packed-refs"))
+            if not repo.head.is_detached:
+                paths.append(common_dir / repo.head.reference.path)
+    except (git.InvalidGitRepositoryError, git.NoSuchPathError, ValueError):
+        pass
+
+    stats = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            stats.append((str(path), None))
+        else:
+            stats.append((str(path), st.st_ino, st.st_size, st.st_mtime_ns))
+    return tuple(stats), _environment_fingerprint()
+
+
+def _peer_uid(conn: socket.socket) -> Optional[int]:
+    """
+    Determines the user ID of the process at the other end of the connection, when the platform supports that.
+    """
+
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    creds = struct.Struct("3i")
+    pid, uid, gid = creds.unpack(conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, creds.size))
+    return uid
+
+
+def _execute_request(ctx: click.Context, conn: socket.socket) -> None:
+    """
+    Executes a single forwarded command line. Only to be called in a freshly forked process.
+    """
+
+    request, fds = client.receive_request(conn)
+    for target_fd, fd in enumerate(fds[:3]):
+        os.dup2(fd, target_fd)
+    for fd in fds:
+        if fd > 2:
+            os.close(fd)
+
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    for signum in (signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, signal.SIG_DFL)
+
+    os.environ.clear()
+    os.environ.update(request["env"])
+    os.chdir(request["cwd"])
+    sys.argv = [PACKAGE, *request["argv"]]
+
+    client.send_status(conn, os.getpid())
+
+    status = 0
+    try:
+        ctx.find_root().command.main(args=request["argv"], prog_name=PACKAGE)
+    except SystemExit as exc:
+        if exc.code is None:
+            status = 0
+        elif isinstance(exc.code, int):
+            status = exc.code
+        else:
+            sys.stderr.write(f"{exc.code}\n")
+            status = 1
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    finally:
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except (OSError, ValueError):
+                pass
+    client.send_status(conn, status)
+
+
+def _replace_process(listener: socket.socket, conn: Optional[socket.socket]) -> None:
+    """
+    Replaces the current server process by a fresh one, that takes over the listening socket.
+
+    The new process re-reads the configuration, and (re-)imports extensions, in the state they're currently in.
+    """
+
+    env = dict(os.environ)
+    os.set_inheritable(listener.fileno(), True)
+    env[client.LISTEN_FD_ENV_VAR] = str(listener.fileno())
+    if conn is not None:
+        os.set_inheritable(conn.fileno(), True)
+        env[_CONN_FD_ENV_VAR] = str(conn.fileno())
+    for stream in (sys.stdout, sys.stderr):
+        stream.flush()
+    os.execve(sys.executable, [sys.executable, "-m", PACKAGE, *sys.argv[1:]], env)
+
+
+def _listen(socket_path: str) -> socket.socket:
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with probe:
+        try:
+            probe.connect(socket_path)
+        except OSError as exc:
+            if exc.errno not in (errno.ENOENT, errno.ECONNREFUSED):
+                raise
+        else:
+            raise click.ClickException(f"another server is already listening on '{socket_path}'")
+
+    # Remove a stale socket left behind by a server that died
+    try:
+        os.unlink(socket_path)
+    except FileNotFoundError:
+        pass
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Only allow connecting by the same user
+    umask = os.umask(0o077)
+    try:
+        listener.bind(socket_path)
+    finally:
+        os.umask(umask)
+    listener.listen(64)
+    return listener
+
+
+@click.command()
+# fmt: off
+@click.option("--socket"      , "socket_path", envvar=client.SOCKET_ENV_VAR, required=True, type=click.Path(dir_okay=False), help="""Unix socket to listen on""")  # noqa: E501
+@click.option("--idle-timeout", type=click.IntRange(min=0), default=3600, show_default=True, help="""Seconds without requests after which to exit, 0 to never exit""")  # noqa: E501
+# fmt: on
+@click.pass_context
+def serve(ctx, socket_path, idle_timeout):
+    """
+    Serve Hopic commands from a resident process, to avoid startup costs.
+
+    The `hopic` command forwards its command line to this server when the HOPIC_SERVE_SOCKET environment variable
+    points to its socket. It executes every forwarded command in a forked copy of this process, with the forwarding process'
+    command line, environment, working directory, standard input, output and error. Commands invoked with the same global
+    options reuse the configuration and version determined by the server. The server only executes commands for the user
+    that it runs as.
+
+    Whenever the checked out commit, the index, the configuration file or the installed packages change, the server
+    replaces itself with a fresh process before executing the next command.
+    """
+
+    try:
+        config_file = ctx.obj.config_file
+    except (click.ClickException, AttributeError):
+        config_file = None
+    workspace = ctx.obj.workspace
+
+    listen_fd = os.environ.pop(client.LISTEN_FD_ENV_VAR, None)
+    conn_fd = os.environ.pop(_CONN_FD_ENV_VAR, None)
+    if listen_fd is not None:
+        listener = socket.socket(fileno=int(listen_fd))
+    else:
+        listener = _listen(socket_path)
+    os.set_inheritable(listener.fileno(), False)
+    pending = None
+    if conn_fd is not None:
+        pending = socket.socket(fileno=int(conn_fd))
+        os.set_inheritable(pending.fileno(), False)
+
+    def terminate(signum, frame):
+        sys.exit(128 + signum)
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGHUP, terminate)
+
+    fingerprint = _state_fingerprint(workspace, config_file)
+    preserve_global_state(ctx)
+    children: Set[int] = set()
+    last_activity = time.monotonic()
+    listener.settimeout(1)
+    log.info("serving %s on %s", workspace, socket_path)
+
+    replacing = False
+    try:
+        while True:
+            while children:
+                try:
+                    pid, _ = os.waitpid(-1, os.WNOHANG)
+                except ChildProcessError:
+                    children.clear()
+                    break
+                if not pid:
+                    break
+                children.discard(pid)
+
+            if pending is not None:
+                conn, pending = pending, None
+            else:
+                try:
+                    conn, _ = listener.accept()
+                except socket.timeout:
+                    if children:
+                        last_activity = time.monotonic()
+                    elif idle_timeout and time.monotonic() - last_activity >= idle_timeout:
+                        log.info("exiting after %d seconds without requests", idle_timeout)
+                        return
+                    continue
+            last_activity = time.monotonic()
+
+            with conn:
+                conn.settimeout(None)
+                uid = _peer_uid(conn)
+                if uid is not None and uid != os.getuid():
+                    log.warning("refusing request from user %d", uid)
+                    continue
+
+                new_fingerprint = _state_fingerprint(workspace, config_file)
+                if new_fingerprint != fingerprint:
+                    log.info("workspace, configuration or installed packages changed: restarting server")
+                    replacing = True
+                    _replace_process(listener, conn)
+
+                for stream in (sys.stdout, sys.stderr):
+                    stream.flush()
+                pid = os.fork()
+                if pid == 0:
+                    try:
+                        listener.close()
+                        _execute_request(ctx, conn)
+                    except BaseException:
+                        traceback.print_exc()
+                    finally:
+                        os._exit(0)
+                children.add(pid)
+                log.debug("executing request in process %d", pid)
+    finally:
+        if not replacing:
+            listener.close()
+            try:
+                os.unlink(socket_path)
+            except OSError:
+                pass
@@ -13,7 +13,6 @@
 # limitations under the License.
 
 from pathlib import Path
-from pkg_resources import parse_version
 import re
 import subprocess
 import sys
@@ -25,10 +24,6 @@
 
 import click
 
-from ..build import (
-    HopicGitInfo,
-)
-
 from ..compat import metadata
 
 
@@ -38,6 +33,7 @@ def is_publish_branch(ctx, hopic_git_info=None) -> bool:
     """
 
     if hopic_git_info is None:
+        from ..build import HopicGitInfo
         hopic_git_info = HopicGitInfo.from_repo(ctx.obj.workspace)
     if hopic_git_info is None or hopic_git_info.submit_ref is None:
         return False
@@ -94,6 +90,7 @@ def check_minimum_package_version(package: str, min_version: str) -> Tuple[bool,
     except metadata.PackageNotFoundError:
         return False, None
 
+    from pkg_resources import parse_version
     result = parse_version(version) >= parse_version(min_version)
 
     return result, version
@@ -0,0 +1,164 @@
+# Copyright (c) 2021 - 2021 TomTom N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Thin client for forwarding command line invocations to a resident ``hopic serve`` process.
+
+This module provides the console entry point. It deliberately only imports modules from the standard library, such that
+forwarding doesn't pay for importing Hopic's dependencies.
+"""
+
+import array
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+SOCKET_ENV_VAR = "HOPIC_SERVE_SOCKET"
+# Set when a server replaces itself, to hand over its listening socket
+LISTEN_FD_ENV_VAR = "HOPIC_SERVE_LISTEN_FD"
+
+_length = struct.Struct("!I")
+_status = struct.Struct("!i")
+_forwarded_fds = (0, 1, 2)
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError("connection closed prematurely")
+        data += chunk
+    return bytes(data)
+
+
+def send_request(sock: socket.socket, argv: Sequence[str], env: Dict[str, str], cwd: str, fds: Sequence[int]) -> None:
+    """
+    Sends the command line, environment and working directory to execute with, along with the given file descriptors.
+    """
+
+    payload = json.dumps({"argv": list(argv), "env": env, "cwd": cwd}).encode("UTF-8")
+    sock.sendmsg([_length.pack(len(payload))], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))])
+    sock.sendall(payload)
+
+
+def receive_request(sock: socket.socket) -> Tuple[Dict[str, Any], List[int]]:
+    """
+    Receives a request sent by :func:`send_request`. Returns the request and the received file descriptors.
+    """
+
+    fds = array.array("i")
+    msg, ancdata, flags, addr = sock.recvmsg(_length.size, socket.CMSG_SPACE(len(_forwarded_fds) * fds.itemsize))
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+    if len(msg) != _length.size:
+        for fd in fds:
+            os.close(fd)
+        raise EOFError("connection closed prematurely")
+
+    (length,) = _length.unpack(msg)
+    return json.loads(_recv_exactly(sock, length).decode("UTF-8")), list(fds)
+
+
+def send_status(sock: socket.socket, status: int) -> None:
+    sock.sendall(_status.pack(status))
+
+
+def receive_status(sock: socket.socket) -> int:
+    (status,) = _status.unpack(_recv_exactly(sock, _status.size))
+    return status
+
+
+def forward(socket_path: str, argv: Sequence[str]) -> Optional[int]:
+    """
+    Executes the given command line in the server listening on socket_path.
+
+    Returns the exit code of that command, or None when the server couldn't be reached.
+    """
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with sock:
+        try:
+            sock.connect(socket_path)
+            send_request(sock, argv, dict(os.environ), os.getcwd(), _forwarded_fds)
+            # The server reports the process ID of the process executing the command first
+            pid = receive_status(sock)
+        except (OSError, EOFError):
+            return None
+
+        def forward_signal(signum, frame):
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+        for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+            signal.signal(signum, forward_signal)
+
+        try:
+            return receive_status(sock)
+        except (OSError, EOFError) as exc:
+            sys.stderr.write(f"Error: hopic server process {pid} terminated without exit status: {exc}\n")
+            return 1
+
+
+def forward_if_served() -> None:
+    """
+    Executes this process' command line in a server, when one is configured and reachable, and exits with its status.
+
+    Returns without doing anything otherwise, to let the caller execute the command line itself.
+    """
+
+    socket_path = os.environ.get(SOCKET_ENV_VAR)
+    if not socket_path or LISTEN_FD_ENV_VAR in os.environ:
+        return
+
+    status = forward(socket_path, sys.argv[1:])
+    if status is not None:
+        sys.exit(status)
+
+
+class _EntryPoint:
+    """
+    The ``hopic`` console entry point.
+
+    Forwards command lines from the console to a server before importing anything outside of the standard library.
+    Behaves as Hopic's Click command group otherwise, which only gets imported when needed.
+    """
+
+    def __call__(self, *args, **kwargs):
+        # Only command lines from the console get forwarded, not explicit invocations, e.g. by a server itself
+        if not args and "args" not in kwargs:
+            forward_if_served()
+        from .cli import main
+        return main(*args, **kwargs)
+
+    def __getattr__(self, name):
+        from .cli import main
+        return getattr(main, name)
+
+
+main = _EntryPoint()
@@ -61,6 +61,7 @@
 else:
     from typing import _ForwardRef as ForwardRef  # type: ignore[attr-defined]
 
+from . import cache as hopic_cache
 from .compat import metadata
 from .errors import ConfigurationError
 from .types import PathLike
@@ -135,21 +136,71 @@ class CredentialEncoding(str, Enum):
 
 
 _variable_interpolation_re = re.compile(r'(?<!\$)\$(?:(\w+)|\{([^}]+)\})')
-def expand_vars(vars, expr):  # noqa: E302 'expected 2 blank lines'
-    if isinstance(expr, str):
-        # Expand variables from our "virtual" environment
-        last_idx = 0
-        new_val = expr[:last_idx]
-        for var in _variable_interpolation_re.finditer(expr):
-            name = var.group(1) or var.group(2)
+
+
+class CompiledTemplate(str):
+    """
+    A string with variable references, split into the literal text surrounding them.
+
+    There is always one more literal than there are variables. Escaped dollar signs are already resolved in the literals.
+    Being a string itself, it can take the place of the string it got compiled from in the processed configuration.
+    """
+
+    __slots__ = ('literals', 'variables')
+
+    literals: typing.Tuple[str, ...]
+    variables: typing.Tuple[str, ...]
+
+    def render(self, vars) -> str:
+        if not self.variables:
+            return self.literals[0]
+
+        parts = [self.literals[0]]
+        for name, literal in zip(self.variables, self.literals[1:]):
             value = vars[name]
             if isinstance(value, Exception):
                 raise value
-            new_val = new_val + expr[last_idx:var.start()].replace('$$', '$') + value
-            last_idx = var.end()
+            parts.append(value)
+            parts.append(literal)
+        return ''.join(parts)
+
+
+def compile_template(expr: str) -> CompiledTemplate:
+    if isinstance(expr, CompiledTemplate):
+        return expr
+
+    literals = []
+    variables = []
+    last_idx = 0
+    for var in _variable_interpolation_re.finditer(expr):
+        literals.append(expr[last_idx:var.start()].replace('$$', '$'))
+        variables.append(var.group(1) or var.group(2))
+        last_idx = var.end()
+    literals.append(expr[last_idx:].replace('$$', '$'))
+
+    template = CompiledTemplate(expr)
+    template.literals = tuple(literals)
+    template.variables = tuple(variables)
+    return template
+
+
+def compile_cmd_templates(cmd: typing.MutableMapping[str, typing.Any]) -> None:
+    """
+    Replaces the arguments and environment values of the command by compiled templates, to expand them without parsing.
+    """
 
-        new_val = new_val + expr[last_idx:].replace('$$', '$')
-        return new_val
+    if 'sh' in cmd:
+        cmd['sh'] = type(cmd['sh'])(compile_template(arg) for arg in cmd['sh'])
+    if cmd.get('environment'):
+        for name, value in cmd['environment'].items():
+            if value is not None:
+                cmd['environment'][name] = compile_template(value)
+
+
+def expand_vars(vars, expr):
+    if isinstance(expr, str):
+        # Expand variables from our "virtual" environment
+        return compile_template(expr).render(vars)
     if hasattr(expr, 'items'):
         expr = expr.copy()
         for key, val in expr.items():
@@ -161,6 +212,21 @@ def expand_vars(vars, expr):  # noqa: E302 'expected 2 blank lines'
         return expr
 
 
+def referenced_vars(expr) -> typing.Set[str]:
+    """
+    Returns the names of the variables that expand_vars() would expand in the given expression.
+    """
+
+    if isinstance(expr, str):
+        return set(compile_template(expr).variables)
+    if hasattr(expr, 'items'):
+        return set().union(*(referenced_vars(val) for val in expr.values()))
+    try:
+        return set().union(*(referenced_vars(val) for val in expr))
+    except TypeError:
+        return set()
+
+
 class TemplateNotFoundError(ConfigurationError):
     def __init__(self, name, props):
         self.name = name
@@ -250,7 +316,11 @@ def get_default_error_variant(error_msg):
 
 
 # Non failure function in order to always be able to load hopic file, use default (error) variant in case of error
-def load_embedded_command(volume_vars, loader, node):
+def load_embedded_command(volume_vars, extension_installer, loader, node):
+    # The output of arbitrary commands cannot be assumed to be stable
+    if isinstance(extension_installer, _CacheRecordingInstaller):
+        extension_installer.cacheable = False
+
     try:
         props = loader.construct_mapping(node) if node.value else {}
         if 'cmd' not in props:
@@ -491,7 +561,7 @@ def pass_volume_vars_and_extension_installer(f):
     )
     OrderedConfigLoader.add_constructor(
         '!embed',
-        pass_volume_vars(load_embedded_command)
+        pass_volume_vars_and_extension_installer(load_embedded_command)
     )
 
     OrderedConfigLoader.add_constructor(
@@ -873,6 +943,13 @@ def archive(self, value, *, name: str, keys: typing.AbstractSet[str]):
                 file=self._config_file,
             )
 
+        compression_level = value.get("compression-level", 9)
+        if not isinstance(compression_level, int) or isinstance(compression_level, bool) or not 0 <= compression_level <= 9:
+            raise ConfigurationError(
+                f"'{self._phase}.{self._variant}.{name}.compression-level' should be an integer from 0 to 9, not {compression_level!r}",
+                file=self._config_file,
+            )
+
         yield name, value
 
     def fingerprint(self, value, *, name: str, keys: typing.AbstractSet[str]):
@@ -915,6 +992,29 @@ def junit(self, value, *, name: str, keys: typing.AbstractSet[str]):
 
         yield name, value
 
+    def cache_inputs(self, value, *, name: str, keys: typing.AbstractSet[str]):
+        if isinstance(value, str):
+            value = [value]
+
+        try:
+            typeguard.check_type(argname=f"{self._phase}.{self._variant}.{name}", value=value, expected_type=typing.Sequence[str])
+        except TypeError as exc:
+            raise ConfigurationError(
+                f"'{self._phase}.{self._variant}.{name}' member is not a list of file pattern strings",
+                file=self._config_file,
+            ) from exc
+        for pattern_idx, pattern in enumerate(value):
+            try:
+                for _ in Path(os.path.devnull).glob(pattern):
+                    break
+            except ValueError as exc:
+                raise ConfigurationError(
+                    f"'{self._phase}.{self._variant}.{name}[{pattern_idx}]' value of {pattern!r} is not a valid glob pattern: {exc}",
+                    file=self._config_file,
+                ) from exc
+
+        yield name, value
+
     def with_credentials(self, value, *, name: str, keys: typing.AbstractSet[str]):
         if isinstance(value, str):
             value = OrderedDict([("id", value)])
@@ -979,6 +1079,32 @@ def image(self, value, *, name: str, keys: typing.AbstractSet[str]):
 
         yield name, value
 
+    def docker_reuse_container(self, value, *, name: str, keys: typing.AbstractSet[str]):
+        if not isinstance(value, bool):
+            raise ConfigurationError(
+                f"`{name}` member of `{self._phase}.{self._variant}` must be a boolean, not a {type(value).__name__}",
+                file=self._config_file)
+
+        yield name, value
+
+    def foreach_jobs(self, value, *, name: str, keys: typing.AbstractSet[str]):
+        if "foreach" not in keys:
+            raise ConfigurationError(f"`{name}` member of `{self._phase}.{self._variant}` requires a `foreach` member", file=self._config_file)
+        if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+            raise ConfigurationError(f"`{name}` member of `{self._phase}.{self._variant}` must be a positive integer, not {value!r}", file=self._config_file)
+
+        yield name, value
+
+    def foreach_checkout(self, value, *, name: str, keys: typing.AbstractSet[str]):
+        if "foreach" not in keys:
+            raise ConfigurationError(f"`{name}` member of `{self._phase}.{self._variant}` requires a `foreach` member", file=self._config_file)
+        if not isinstance(value, bool):
+            raise ConfigurationError(
+                f"`{name}` member of `{self._phase}.{self._variant}` must be a boolean, not a {type(value).__name__}",
+                file=self._config_file)
+
+        yield name, value
+
     def volumes_from(self, value, *, name: str, keys: typing.AbstractSet[str]):
         yield name, expand_docker_volumes_from(self._volume_vars, value)
 
@@ -1160,8 +1286,11 @@ class ModalitySourcePreparationCmd(VariantCmd):
     cmd_rejected_fields = frozenset(
         {
             "archive",
+            "cache-inputs",
             "fingerprint",
             "foreach",
+            "foreach-checkout",
+            "foreach-jobs",
             "junit",
             "node-label",
             "run-on-change",
@@ -1224,6 +1353,7 @@ class PostSubmitCmd(VariantCmd):
         "environment",
         "description",
         "docker-in-docker",
+        "docker-reuse-container",
         "image",
         "node-label",
         "run-on-change",
@@ -1237,7 +1367,100 @@ def __init__(self, *, phase: str, config_file: PathLike, volume_vars: typing.Map
         super().__init__(phase="post-submit", variant=phase, config_file=config_file, volume_vars=volume_vars)
 
 
-def read(config, volume_vars, extension_installer=lambda *args: None):
+class _CacheRecordingInstaller:
+    """
+    Wraps an extension installer to record the extensions that a configuration requires.
+
+    This allows replaying the installation when obtaining that configuration from the cache.
+    """
+
+    def __init__(self, extension_installer):
+        self.extension_installer = extension_installer
+        self.pip_configs = []
+        self.cacheable = True
+
+    def __call__(self, pip_cfg):
+        self.pip_configs.append(pip_cfg)
+        return self.extension_installer(pip_cfg)
+
+
+def _template_entry_points_fingerprint():
+    fingerprint = []
+    for name, ep in sorted(get_entry_points().items()):
+        dist = getattr(ep, "dist", None)
+        fingerprint.append((
+            name,
+            getattr(ep, "value", None),
+            getattr(dist, "name", None) if dist is not None else None,
+            getattr(dist, "version", None) if dist is not None else None,
+        ))
+    return tuple(fingerprint)
+
+
+def _config_cache_key(config, content, volume_vars, template_fingerprint):
+    try:
+        hopic_version = metadata.version(__package__.split('.')[0])
+    except metadata.PackageNotFoundError:
+        hopic_version = None
+
+    return hopic_cache.cache_key(
+        hopic_version,
+        str(config),
+        content,
+        sorted((name, repr(value)) for name, value in volume_vars.items()),
+        template_fingerprint,
+    )
+
+
+def read(config, volume_vars, extension_installer=lambda *args: None, *, cache: bool = False):
+    """
+    Reads and processes the given configuration file.
+
+    When `cache` is true the processed configuration is stored in, and when possible obtained from, Hopic's persistent
+    cache. Its key contains the configuration's content, all variables, Hopic's version and the versions of all
+    installed templates. Templates are assumed to produce the same output for the same input. Configurations using
+    ``!embed`` or referring to missing templates are never cached.
+    """
+
+    if not cache:
+        return _read(config, volume_vars, extension_installer)
+
+    if isinstance(config, io.TextIOBase):
+        content = config.read()
+        config.seek(0)
+        config_name = config.name
+    else:
+        with open(config, 'r') as f:
+            content = f.read()
+        config_name = config
+
+    template_fingerprint = _template_entry_points_fingerprint()
+    key = _config_cache_key(config_name, content, volume_vars, template_fingerprint)
+    try:
+        pip_configs, cfg = hopic_cache.load("config", key)
+    except KeyError:
+        pass
+    else:
+        log.debug("using cached configuration for %s", config_name)
+        for pip_cfg in pip_configs:
+            extension_installer(pip_cfg)
+        return cfg
+
+    recorder = _CacheRecordingInstaller(extension_installer)
+    cfg = _read(config, volume_vars, recorder)
+
+    if not recorder.cacheable:
+        log.debug("not caching configuration for %s: it depends on more than its content", config_name)
+    elif template_fingerprint != _template_entry_points_fingerprint():
+        # Templates got installed while reading, the key we computed doesn't describe them
+        log.debug("not caching configuration for %s: installed templates changed", config_name)
+    else:
+        hopic_cache.store("config", key, (recorder.pip_configs, cfg))
+
+    return cfg
+
+
+def _read(config, volume_vars, extension_installer):
     if isinstance(config, io.TextIOBase):
         f = config
         config = f.name
@@ -1258,6 +1481,9 @@ def read(config, volume_vars, extension_installer=lambda *args: None):
         try:
             cfg = yaml.load(f, ordered_config_loader(volume_vars, extension_installer))
         except TemplateNotFoundError as e:
+            # The template may become available later, e.g. after installing extensions
+            if isinstance(extension_installer, _CacheRecordingInstaller):
+                extension_installer.cacheable = False
             cfg['phases'] = OrderedDict([
                 ("yaml-error", {
                     f"{e.name}": [{
@@ -1364,6 +1590,8 @@ def read(config, volume_vars, extension_installer=lambda *args: None):
                     flatten_command_list(phasename, variant, phase[variant], config_file=config)
                 )
             )
+            for cmd in phase[variant]:
+                compile_cmd_templates(cmd)
             wait_on_full_previous_phase = None
             run_on_change = None
             for cmd_idx, cmd in enumerate(phase[variant]):
@@ -13,7 +13,10 @@
 # limitations under the License.
 
 from textwrap import dedent
-from typing import Optional
+from typing import (
+    Mapping,
+    Optional,
+)
 
 from click import ClickException
 
@@ -124,3 +127,14 @@ def __init__(self, timeout, *, cmd: Optional[str] = None, before: bool = False):
             msg += f": {cmd}"
         super().__init__(msg)
         self.timeout = timeout
+
+
+class ArtifactNormalizationError(ClickException):
+    exit_code = 41
+
+    def __init__(self, failures: Mapping[str, BaseException]):
+        super().__init__(
+            "failed to normalize artifact(s):\n"
+            + "\n".join(f"{artifact}: {exc.__class__.__name__}: {exc}" for artifact, exc in failures.items())
+        )
+        self.failures = failures
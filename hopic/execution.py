@@ -25,7 +25,7 @@ def no_exec(*args, **kwargs):
     return 0
 
 
-def echo_cmd(fun, cmd, *args, dry_run=False, obfuscate=None, **kwargs):
+def format_cmd(cmd, obfuscate=None):
     command_list = []
     for word in cmd:
         if obfuscate is not None:
@@ -33,18 +33,26 @@ def echo_cmd(fun, cmd, *args, dry_run=False, obfuscate=None, **kwargs):
                 if secret and isinstance(secret, str):
                     word = word.replace(secret, f'${{{secret_name}}}')
         command_list.append(shlex.quote(word))
+    return ' '.join(command_list)
+
+
+def echo_cmd(fun, cmd, *args, dry_run=False, obfuscate=None, **kwargs):
+    """
+    Logs and executes a command.
+
+    The environment may be any mapping, e.g. a ChainMap of layered environments. It gets copied only once, leaving out
+    variables with a value of None.
+    """
+
     log.info('%s%s', '' if dry_run else 'Executing: ',
-             click.style(' '.join(command_list), fg='yellow'))
+             click.style(format_cmd(cmd, obfuscate), fg='yellow'))
 
     # Set our locale for machine readability with UTF-8
-    kwargs = kwargs.copy()
-    try:
-        env = kwargs['env'].copy()
-    except KeyError:
-        env = os.environ.copy()
-    for key in list(env):
-        if key.startswith('LC_') or key in ('LANG', 'LANGUAGE'):
-            del env[key]
+    env = {
+        key: value
+        for key, value in kwargs.get('env', os.environ).items()
+        if value is not None and not key.startswith('LC_') and key not in ('LANG', 'LANGUAGE')
+    }
     env['LANG'] = 'C.UTF-8'
     kwargs['env'] = env
 
@@ -0,0 +1,115 @@
+# Copyright (c) 2021 - 2021 TomTom N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Creation of git bundles that only contain what the receiving side doesn't have yet.
+"""
+
+import logging
+import os
+import tempfile
+import time
+from typing import (
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+
+import git
+
+from . import trace
+from .types import PathLike
+
+log = logging.getLogger(__name__)
+
+
+def fetched_tags(repo: git.Repo, remote: str, *, exclude: Iterable[str] = ()) -> List[str]:
+    """
+    Returns the names of the tags that another checkout of the remote is expected to have fetched too.
+
+    Only tags that exist on the remote, with the same value as locally, qualify. Tags with a name in exclude, e.g.
+    because they're bundled, are skipped.
+    """
+
+    exclude = frozenset(exclude)
+    remote_tags = {}
+    for line in repo.git.ls_remote("--tags", remote).splitlines():
+        objectname, ref = line.split("\t", 1)
+        remote_tags[ref] = objectname
+
+    tags = []
+    for line in repo.git.for_each_ref("refs/tags", format="%(objectname) %(objecttype) %(*objecttype) %(refname)").splitlines():
+        objectname, objecttype, peeled_objecttype, ref = line.split(" ", 3)
+        if ref in exclude or remote_tags.get(ref) != objectname:
+            continue
+        # Tags of trees or blobs don't limit the history to transfer
+        if "commit" not in (objecttype, peeled_objecttype):
+            continue
+        tags.append(ref)
+    return tags
+
+
+def read_header(bundle: PathLike) -> Tuple[List[str], List[str]]:
+    """
+    Returns the prerequisites and references of a bundle.
+    """
+
+    prerequisites = []
+    refs = []
+    with open(bundle, "rb") as f:
+        # Skip the signature line
+        f.readline()
+        for line in f:
+            line = line.decode("UTF-8").rstrip("\n")
+            if not line:
+                break
+            if line.startswith("-"):
+                prerequisites.append(line[1:].split(" ", 1)[0])
+            elif not line.startswith("@"):
+                refs.append(line.split(" ", 1)[1])
+    return prerequisites, refs
+
+
+def create(
+    repo: git.Repo,
+    bundle: PathLike,
+    revs: Iterable[str],
+    *,
+    exclude: Iterable[object] = (),
+    compression_level: Optional[int] = None,
+) -> None:
+    """
+    Creates a bundle of the given revisions, excluding all history reachable from exclude.
+
+    The receiving side needs to have all of exclude that's an ancestor of the bundled revisions.
+    """
+
+    start = time.monotonic()
+    git_options = {}
+    if compression_level is not None:
+        git_options["c"] = f"pack.compression={compression_level}"
+    with trace.span("create-bundle", bundle=str(bundle)) as trace_args, tempfile.TemporaryFile() as excludes:
+        # Passed through stdin because excluding every tag may exceed the maximum command line length.
+        # Revisions to include stay on the command line because only those are reliably recorded as references.
+        for rev in exclude:
+            excludes.write(f"^{rev}\n".encode("UTF-8"))
+        excludes.seek(0)
+        repo.git(**git_options).bundle("create", bundle, *revs, "--stdin", istream=excludes)
+        trace_args["size"] = os.path.getsize(bundle)
+
+    prerequisites, refs = read_header(bundle)
+    log.info(
+        "created bundle %s of %d bytes with %d refs and %d prerequisites in %.3f s",
+        bundle, os.path.getsize(bundle), len(refs), len(prerequisites), time.monotonic() - start)
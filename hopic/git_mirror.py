@@ -0,0 +1,137 @@
+# Copyright (c) 2021 - 2021 TomTom N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Node-local mirror repository, shared by workspaces through git alternates, to avoid storing and fetching the same
+objects for every workspace.
+
+Workspaces refer to the mirror's objects without copying them. For that reason the mirror never deletes refs or
+objects, and it shouldn't be deleted while workspaces use it. Git's automatic garbage collection is disabled in the
+mirror for the same reason.
+
+Repacking only adds packs, it never deletes the packs that concurrent builds may be reading. A full repack, e.g. with
+``git repack -a -d --keep-unreachable``, may only be performed while no builds use the mirror.
+"""
+
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import logging
+import os
+from pathlib import Path
+import time
+from typing import (
+    Iterator,
+)
+
+import git
+
+from .types import PathLike
+
+log = logging.getLogger(__name__)
+
+# Minimum number of seconds between repacks of a mirror
+REPACK_INTERVAL = 24 * 3600
+
+_lock_file = "hopic-mirror.lock"
+_repack_stamp = "hopic-repack-stamp"
+
+# Prevents fetches from pruning objects that workspaces still use, e.g. those of force-pushed or deleted branches
+_config = {
+    "gc.auto": "0",
+    "gc.pruneExpire": "never",
+}
+
+
+@contextmanager
+def locked(mirror: PathLike) -> Iterator[Path]:
+    """
+    Holds an exclusive lock on the mirror for the duration of the context, to serialize updates from concurrent builds.
+    """
+
+    mirror = Path(mirror)
+    mirror.mkdir(parents=True, exist_ok=True)
+    with open(mirror / _lock_file, "a") as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            yield mirror
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+def _remote_namespace(remote: str) -> str:
+    return "refs/hopic/mirror/" + hashlib.sha256(remote.encode("UTF-8")).hexdigest()[:16]
+
+
+def _repack_if_due(repo: git.Repo) -> None:
+    stamp = Path(repo.git_dir) / _repack_stamp
+    try:
+        if time.time() - stamp.stat().st_mtime < REPACK_INTERVAL:
+            return
+    except FileNotFoundError:
+        pass
+
+    log.info("repacking mirror %s", repo.git_dir)
+    repo.git.pack_refs(all=True)
+    # Only packs loose objects into a new pack: existing packs may be opened by workspaces at any time
+    repo.git.repack(quiet=True)
+    # Readers that miss a loose object look for it in the packs again
+    repo.git.prune_packed(quiet=True)
+    stamp.touch()
+
+
+def _configure(repo: git.Repo) -> None:
+    for key, value in _config.items():
+        if repo.git.config("--get", key, with_exceptions=False) != value:
+            repo.git.config(key, value)
+
+
+def update(mirror: PathLike, remote: str) -> None:
+    """
+    Fetches all branches and tags of the remote into the mirror, creating the mirror when necessary.
+    """
+
+    with locked(mirror) as mirror:
+        if (mirror / "objects").is_dir():
+            repo = git.Repo(mirror)
+        else:
+            log.info("creating mirror repository in %s", mirror)
+            repo = git.Repo.init(mirror, bare=True)
+        with repo:
+            # Mirrors created by older versions lack this configuration too
+            _configure(repo)
+            namespace = _remote_namespace(remote)
+            log.debug("updating mirror %s from %s", mirror, remote)
+            # Never prune: objects of deleted refs may still be used by workspaces
+            repo.git.fetch(remote, f"+refs/heads/*:{namespace}/heads/*", f"+refs/tags/*:{namespace}/tags/*", no_tags=True)
+            _repack_if_due(repo)
+
+
+def add_alternate(repo: git.Repo, mirror: PathLike) -> None:
+    """
+    Makes the objects of the mirror available to the given repository.
+    """
+
+    objects = os.path.abspath(os.path.join(mirror, "objects"))
+    alternates = Path(repo.common_dir) / "objects" / "info" / "alternates"
+    try:
+        present = alternates.read_text().splitlines()
+    except FileNotFoundError:
+        present = []
+    if objects in present:
+        return
+
+    alternates.parent.mkdir(parents=True, exist_ok=True)
+    with alternates.open("a") as f:
+        f.write(f"{objects}\n")
@@ -16,14 +16,18 @@
         datetime,
         timedelta,
     )
+from collections import defaultdict
 from enum import Enum, unique
 import os
 import logging
 import math
 import sys
 from typing import (
+    AbstractSet,
     Any,
+    Dict,
     Iterable,
+    List,
     Mapping,
     Optional,
     Tuple,
@@ -36,6 +40,7 @@
     )
 import git
 
+from . import cache as hopic_cache
 from .types import (
     PathLike,
 )
@@ -118,14 +123,131 @@ def determine_source_date(workspace: Union[git.Repo, PathLike]) -> Optional[date
 _git_abbrev_len = math.ceil(math.log2(_max_git_objects) / 2)
 
 
-def determine_git_version(repo: git.Repo) -> GitVersion:
+# Ref through which a shallow clone tracks the fetched ref, causing fetches to also fetch the tags pointing into its history
+SHALLOW_TIP_REF = "refs/hopic/shallow-tip"
+
+# Number of commits by which to deepen a shallow repository on successive attempts, before fetching its complete history
+_deepen_steps = (100, 1000, 10000)
+
+
+def is_shallow_repository(repo: git.Repo) -> bool:
+    return os.path.isfile(os.path.join(repo.common_dir, "shallow"))
+
+
+def deepen_repository(repo: git.Repo, attempt: int) -> bool:
+    """
+    Fetches more history into a shallow repository created by checkout-source-tree with --clone-depth.
+
+    Deepens by an increasing number of commits for increasing attempts, starting at zero, eventually fetching all of it.
+
+    Returns False when there's no more history to fetch.
+    """
+
+    if not is_shallow_repository(repo):
+        return False
+
+    with repo.config_reader() as cfg:
+        remote = cfg.get_value("hopic.shallow", "remote", None)
+        refspec = cfg.get_value("hopic.shallow", "refspec", None)
+    if not remote or not refspec:
+        return False
+
+    if attempt < len(_deepen_steps):
+        log.info("deepening shallow repository by %d commits", _deepen_steps[attempt])
+        repo.git.fetch(remote, refspec, deepen=_deepen_steps[attempt], recurse_submodules="no")
+    else:
+        log.info("fetching complete history of shallow repository")
+        repo.git.fetch(remote, refspec, unshallow=True, recurse_submodules="no")
+    return True
+
+
+def ensure_merge_base(repo: git.Repo, *commits: Union[str, git.Commit]) -> List[git.Commit]:
+    """
+    Determines the merge base of the given commits, deepening a shallow repository until it contains that.
+    """
+
+    attempt = 0
+    while True:
+        merge_base = repo.merge_base(*commits)
+        if merge_base or not deepen_repository(repo, attempt):
+            return merge_base
+        attempt += 1
+
+
+def _stat_signature(path: PathLike) -> Optional[Tuple[int, int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def _tag_refs_signature(repo: git.Repo) -> Tuple[Any, ...]:
+    """
+    Describes the state of the repository's tags, and its shallow boundary, without reading them.
+
+    Git replaces refs, instead of modifying them, so every change to a loose ref modifies its directory.
+    """
+
+    common_dir = repo.common_dir
+    signature = [_stat_signature(os.path.join(common_dir, name)) for name in ("packed-refs", "shallow")]
+    for dirpath, dirnames, _ in os.walk(os.path.join(common_dir, "refs", "tags")):
+        dirnames.sort()
+        signature.append((os.path.relpath(dirpath, common_dir), _stat_signature(dirpath)))
+    return tuple(signature)
+
+
+def _describe(repo: git.Repo) -> str:
+    """
+    Describes HEAD based on the tags, without dirty state.
+
+    Because that can be expensive with many tags, the result is cached in the repository for as long as HEAD and the
+    tags stay the same.
+    """
+
+    try:
+        head = repo.head.commit.hexsha
+    except ValueError:
+        # No commit checked out (yet), let git produce its error
+        head = None
+
+    describe_args = dict(tags=True, long=True, always=True, abbrev=_git_abbrev_len)
+    if head is None:
+        return repo.git.describe(**describe_args)
+
+    cache_dir = os.path.join(repo.git_dir, 'hopic-cache')
+    cache_key = hopic_cache.cache_key('describe', describe_args)
+    signature = (head, _tag_refs_signature(repo))
+    try:
+        cached_signature, description = hopic_cache.load('git-describe', cache_key, directory=cache_dir)
+    except KeyError:
+        pass
+    else:
+        if cached_signature == signature:
+            return description
+
+    description = repo.git.describe(head, **describe_args)
+    hopic_cache.store('git-describe', cache_key, (signature, description), directory=cache_dir)
+    return description
+
+
+def determine_git_version(repo: git.Repo, *, require_tag: bool = False) -> GitVersion:
     """
     Determines the current version of a git repository based on its tags.
+
+    When require_tag is set a shallow repository gets deepened until the history contains a tag.
     """
 
-    return GitVersion.from_description(
-        repo.git.describe(tags=True, long=True, dirty=True, always=True, abbrev=_git_abbrev_len),
-    )
+    attempt = 0
+    while True:
+        description = _describe(repo)
+        # Equivalent to 'git describe --dirty', which cannot be combined with describing a specific commit
+        if repo.is_dirty(index=True, working_tree=True, untracked_files=False):
+            description += "-dirty"
+        gitversion = GitVersion.from_description(description)
+        if not require_tag or gitversion.tag_name or not deepen_repository(repo, attempt):
+            return gitversion
+        attempt += 1
 
 
 def determine_version(
@@ -151,7 +273,7 @@ def determine_version(
     if code_dir is not None:
         try:
             with git.Repo(code_dir) as repo:
-                gitversion = determine_git_version(repo)
+                gitversion = determine_git_version(repo, require_tag=bool(version_info.get('tag', False)) and version is None)
                 commit_hash = gitversion.commit_hash
 
                 if version_info.get('tag', False) and version is None:
@@ -175,6 +297,111 @@ class GitObjectType(Enum):
     gitlink = 0b1110
 
 
+def _walk_changes(
+    repo: git.Repo,
+    revisions: Iterable[str],
+    author_time: bool,
+    until_seen: Optional[AbstractSet[bytes]] = None,
+) -> Iterable[Tuple[bytes, int, int]]:
+    """
+    Yields the path, new mode and time of the most recent change to each file changed by the given revisions.
+
+    Stops as soon as every file in until_seen has been yielded, when given.
+    """
+
+    remaining = None if until_seen is None else set(until_seen)
+    seen = set()
+    whatchanged = repo.git.whatchanged(*revisions, pretty='format:%at' if author_time else 'format:%ct', as_process=True)
+    mtime = 0
+    try:
+        for line in whatchanged.stdout:
+            if remaining is not None and not remaining:
+                break
+
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith(b':'):
+                line = line[1:]
+
+                props, filenames = line.split(b'\t', 1)
+                old_mode, new_mode, old_hash, new_hash, operation = props.split(b' ')
+                new_mode = int(new_mode, 8)
+
+                new_filename = filenames.split(b'\t')[-1]
+                if new_filename in seen:
+                    continue
+                seen.add(new_filename)
+                if remaining is not None:
+                    remaining.discard(new_filename)
+                yield new_filename, new_mode, mtime
+            else:
+                mtime = int(line)
+    finally:
+        try:
+            whatchanged.terminate()
+        except OSError:
+            pass
+
+
+def _determine_tree_mtimes(repo: git.Repo, author_time: bool = False) -> Dict[bytes, Tuple[int, int]]:
+    """
+    Determines the object type and time of the last change of every file in the tree of the HEAD commit.
+
+    The result is cached in the repository, keyed by commit, such that subsequent invocations only need to walk the
+    history between the cached commit and HEAD, provided that history contains no merges.
+    """
+
+    try:
+        head = repo.head.commit.hexsha
+    except ValueError:
+        # No commit checked out (yet)
+        return {}
+
+    tree_files = frozenset(filter(None, repo.git.ls_tree('-r', '-z', '--name-only', head, stdout_as_string=False).split(b'\0')))
+    cache_dir = os.path.join(repo.git_dir, 'hopic-cache')
+    cache_key = hopic_cache.cache_key('mtime', author_time)
+
+    try:
+        cached_commit, mtimes = hopic_cache.load('git-mtime', cache_key, directory=cache_dir)
+    except KeyError:
+        cached_commit, mtimes = None, {}
+
+    if cached_commit == head:
+        return mtimes
+
+    incremental = False
+    if cached_commit is not None:
+        try:
+            # Merges can bring in changes older than those of the cached history, which a full walk would order
+            # differently. Without merges both walk the new commits first and then continue exactly like the cached walk.
+            incremental = repo.is_ancestor(cached_commit, head) and not repo.git.rev_list(
+                '--merges', '--max-count=1', f"{cached_commit}..{head}")
+        except git.GitCommandError:
+            # The cached commit doesn't exist in this repository (anymore)
+            pass
+
+    if incremental:
+        log.debug('restoring mtime from git, incrementally from %s', cached_commit)
+        for filename, new_mode, mtime in _walk_changes(repo, (f"{cached_commit}..{head}",), author_time):
+            mtimes[filename] = (new_mode >> (9 + 3)) & 0b1111, mtime
+        mtimes = {filename: info for filename, info in mtimes.items() if filename in tree_files}
+        # Can only happen with history rewrites, e.g. grafts and replacements, fall back to a full walk
+        if len(mtimes) != len(tree_files):
+            incremental = False
+
+    if not incremental:
+        log.debug('restoring mtime from git')
+        mtimes = {
+            filename: ((new_mode >> (9 + 3)) & 0b1111, mtime)
+            for filename, new_mode, mtime in _walk_changes(repo, (head,), author_time, until_seen=tree_files)
+            if filename in tree_files
+        }
+
+    hopic_cache.store('git-mtime', cache_key, (head, mtimes), directory=cache_dir)
+    return mtimes
+
+
 def determine_mtime_from_git(
     repo: git.Repo,
     files: Optional[Iterable[Union[bytes, str]]] = None,
@@ -187,57 +414,47 @@ def determine_mtime_from_git(
     else:
         files = set((fname.encode(encoding) if isinstance(fname, str) else fname) for fname in files)
 
-    log.debug('restoring mtime from git')
-
-    # Set all files' modification times to their last commit's time
-    whatchanged = repo.git.whatchanged(pretty='format:%at' if author_time else 'format:%ct', as_process=True)
-    mtime = 0
-    for line in whatchanged.stdout:
-        if not files:
-            break
-
-        line = line.strip()
-        if not line:
+    mtimes = _determine_tree_mtimes(repo, author_time)
+    for filename in sorted(files):
+        try:
+            object_type, mtime = mtimes[filename]
+        except KeyError:
             continue
-        if line.startswith(b':'):
-            line = line[1:]
-
-            props, filenames = line.split(b'\t', 1)
-            old_mode, new_mode, old_hash, new_hash, operation = props.split(b' ')
-            old_mode, new_mode = int(old_mode, 8), int(new_mode, 8)
-
-            object_type = (new_mode >> (9 + 3)) & 0b1111
-            try:
-                object_type = GitObjectType(object_type)
-            except ValueError:
-                pass
-
-            filenames = filenames.split(b'\t')
-            if len(filenames) == 1:
-                filenames.insert(0, None)
-            old_filename, new_filename = filenames
-
-            if new_filename in files:
-                files.remove(new_filename)
-                yield new_filename.decode(encoding), object_type, mtime
-        else:
-            mtime = int(line)
-    try:
-        whatchanged.terminate()
-    except OSError:
-        pass
+        try:
+            object_type = GitObjectType(object_type)
+        except ValueError:
+            pass
+        yield filename.decode(encoding), object_type, mtime
 
 
 def restore_mtime_from_git(repo: git.Repo, files: Optional[Iterable[Union[bytes, str]]] = None) -> None:
+    # Only attempt to modify symlinks' timestamps when the current system supports it.
+    # E.g. Python >= 3.3 and Linux kernel >= 2.6.22
+    symlinks_supported = os.utime in getattr(os, 'supports_follow_symlinks', set())
+
+    # Group by directory to resolve each directory only once instead of once per file
+    per_directory = defaultdict(list)
     for filename, object_type, mtime in determine_mtime_from_git(repo, files):
-        path = os.path.join(repo.working_tree_dir, filename)
         if object_type == GitObjectType.symlink:
-            # Only attempt to modify symlinks' timestamps when the current system supports it.
-            # E.g. Python >= 3.3 and Linux kernel >= 2.6.22
-            if os.utime in getattr(os, 'supports_follow_symlinks', set()):
-                os.utime(path, (mtime, mtime), follow_symlinks=False)
-        elif object_type == GitObjectType.gitlink:
+            if not symlinks_supported:
+                continue
+        elif object_type != GitObjectType.regular_file:
             # Skip gitlinks: used by submodules, they don't exist as regular files
-            pass
-        elif object_type == GitObjectType.regular_file:
-            os.utime(path, (mtime, mtime))
+            continue
+        dirname, basename = os.path.split(filename)
+        per_directory[dirname].append((basename, mtime, object_type != GitObjectType.symlink))
+
+    use_dir_fd = os.utime in getattr(os, 'supports_dir_fd', set()) and hasattr(os, 'O_DIRECTORY')
+    for dirname, entries in per_directory.items():
+        path = os.path.join(repo.working_tree_dir, dirname)
+        if not use_dir_fd:
+            for basename, mtime, follow_symlinks in entries:
+                os.utime(os.path.join(path, basename), (mtime, mtime), follow_symlinks=follow_symlinks)
+            continue
+
+        dir_fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            for basename, mtime, follow_symlinks in entries:
+                os.utime(basename, (mtime, mtime), dir_fd=dir_fd, follow_symlinks=follow_symlinks)
+        finally:
+            os.close(dir_fd)
@@ -201,6 +201,14 @@ def pip_freeze_constant(monkeypatch):
         yield m
 
 
+@pytest.fixture(autouse=True)
+def isolated_cache_dir(monkeypatch, tmp_path):
+    """Prevent sharing cached state between tests and with the user running them"""
+    with monkeypatch.context() as m:
+        m.setenv('HOPIC_CACHE_DIR', str(tmp_path / 'hopic-cache'))
+        yield tmp_path / 'hopic-cache'
+
+
 def _data_file_paths(
     datadir: Union[str, PurePath],
     *,
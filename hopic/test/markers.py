@@ -1,3 +1,4 @@
 import pytest as _pytest
 
 docker = _pytest.mark.docker
+benchmark = _pytest.mark.benchmark
@@ -199,3 +199,27 @@ def test_approval_handle_invalid_shas_gracefully(repo_with_fixup, run_hopic):
             (_POSTSQUASH_APPROVER, invalid_sha),
         ))
     assert set(commit.footers['Acked-By']) == {_PRESQUASH_APPROVER}
+
+
+def test_approvals_validated_once_per_reviewed_commit(repo_with_fixup, run_hopic, caplog):
+    presquash_commit_sha = repo_with_fixup.head.commit.hexsha
+    repo_with_fixup.git.rebase('HEAD~~', interactive=True, autosquash=True, kill_after_timeout=5, env={
+            'GIT_SEQUENCE_EDITOR': ':',
+            'GIT_COMMITTER_NAME': 'My Name is Nobody',
+            'GIT_COMMITTER_EMAIL': 'nobody@example.com',
+        })
+    squashed_commit_sha = repo_with_fixup.head.commit.hexsha
+    base_sha = repo_with_fixup.commit('HEAD~').hexsha
+
+    presquash_approvers = [f"Approver {n} <approver.{n}@example.net>" for n in range(10)]
+    commit = _perform_merge(run_hopic, repo_with_fixup, (
+            (_BASE_APPROVER, base_sha),
+            *((approver, presquash_commit_sha) for approver in presquash_approvers),
+            (_POSTSQUASH_APPROVER, squashed_commit_sha),
+        ))
+
+    assert set(commit.footers['Acked-By']) == {_POSTSQUASH_APPROVER, *presquash_approvers}
+    assert any(
+        rec.getMessage().startswith('validated 12 approvals for 3 reviewed commits in ')
+        for rec in caplog.records
+    )
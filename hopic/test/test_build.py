@@ -16,9 +16,12 @@
 from .markers import (
         docker,
     )
+from .. import action_cache
+from .. import binary_normalize
 from .. import credentials
 from .. import config_reader
 from ..errors import (
+    ArtifactNormalizationError,
     ConfigurationError,
     MissingFileError,
     UnknownPhaseError,
@@ -30,6 +33,7 @@
 from textwrap import dedent
 from typing import Pattern
 import functools
+import io
 import json
 import logging
 import os
@@ -39,6 +43,7 @@
 import stat
 import subprocess
 import sys
+import tarfile
 import time
 import typing
 
@@ -1340,6 +1345,142 @@ def test_normalize_artifacts(capfd, expected_hash, include_file, mtime, run_hopi
     assert out == f"{expected_hash} *archive-0.0.0.tar.gz\n", "archive's hash should not depend on build time"
 
 
+@pytest.mark.skipif(sys.version_info < (3, 9, 0), reason="single pass normalization requires Python >= 3.9")
+@pytest.mark.parametrize("names", (
+    ("a", "b/c", "b/d", "e"),
+    ("e", "b/d", "a", "b/c"),
+))
+@pytest.mark.parametrize("suffix", (".tar", ".tar.gz"))
+def test_normalize_single_pass(monkeypatch, tmp_path, names, suffix):
+    archive = tmp_path / f"archive{suffix}"
+    with tarfile.open(archive, "w:gz" if suffix.endswith(".gz") else "w", format=tarfile.PAX_FORMAT) as tar:
+        for idx, name in enumerate(names):
+            data = name.encode() * (idx * 300 + 1)
+            member = tarfile.TarInfo(name)
+            member.size = len(data)
+            member.mtime = 1000000000.5 + idx
+            member.uid = os.getuid()
+            member.uname = "someone"
+            tar.addfile(member, io.BytesIO(data))
+
+    class KeepContentBytesIO(io.BytesIO):
+        def close(self):
+            self.content = self.getvalue()
+            super().close()
+
+    # Force the code path that sorts in memory
+    expected = KeepContentBytesIO()
+    with open(archive, "rb") as in_file:
+        binary_normalize.normalize(archive, fileobj=in_file, outfileobj=expected, source_date_epoch=source_date_epoch)
+
+    sorted_in_single_pass = []
+    orig_single_pass = binary_normalize._normalize_sorted_tar
+
+    def normalize_sorted_tar(*args, **kwargs):
+        orig_single_pass(*args, **kwargs)
+        sorted_in_single_pass.append(True)
+    monkeypatch.setattr(binary_normalize, "_normalize_sorted_tar", normalize_sorted_tar)
+
+    binary_normalize.normalize(archive, source_date_epoch=source_date_epoch)
+    assert archive.read_bytes() == expected.content
+    assert bool(sorted_in_single_pass) == (list(names) == sorted(names))
+    assert not archive.with_suffix(archive.suffix + ".tmp").exists()
+
+    with tarfile.open(archive) as tar:
+        assert tar.getnames() == sorted(names)
+        for member in tar:
+            assert member.mtime <= source_date_epoch
+            assert member.uid == 0
+            assert member.uname == ""
+
+
+@pytest.mark.parametrize("compression_level, expected_xfl", (
+    (None, 2),
+    (1, 4),
+))
+def test_archive_compression_level(capfd, run_hopic, compression_level, expected_xfl):
+    (result,) = run_hopic(
+        ("build",),
+        config=dedent(
+            f"""\
+            phases:
+              a:
+                x:
+                  - archive:
+                      artifacts: archive.tar.gz
+                      {'' if compression_level is None else f'compression-level: {compression_level}'}
+                  - mkdir src
+                  - touch src/here.cpp
+                  - tar czf archive.tar.gz src
+              b:
+                x:
+                  - python -c "print(open('archive.tar.gz', 'rb').read(9)[8])"
+            """
+        ),
+    )
+
+    assert result.exit_code == 0
+    out, err = capfd.readouterr()
+    sys.stdout.write(out)
+    sys.stderr.write(err)
+    # gzip's "extra flags" header field records whether the fastest or the best compression got used
+    assert out.splitlines()[-1] == str(expected_xfl)
+
+
+def test_normalize_artifacts_failure(run_hopic, tmp_path):
+    (result,) = run_hopic(
+        ("build",),
+        config=dedent(
+            """\
+            phases:
+              a:
+                x:
+                  - archive:
+                      artifacts:
+                        - pattern: good-*.tar.gz
+                        - pattern: bad.tar.gz
+                    fingerprint:
+                      artifacts: good-1.tar.gz
+                  - mkdir src
+                  - touch src/here.cpp
+                  - tar czf good-1.tar.gz src
+                  - tar czf good-2.tar.gz src
+                  - sh -c "echo garbage > bad.tar.gz"
+            """
+        ),
+    )
+
+    assert isinstance(result.exception, ArtifactNormalizationError)
+    msg = result.exception.format_message()
+    assert "bad.tar.gz" in msg
+    assert "good-" not in msg
+
+    # All other artifacts should still have been normalized
+    for good in ("good-1.tar.gz", "good-2.tar.gz"):
+        with tarfile.open(tmp_path / "rundir" / good) as tar:
+            assert all(member.uname == "" for member in tar)
+    assert any("normalized 2 artifact(s)" in msg for _, msg in result.logs)
+
+
+def test_archive_invalid_compression_level(run_hopic):
+    (result,) = run_hopic(
+        ("getinfo",),
+        config=dedent(
+            """\
+            phases:
+              a:
+                x:
+                  - archive:
+                      artifacts: archive.tar.gz
+                      compression-level: 10
+            """
+        ),
+    )
+
+    assert isinstance(result.exception, ConfigurationError)
+    assert "compression-level" in result.exception.format_message()
+
+
 @pytest.mark.parametrize("archive_key", (
     "archive",
     "fingerprint",
@@ -1556,3 +1697,317 @@ def test_global_timeout_expire(monkeypatch, run_hopic):
     assert timeout_msgs, f"Didn't find any timeout related messages matching '{timeout_msg_re.pattern}'"
 
     assert "global" in timeout_msgs[-1], "timeout expiration wasn't caused by the _global_ timeout"
+
+
+def test_concurrent_variants(run_hopic):
+    # Each of these variants can only succeed when the other is running concurrently
+    wait_for = "sh -c 'touch {self}-started; for i in $(seq 100); do test -e {other}-started && exit 0; sleep 0.1; done; exit 1'"
+    (result,) = run_hopic(
+        ("build", "--jobs", "2"),
+        config=dedent(
+            f"""\
+            phases:
+              build:
+                x:
+                  - {wait_for.format(self='x', other='y')}
+                  - echo built x
+                y:
+                  - {wait_for.format(self='y', other='x')}
+                  - echo built y
+              test:
+                x:
+                  - echo tested x
+            """
+        ),
+    )
+
+    assert result.exit_code == 0
+    lines = result.stdout.splitlines()
+    assert '[build.x] built x' in lines
+    assert '[build.y] built y' in lines
+    assert lines[-1] == '[test.x] tested x'
+
+
+@pytest.mark.parametrize("keep_going", (False, True))
+def test_concurrent_variants_failure(run_hopic, keep_going):
+    (result,) = run_hopic(
+        ("build", "--jobs", "2", *(("--keep-going",) if keep_going else ())),
+        config=dedent(
+            """\
+            phases:
+              build:
+                x:
+                  - sh -c 'exit 3'
+                y:
+                  - sleep 2
+                  - echo built y
+              test:
+                x:
+                  - echo tested x
+                y:
+                  - wait-on-full-previous-phase: no
+                  - echo tested y
+            """
+        ),
+    )
+
+    assert result.exit_code == 3
+    lines = result.stdout.splitlines()
+    assert '[test.x] tested x' not in lines
+    assert ('[build.y] built y' in lines) == keep_going
+    assert ('[test.y] tested y' in lines) == keep_going
+    assert any(level == logging.ERROR and "failed variants: build.x" in msg for level, msg in result.logs)
+
+
+@pytest.mark.parametrize("entrypoint", (None, ["/entrypoint.sh"]))
+def test_docker_reuse_container(monkeypatch, run_hopic, entrypoint):
+    cid = 'f' * 64
+    calls = []
+
+    def mock_check_output(args, *popenargs, **kwargs):
+        calls.append(tuple(args))
+        if args[:3] == ['docker', 'image', 'inspect']:
+            return json.dumps(entrypoint).encode('UTF-8')
+        assert args[:3] == ['docker', 'run', '--detach']
+        assert entrypoint is None
+        return f"{cid}\n".encode('UTF-8')
+
+    def mock_check_call(args, *popenargs, **kwargs):
+        calls.append(tuple(args))
+
+    monkeypatch.setattr(subprocess, 'check_output', mock_check_output)
+    monkeypatch.setattr(subprocess, 'check_call', mock_check_call)
+
+    (result,) = run_hopic(
+        ("build",),
+        config=dedent('''\
+        image: buildpack-deps:18.04
+
+        phases:
+          build:
+            a:
+              - docker-reuse-container: yes
+              - ./build-a.sh
+              - environment:
+                  SOME_VAR: some-value
+                sh: ./test-a.sh
+        '''),
+    )
+
+    assert result.exit_code == 0
+    if entrypoint is None:
+        (inspect, run, build, test, remove) = calls
+        assert run[-3:] == ('buildpack-deps:18.04', '-f', '/dev/null')
+        assert build[:2] == test[:2] == ('docker', 'exec')
+        assert build[-2:] == (cid, './build-a.sh')
+        assert test[-2:] == (cid, './test-a.sh')
+        assert '--env=SOME_VAR=some-value' in test
+        assert remove == ('docker', 'rm', '--force', '--volumes', cid)
+    else:
+        (inspect, build, test) = calls
+        assert build[:2] == test[:2] == ('docker', 'run')
+
+
+def test_docker_reuse_container_terminated(monkeypatch, run_hopic):
+    cid = 'f' * 64
+    expected = [
+        ('docker', 'exec'),
+        ('docker', 'stop'),
+    ]
+
+    def mock_check_output(args, *popenargs, **kwargs):
+        if args[:3] == ['docker', 'image', 'inspect']:
+            return b'null\n'
+        return f"{cid}\n".encode('UTF-8')
+
+    def mock_check_call(args, *popenargs, **kwargs):
+        assert tuple(args[:2]) == expected.pop(0)
+        if args[:2] == ['docker', 'exec']:
+            os.kill(os.getpid(), signal.SIGTERM)
+        else:
+            assert tuple(args) == ('docker', 'stop', cid)
+
+    monkeypatch.setattr(subprocess, 'check_output', mock_check_output)
+    monkeypatch.setattr(subprocess, 'check_call', mock_check_call)
+
+    (result,) = run_hopic(
+        ("build",),
+        config=dedent('''\
+        image: buildpack-deps:18.04
+
+        phases:
+          build:
+            a:
+              - docker-reuse-container: yes
+              - ./build-a.sh
+              - ./test-a.sh
+        '''),
+    )
+
+    assert result.exit_code == 128 + signal.SIGTERM
+    assert not expected
+
+
+@pytest.mark.parametrize("jobs", (1, 2))
+def test_build_trace(run_hopic, tmp_path, jobs):
+    trace_file = tmp_path / "trace.jsonl"
+    (result,) = run_hopic(
+        ("--trace", trace_file, "build", "--jobs", str(jobs)),
+        config=dedent(
+            """\
+            phases:
+              build:
+                x:
+                  - echo built x
+                y:
+                  - sh -c 'exit 3'
+            """
+        ),
+    )
+    assert result.exit_code == 3
+
+    events = [json.loads(line) for line in trace_file.read_text().splitlines()]
+    assert all(event["ph"] == "X" and event["dur"] >= 0 for event in events)
+    assert "read-config" in {event["name"] for event in events}
+
+    commands = {event["name"]: event["args"] for event in events if event["cat"] == "command"}
+    assert commands['echo built x']["exit_status"] == 0
+    assert commands['echo built x']["variant"] == "x"
+    assert commands['echo built x']["phase"] == "build"
+    assert commands["sh -c 'exit 3'"]["exit_status"] == 3
+    assert "user_cpu" in commands["sh -c 'exit 3'"]
+
+    variants = {event["name"]: event["args"] for event in events if event["cat"] == "variant"}
+    assert "error" not in variants["build.x"]
+    assert variants["build.y"]["error"]
+
+
+def test_build_action_cache(run_hopic, tmp_path):
+    cache_dir = tmp_path / "action-cache"
+    runs = tmp_path / "runs"
+    output = tmp_path / "rundir" / "out.txt"
+    build = ("build", "--action-cache", cache_dir)
+
+    def remove_output():
+        output.unlink()
+
+    def change_input():
+        (tmp_path / "rundir" / "input.txt").write_text("changed")
+
+    results = list(run_hopic(
+        build,
+        remove_output,
+        build,
+        remove_output,
+        change_input,
+        build,
+        config=dedent(
+            f"""\
+            phases:
+              build:
+                x:
+                  - cache-inputs: input.txt
+                    archive:
+                      artifacts: out.txt
+                  - sh -c 'echo run >> {runs} && cp input.txt out.txt'
+            """
+        ),
+        files={"input.txt": "original"},
+    ))
+    assert all(result.exit_code == 0 for result in results)
+
+    assert runs.read_text().splitlines() == ["run", "run"]
+    assert output.read_text() == "changed"
+    assert (logging.INFO, "action cache: 0 hit(s), 1 miss(es)") in results[0].logs
+    assert (logging.INFO, "action cache: 1 hit(s), 0 miss(es)") in results[1].logs
+    assert (logging.INFO, "action cache: 0 hit(s), 1 miss(es)") in results[2].logs
+
+
+def test_build_action_cache_across_commits(run_hopic, tmp_path):
+    cache_dir = tmp_path / "action-cache"
+    runs = tmp_path / "runs"
+    build = ("build", "--action-cache", cache_dir)
+
+    def commit():
+        subprocess.check_call(
+            ("git", "-c", "user.name=Bob", "-c", "user.email=bob@example.com", "commit", "--allow-empty", "-m", "Next commit"),
+            cwd=tmp_path / "rundir",
+            env={**os.environ, "GIT_COMMITTER_DATE": "2021-01-01T12:00:00Z"},
+        )
+
+    results = list(run_hopic(
+        build,
+        commit,
+        build,
+        config=dedent(
+            f"""\
+            phases:
+              build:
+                x:
+                  - cache-inputs: input.txt
+                    archive:
+                      artifacts: x.txt
+                  - sh -c 'echo x >> {runs} && cp input.txt x.txt'
+                y:
+                  - cache-inputs: input.txt
+                    archive:
+                      artifacts: y.txt
+                  - sh -c 'echo y >> {runs} && echo ${{SOURCE_DATE_EPOCH}} > y.txt'
+            """
+        ),
+        files={"input.txt": "original"},
+    ))
+    assert all(result.exit_code == 0 for result in results)
+
+    # Only the variant referring to SOURCE_DATE_EPOCH gets executed again for the new commit
+    assert runs.read_text().splitlines() == ["x", "y", "y"]
+    assert (logging.INFO, "action cache: 1 hit(s), 1 miss(es)") in results[1].logs
+
+
+def test_build_action_cache_shared_between_workspaces(run_hopic, tmp_path):
+    cache_dir = tmp_path / "action-cache"
+    runs = tmp_path / "runs"
+    config = dedent(
+        f"""\
+        phases:
+          build:
+            x:
+              - cache-inputs: input.txt
+                archive:
+                  artifacts: out.txt
+              - sh -c 'echo run >> {runs} && cp ${{WORKSPACE}}/input.txt out.txt'
+        """
+    )
+
+    for rundir in (tmp_path / "node-a", tmp_path / "node-b"):
+        (result,) = run_hopic(
+            ("build", "--action-cache", cache_dir),
+            config=config,
+            files={"input.txt": "original"},
+            rundir=rundir,
+        )
+        assert result.exit_code == 0
+        assert (rundir / "out.txt").read_text() == "original"
+
+    assert runs.read_text().splitlines() == ["run"]
+
+
+@pytest.mark.parametrize("file", (
+    "../escaped.txt",
+    "sub/../../escaped.txt",
+    "/tmp/escaped.txt",
+))
+def test_action_cache_rejects_escaping_paths(tmp_path, file):
+    base = tmp_path / "base"
+    base.mkdir()
+    (base / "out.txt").write_text("output")
+    key = "0123456789abcdef"
+    assert action_cache.store(tmp_path / "cache", key, {"code": (base, ["out.txt"])}) == 1
+
+    entry = tmp_path / "cache" / "action-cache-files" / key[:2] / key[2:]
+    (entry / "manifest.json").write_text(json.dumps({"code": [file]}))
+    destination = tmp_path / "destination" / "code"
+    destination.mkdir(parents=True)
+
+    assert action_cache.restore(tmp_path / "cache", key, {"code": destination}) is None
+    assert not (tmp_path / "destination" / "escaped.txt").exists()
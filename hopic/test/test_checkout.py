@@ -14,11 +14,15 @@
 
 import os
 import sys
+from pathlib import Path
 from textwrap import dedent
 
 import git
 import pytest
 
+from .. import git_mirror
+from ..cli import commands
+
 
 _git_time = f"{7 * 24 * 3600} +0000"
 _author = git.Actor('Bob Tester', 'bob@example.net')
@@ -67,11 +71,28 @@ def test_clean_submodule_checkout(capfd, run_hopic, tmp_path):
     build_out = ''.join(out.splitlines(keepends=True)[1:])
     assert build_out == dummy_content
 
-    # Make submodule checkout fail
+    # Checking out the same submodule commit again shouldn't need the submodule's repository
+    module_marker = run_hopic.toprepo.parent / 'rundir' / '.git' / 'modules' / 'subrepo' / 'hopic-test-marker'
+    module_marker.touch()
+    subrepo.rename(subrepo.parent / 'old-subrepo')
+    (result,) = run_hopic(('checkout-source-tree', '--clean', '--target-remote', run_hopic.toprepo, '--target-ref', 'master'))
+    assert result.exit_code == 0
+    assert module_marker.exists()
+    (subrepo.parent / 'old-subrepo').rename(subrepo)
+
+    # Make submodule checkout fail, by requiring a commit that needs to be fetched
+    with git.Repo(subrepo) as repo:
+        (subrepo / 'dummy.txt').write_text('Mooh!\n')
+        repo.index.add(('dummy.txt',))
+        repo.index.commit(message='Subsequent dummy commit', **commitargs)
+    with git.Repo(run_hopic.toprepo) as repo:
+        repo.git.submodule(('update', '--remote', 'subrepo'))
+        repo.git.add('subrepo')
+        repo.index.commit(message='Update submodule', **commitargs)
     subrepo.rename(subrepo.parent / 'old-subrepo')
 
     # Expected failure
-    with pytest.raises(git.GitCommandError, match=r'(?is)submodule.*repository.*\bdoes not exist\b'):
+    with pytest.raises(git.GitCommandError, match=r'(?i)unable to fetch in submodule path'):
         (_,) = run_hopic(('checkout-source-tree', '--clean', '--target-remote', run_hopic.toprepo, '--target-ref', 'master'))
 
     # Ignore submodule failure only
@@ -81,6 +102,49 @@ def test_clean_submodule_checkout(capfd, run_hopic, tmp_path):
     assert result.exit_code == 0
 
 
+def test_nested_submodule_url_change(monkeypatch, run_hopic, tmp_path):
+    # Git >= 2.38.1 refuses to clone submodules from local paths by default
+    monkeypatch.setenv("GIT_CONFIG_COUNT", "1")
+    monkeypatch.setenv("GIT_CONFIG_KEY_0", "protocol.file.allow")
+    monkeypatch.setenv("GIT_CONFIG_VALUE_0", "always")
+
+    for name in ("nested-old", "nested-new"):
+        with git.Repo.init(tmp_path / name, expand_vars=False) as repo:
+            (tmp_path / name / "dummy.txt").write_text(f"{name}\n")
+            repo.index.add(("dummy.txt",))
+            repo.index.commit(message=f"Initial {name} commit", **_commitargs)
+
+    subrepo = tmp_path / "subrepo"
+    with git.Repo.init(subrepo, expand_vars=False) as repo:
+        repo.git.submodule(("add", "../nested-old", "nested"))
+        repo.index.commit(message="Initial commit", **_commitargs)
+
+    with git.Repo.init(run_hopic.toprepo, expand_vars=False) as repo:
+        repo.git.submodule(("add", "../subrepo", "subrepo"))
+        repo.index.commit(message="Initial commit", **_commitargs)
+
+    (result,) = run_hopic(("checkout-source-tree", "--target-remote", run_hopic.toprepo, "--target-ref", "master"))
+    assert result.exit_code == 0
+    nested = run_hopic.toprepo.parent / "rundir" / "subrepo" / "nested"
+    assert (nested / "dummy.txt").read_text() == "nested-old\n"
+
+    # Change the URL of the nested submodule, while keeping the submodule itself
+    with git.Repo(subrepo) as repo:
+        repo.git.submodule(("set-url", "nested", "../nested-new"))
+        repo.git.submodule(("sync",))
+        repo.git.submodule(("update", "--remote", "nested"))
+        repo.git.add(".gitmodules", "nested")
+        repo.index.commit(message="Switch nested submodule", **_commitargs)
+    with git.Repo(run_hopic.toprepo) as repo:
+        repo.git.submodule(("update", "--remote", "subrepo"))
+        repo.git.add("subrepo")
+        repo.index.commit(message="Update submodule", **_commitargs)
+
+    (result,) = run_hopic(("checkout-source-tree", "--target-remote", run_hopic.toprepo, "--target-ref", "master"))
+    assert result.exit_code == 0
+    assert (nested / "dummy.txt").read_text() == "nested-new\n"
+
+
 def test_clean_checkout_in_non_empty_dir(run_hopic, tmp_path):
     with git.Repo.init(run_hopic.toprepo, expand_vars=False) as repo:
         repo.index.commit(message='Initial commit', **_commitargs)
@@ -307,3 +371,128 @@ def test_reject_checkout_out_of_branch_commit(run_hopic):
         ("checkout-source-tree", "--target-remote", run_hopic.toprepo, "--target-ref", "master", "--target-commit", final_commit),
     )
     assert result.exit_code == 37
+
+
+def test_checkout_with_reference_mirror(run_hopic, tmp_path):
+    mirror = tmp_path / "mirror"
+    with git.Repo.init(run_hopic.toprepo, expand_vars=False) as repo:
+        (run_hopic.toprepo / "dummy.txt").write_text("Lalalala!\n")
+        repo.index.add(("dummy.txt",))
+        commit = repo.index.commit(message="Initial dummy commit", **_commitargs)
+        repo.create_tag("1.0.0")
+
+    for workspace in (tmp_path / "first", tmp_path / "second"):
+        # Use a URL because local clones hard link objects instead of using the mirror's
+        (result,) = run_hopic(
+            ("checkout-source-tree", "--target-remote", run_hopic.toprepo.as_uri(), "--target-ref", "master", "--reference-mirror", mirror),
+            rundir=workspace,
+        )
+        assert result.exit_code == 0
+
+        with git.Repo(workspace) as repo:
+            assert repo.head.commit == commit
+            assert (Path(repo.git_dir) / "objects" / "info" / "alternates").read_text() == f"{mirror / 'objects'}\n"
+            # All objects are shared through the mirror
+            objects = dict(line.split(": ", 1) for line in repo.git.count_objects(verbose=True).splitlines())
+            assert objects["count"] == "0"
+            assert objects["in-pack"] == "0"
+
+    with git.Repo(mirror) as repo:
+        assert repo.bare
+        assert {ref.commit for ref in repo.refs} == {commit}
+        assert any(ref.path.endswith("/tags/1.0.0") for ref in repo.refs)
+        assert repo.git.config("--get", "gc.auto") == "0"
+        assert repo.git.config("--get", "gc.pruneExpire") == "never"
+
+
+def test_mirror_repack_keeps_packs(tmp_path):
+    mirror = tmp_path / "mirror"
+    with git.Repo.init(tmp_path / "upstream", expand_vars=False) as repo:
+        repo.index.commit(message="Initial commit", **_commitargs)
+    git_mirror.update(mirror, str(tmp_path / "upstream"))
+
+    with git.Repo(mirror) as repo:
+        repo.git.repack(a=True, d=True, quiet=True)
+        packs = set((mirror / "objects" / "pack").iterdir())
+        assert packs
+
+    with git.Repo(tmp_path / "upstream") as repo:
+        repo.index.commit(message="Second commit", **_commitargs)
+    (mirror / git_mirror._repack_stamp).unlink()
+    git_mirror.update(mirror, str(tmp_path / "upstream"))
+
+    # Workspaces may have the existing packs open while repacking
+    assert packs < set((mirror / "objects" / "pack").iterdir())
+    with git.Repo(mirror) as repo:
+        objects = dict(line.split(": ", 1) for line in repo.git.count_objects(verbose=True).splitlines())
+        assert objects["count"] == "0"
+
+
+def test_fetch_multiple_refspecs(tmp_path):
+    with git.Repo.init(tmp_path / "upstream", expand_vars=False) as repo:
+        first_commit = repo.index.commit(message="Initial commit", **_commitargs)
+        repo.create_head("other", first_commit)
+        second_commit = repo.index.commit(message="Second commit", **_commitargs)
+        repo.git.notes("add", "-m", "note", first_commit, ref="hopic/master", env={
+            "GIT_AUTHOR_NAME": _author.name,
+            "GIT_AUTHOR_EMAIL": _author.email,
+            "GIT_COMMITTER_NAME": _author.name,
+            "GIT_COMMITTER_EMAIL": _author.email,
+        })
+
+    with git.Repo.init(tmp_path / "downstream", expand_vars=False) as repo:
+        remote = repo.create_remote("origin", str(tmp_path / "upstream"))
+        # The wildcard goes first, to ensure that its ref doesn't get mistaken for the result of another refspec
+        assert commands.fetch(remote, "+refs/notes/hopic/*:refs/notes/hopic/*", "master", "other") == [second_commit, first_commit]
+        assert "refs/notes/hopic/master" in (ref.path for ref in repo.refs)
+
+        # Git only fetches repeated refspecs once
+        assert commands.fetch(remote, "master:refs/x", "other", "master:refs/x") == [second_commit, first_commit, second_commit]
+
+
+def test_checkout_reuses_worktrees(run_hopic, tmp_path):
+    with git.Repo.init(run_hopic.toprepo, expand_vars=False) as repo:
+        for branch in ("doc-a", "doc-b"):
+            (run_hopic.toprepo / "index.html").write_text(f"{branch}\n")
+            repo.index.add(("index.html",))
+            repo.index.commit(message=f"Initial {branch} commit", **_commitargs)
+            repo.git.branch(branch)
+            repo.git.update_ref(d="HEAD")
+            repo.git.rm("index.html", cached=True)
+            (run_hopic.toprepo / "index.html").unlink()
+
+        (run_hopic.toprepo / "hopic-ci-config.yaml").write_text(dedent(
+            """\
+            scm:
+              git:
+                worktrees:
+                  doc/a: doc-a
+                  doc/b: doc-b
+            """
+        ))
+        repo.index.add(("hopic-ci-config.yaml",))
+        repo.index.commit(message="Initial commit", **_commitargs)
+        repo.git.branch("master", move=True)
+
+    workspace = tmp_path / "rundir"
+    checkout = ("checkout-source-tree", "--target-remote", run_hopic.toprepo, "--target-ref", "master")
+    (result,) = run_hopic(checkout)
+    assert result.exit_code == 0
+    assert (workspace / "doc" / "a" / "index.html").read_text() == "doc-a\n"
+    assert (workspace / "doc" / "b" / "index.html").read_text() == "doc-b\n"
+
+    (workspace / "doc" / "a" / "index.html").write_text("modified\n")
+    (workspace / "doc" / "a" / "untracked.html").write_text("untracked\n")
+    unmodified_stat = (workspace / "doc" / "b" / "index.html").stat()
+
+    (result,) = run_hopic(checkout)
+    assert result.exit_code == 0
+    assert (workspace / "doc" / "a" / "index.html").read_text() == "doc-a\n"
+    assert not (workspace / "doc" / "a" / "untracked.html").exists()
+    # Existing worktrees get reset in place instead of recreated
+    stat = (workspace / "doc" / "b" / "index.html").stat()
+    assert (stat.st_ino, stat.st_mtime_ns) == (unmodified_stat.st_ino, unmodified_stat.st_mtime_ns)
+
+    with git.Repo(workspace) as repo:
+        worktrees = [line for line in repo.git.worktree("list", "--porcelain").splitlines() if line.startswith("worktree ")]
+        assert len(worktrees) == 3
@@ -13,13 +13,16 @@
 # limitations under the License.
 
 import json
+import os
 import re
 from textwrap import dedent
+import timeit
 import typing
 
 import pytest
 
 from . import config_file
+from .markers import benchmark
 from .. import config_reader
 from ..errors import ConfigurationError
 
@@ -1754,3 +1757,178 @@ def test_post_submit():
 
     (out,) = cfg["post-submit"]["some-phase"]
     assert out["sh"] == ["echo", "hello Bob"]
+
+
+@pytest.fixture
+def counting_template(monkeypatch):
+    calls = []
+
+    class TestCountingTemplate:
+        name = 'counting'
+        value = 'hopic.test:counting_template'
+
+        def load(self):
+            return self.counting_template
+
+        @staticmethod
+        def counting_template(
+            volume_vars : typing.Mapping[str, str],
+        ) -> typing.Sequence[str]:
+            calls.append(volume_vars)
+            return ('echo counted',)
+
+    monkeypatch.setattr(config_reader, 'get_entry_points', lambda: {'counting': TestCountingTemplate()})
+    return calls
+
+
+_cached_config = dedent(
+    """\
+    pip:
+      - some-extension
+    phases:
+      build:
+        example: !template counting
+    """
+)
+
+
+def test_config_cache_reuses_processed_config(counting_template):
+    installed = []
+    cfgs = [
+        config_reader.read(config_file("test-hopic-config.yaml", _cached_config), {'WORKSPACE': None}, installed.append, cache=True)
+        for _ in range(2)
+    ]
+
+    assert len(counting_template) == 1
+    assert cfgs[0] == cfgs[1]
+    (cmd,) = cfgs[1]['phases']['build']['example']
+    assert cmd['sh'] == ['echo', 'counted']
+
+    # Extensions must still be installed when the config comes from the cache
+    assert len(installed) == 2
+    assert installed[0] == installed[1]
+    assert installed[1][0]['packages'] == ('some-extension',)
+
+
+def test_config_cache_disabled(counting_template):
+    for _ in range(2):
+        config_reader.read(config_file("test-hopic-config.yaml", _cached_config), {'WORKSPACE': None})
+
+    assert len(counting_template) == 2
+
+
+def test_config_cache_key(counting_template):
+    config_reader.read(config_file("test-hopic-config.yaml", _cached_config), {'WORKSPACE': None}, cache=True)
+    config_reader.read(config_file("test-hopic-config.yaml", _cached_config), {'WORKSPACE': '/'}, cache=True)
+    config_reader.read(config_file("test-hopic-config.yaml", _cached_config + "    other: !template counting\n"), {'WORKSPACE': None}, cache=True)
+    assert len(counting_template) == 4
+
+    config_reader.read(config_file("test-hopic-config.yaml", _cached_config), {'WORKSPACE': '/'}, cache=True)
+    assert len(counting_template) == 4
+
+
+def test_config_cache_skips_embed(isolated_cache_dir, tmp_path):
+    for _ in range(2):
+        cfg = config_reader.read(
+            config_file(
+                "test-hopic-config.yaml",
+                dedent(
+                    """\
+                    phases:
+                      build:
+                        example: !embed
+                          cmd: echo '[echo embedded]'
+                    """
+                )
+            ),
+            {'WORKSPACE': str(tmp_path)},
+            cache=True,
+        )
+        (cmd,) = cfg['phases']['build']['example']
+        assert cmd['sh'] == ['echo', 'embedded']
+
+    assert not isolated_cache_dir.exists() or not any(path.is_file() for path in isolated_cache_dir.glob('**/*'))
+
+
+@pytest.mark.parametrize("expr, expected", (
+    ("plain", "plain"),
+    ("$A-${B}", "a-b"),
+    ("$$A ${A}$$", "$A a$"),
+    ("$$$A", "$$A"),
+    ("${A}${B}", "ab"),
+))
+def test_compiled_template(expr, expected):
+    assert config_reader.expand_vars({"A": "a", "B": "b"}, expr) == expected
+    template = config_reader.compile_template(expr)
+    assert template == expr
+    assert config_reader.compile_template(template) is template
+    assert config_reader.expand_vars({"A": "a", "B": "b"}, template) == expected
+
+
+def test_read_compiles_templates(isolated_cache_dir, tmp_path):
+    # Compiled templates are kept by the configuration cache too
+    for _ in range(2):
+        cfg = config_reader.read(
+            config_file(
+                "test-hopic-config.yaml",
+                dedent(
+                    """\
+                    phases:
+                      build:
+                        a:
+                          - environment:
+                              NAME: ${VAR}-env
+                            sh: echo ${VAR} $$HOME
+                    """
+                )
+            ),
+            {'WORKSPACE': str(tmp_path), 'VAR': 'value'},
+            cache=True,
+        )
+        (cmd,) = cfg['phases']['build']['a']
+        assert cmd['sh'] == ['echo', '${VAR}', '$$HOME']
+        assert all(isinstance(arg, config_reader.CompiledTemplate) for arg in cmd['sh'])
+        assert isinstance(cmd['environment']['NAME'], config_reader.CompiledTemplate)
+        assert config_reader.expand_vars({'VAR': 'value'}, cmd['sh']) == ['echo', 'value', '$HOME']
+
+
+def _expand_uncompiled(vars, expr):
+    if isinstance(expr, str):
+        last_idx = 0
+        new_val = ""
+        for var in config_reader._variable_interpolation_re.finditer(expr):
+            new_val = new_val + expr[last_idx:var.start()].replace("$$", "$") + vars[var.group(1) or var.group(2)]
+            last_idx = var.end()
+        return new_val + expr[last_idx:].replace("$$", "$")
+    return [_expand_uncompiled(vars, val) for val in expr]
+
+
+def _benchmark_commands():
+    volume_vars = {f"VAR{i}": f"value-{i}" * 4 for i in range(50)}
+    # Every string is distinct, to not only measure cache hits
+    cmds = [[f"--option{i}-{j}=${{VAR{(i + j) % 50}}}/path/$VAR{j} $$HOME" for j in range(10)] for i in range(2000)]
+    return volume_vars, cmds
+
+
+def test_expand_vars_compiled_equals_uncompiled():
+    volume_vars, cmds = _benchmark_commands()
+    assert config_reader.expand_vars(volume_vars, cmds) == _expand_uncompiled(volume_vars, cmds)
+
+
+# Minimum speedup of expanding precompiled templates compared to parsing strings on every expansion.
+# Benchmarks are excluded from the default test run, use `pytest -m benchmark` to execute them.
+EXPAND_VARS_MIN_SPEEDUP = float(os.environ.get("HOPIC_EXPAND_VARS_MIN_SPEEDUP", 1.5))
+
+
+@benchmark
+def test_expand_vars_benchmark():
+    volume_vars, cmds = _benchmark_commands()
+    assert len({cmd for cmdline in cmds for cmd in cmdline}) == 20000
+    # Compile all of them once, like reading the configuration does
+    templates = [[config_reader.compile_template(arg) for arg in cmdline] for cmdline in cmds]
+
+    uncompiled, compiled = (
+        min(timeit.repeat(lambda: expand(volume_vars, exprs), number=3, repeat=5))
+        for expand, exprs in ((_expand_uncompiled, cmds), (config_reader.expand_vars, templates))
+    )
+    assert uncompiled / compiled >= EXPAND_VARS_MIN_SPEEDUP
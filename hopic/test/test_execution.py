@@ -14,7 +14,8 @@
 
 from . import sgr_re
 from .. import execution
-import hopic
+import hopic.cli.commands
+from collections import ChainMap
 import click
 import copy
 import subprocess
@@ -63,7 +64,18 @@ def mock_executor(arg, *args, **kwargs):
         assert arg == 'command'
         return args[0]
 
-    ctx = click.Context(hopic.cli.getinfo)
+    ctx = click.Context(hopic.cli.commands.getinfo)
     with ctx:
         assert execution.echo_cmd_click(mock_executor, 'command', '42') == '42'
         assert execution.echo_cmd_click(mock_executor, 'command', b'42') == '42'
+
+
+def test_echo_cmd_layered_env():
+    base = {'KEEP': 'base', 'OVERRIDE': 'base', 'REMOVE': 'base', 'LC_ALL': 'nl_NL.UTF-8', 'LANG': 'nl_NL.UTF-8'}
+
+    def mock_executor(arg, *args, env, **kwargs):
+        return env
+
+    env = execution.echo_cmd(mock_executor, ['true'], env=ChainMap({'OVERRIDE': 'layer', 'REMOVE': None}, base))
+    assert env == {'KEEP': 'base', 'OVERRIDE': 'layer', 'LANG': 'C.UTF-8'}
+    assert base['REMOVE'] == 'base'
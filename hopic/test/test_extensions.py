@@ -721,10 +721,12 @@ def test_extension_constraints_functionality(monkeypatch, run_hopic, tmp_path):
 
     options = ("--constraints", constraints_file.resolve())
 
+    pip_calls = []
+
     def mock_check_call(args, *popenargs, **kwargs):
         if args[2:4] == ["pip", "install"]:
             assert re.search(r"-c /[^ ]*/constraints.txt\b", " ".join(args)) is not None
-            assert all(pkg in args for pkg in packages)
+            pip_calls.append(args)
 
     monkeypatch.setattr(subprocess, "check_call", mock_check_call)
 
@@ -756,6 +758,12 @@ def mock_write_text(f, text, *args, **kwargs):
 
     assert result.exit_code == 0
 
+    # The installed version of commisery doesn't satisfy our constraint, so it has to be installed too
+    first_call, *_ = pip_calls
+    assert all(pkg in first_call for pkg in packages)
+    # Packages that aren't installed at all will always be passed to pip
+    assert all(pkg in args for pkg in packages[1:] for args in pip_calls)
+
 
 @pytest.mark.parametrize(
     "installed_pip_version, expected_result",
@@ -797,3 +805,60 @@ def mock_check(package):
         assert any(level == logging.WARNING and "is not installed" in line for level, line in result.logs)
 
     assert result.exit_code == 0
+
+
+def test_skip_pip_for_satisfied_requirements(monkeypatch, run_hopic):
+    pip_calls = []
+
+    def mock_check_call(args, *popenargs, **kwargs):
+        if args[2:4] == ["pip", "install"]:
+            pip_calls.append(args)
+
+    monkeypatch.setattr(subprocess, "check_call", mock_check_call)
+
+    (result,) = run_hopic(
+        ("install-extensions",),
+        config=dedent(
+            """\
+            pip:
+              - packages:
+                  - click>=7
+                  - GitPython
+              - packages:
+                  - click>=7
+                  - some-extension-that-is-not-installed>=1.0
+            """
+        ),
+    )
+    assert result.exit_code == 0
+
+    (args,) = pip_calls
+    assert "some-extension-that-is-not-installed>=1.0" in args
+    assert "click>=7" not in args
+
+
+@pytest.mark.parametrize("upgrade", (False, True))
+def test_install_stamp(monkeypatch, run_hopic, upgrade):
+    pip_calls = []
+
+    def mock_check_call(args, *popenargs, **kwargs):
+        if args[2:4] == ["pip", "install"]:
+            pip_calls.append(args)
+
+    monkeypatch.setattr(subprocess, "check_call", mock_check_call)
+
+    options = ("--upgrade",) if upgrade else ()
+    (*_, result) = run_hopic(
+        ("install-extensions", *options),
+        ("install-extensions", *options),
+        config=dedent(
+            """\
+            pip:
+              - some-extension-that-is-not-installed
+            """
+        ),
+    )
+    assert result.exit_code == 0
+
+    # The recorded successful installation is trusted, unless an upgrade is requested
+    assert len(pip_calls) == (2 if upgrade else 1)
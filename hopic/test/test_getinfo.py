@@ -380,3 +380,74 @@ def test_post_submit_summed_timeout(run_hopic):
     output = json.loads(result.stdout, object_pairs_hook=OrderedDict)
 
     assert output["timeout"] == 42 + 37
+
+
+def test_all(run_hopic):
+    config = dedent(
+        """\
+        ci-locks:
+          - branch: main
+            repo-name: other/repo
+        artifactory:
+          promotion:
+            artifactory01:
+              target-repo: releases
+        phases:
+          x:
+            a:
+              - node-label: linux
+              - archive:
+                  artifacts: out/*
+                timeout: 60
+              - sh: echo mooh
+            b: []
+        post-submit:
+          publish:
+            - node-label: publisher
+            - echo publish
+        modality-source-preparation:
+          UPDATE:
+            - with-credentials: some-credential
+              sh: echo update
+        """
+    )
+
+    separate = {}
+    for name, args in (
+        ("phases", ("getinfo",)),
+        ("post-submit", ("getinfo", "--post-submit")),
+        ("show-config", ("show-config",)),
+    ):
+        (result,) = run_hopic(args, config=config)
+        assert result.exit_code == 0
+        separate[name] = json.loads(result.stdout, object_pairs_hook=OrderedDict)
+
+    (result,) = run_hopic(("getinfo", "--all"), config=config)
+    assert result.exit_code == 0
+    output = json.loads(result.stdout, object_pairs_hook=OrderedDict)
+
+    assert output["phases"].keys() == separate["phases"].keys()
+    assert output["phases"]["x"]["a"] == OrderedDict((("node-label", "linux"),))
+    assert "archive" in separate["phases"]["x"]["a"]
+    assert separate["phases"]["x"]["a"]["timeout"] == 60
+    assert output["phases"]["x"]["b"]["nop"] is True
+    assert output["post-submit"] == separate["post-submit"]
+    assert output["post-submit"]["node-label"] == "publisher"
+    assert "modality-source-preparation" not in output
+    assert output["ci-locks"] == separate["show-config"]["ci-locks"]
+    assert output["artifactory"] == separate["show-config"]["artifactory"]
+
+
+def test_all_is_exclusive(run_hopic):
+    (result,) = run_hopic(
+        ("getinfo", "--all", "--post-submit"),
+        config=dedent(
+            """\
+            phases:
+              x:
+                a: []
+            """
+        ),
+    )
+
+    assert result.exit_code != 0
@@ -0,0 +1,184 @@
+# Copyright (c) 2021 - 2021 TomTom N.V. (https://tomtom.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from pathlib import Path
+
+import git
+import pytest
+
+from .. import git_time
+
+
+def _commit(repo, message, when):
+    return repo.index.commit(
+        message=message,
+        author=git.Actor("Hopic Test", "hopic@example.com"),
+        committer=git.Actor("Hopic Test", "hopic@example.com"),
+        author_date=f"{when} +0000",
+        commit_date=f"{when} +0000",
+    )
+
+
+@pytest.fixture
+def repo(tmp_path):
+    with git.Repo.init(tmp_path / "repo") as repo:
+        for name in ("old.txt", "sub/dir/changed.txt", "removed.txt"):
+            path = tmp_path / "repo" / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(name)
+        os.symlink("old.txt", tmp_path / "repo" / "link")
+        repo.index.add(("old.txt", "sub/dir/changed.txt", "removed.txt", "link"))
+        _commit(repo, "Initial commit", 1000)
+        yield repo
+
+
+@pytest.fixture
+def walked_revisions(monkeypatch):
+    revisions = []
+    orig_walk_changes = git_time._walk_changes
+
+    def walk_changes(repo, revs, *args, **kwargs):
+        revisions.append(tuple(revs))
+        return orig_walk_changes(repo, revs, *args, **kwargs)
+    monkeypatch.setattr(git_time, "_walk_changes", walk_changes)
+    return revisions
+
+
+def _mtimes(repo):
+    return {
+        name: os.lstat(os.path.join(repo.working_tree_dir, name)).st_mtime
+        for name in ("old.txt", "sub/dir/changed.txt", "link")
+    }
+
+
+def test_restore_mtime_incrementally(repo, walked_revisions):
+    git_time.restore_mtime_from_git(repo)
+    assert _mtimes(repo) == {"old.txt": 1000, "sub/dir/changed.txt": 1000, "link": 1000}
+    assert len(walked_revisions) == 1
+
+    first = repo.head.commit
+    first_path = os.path.join(repo.working_tree_dir, "sub/dir/changed.txt")
+    with open(first_path, "w") as f:
+        f.write("changed")
+    repo.index.add(("sub/dir/changed.txt",))
+    repo.index.remove(("removed.txt",), working_tree=True)
+    second = _commit(repo, "Second commit", 2000)
+
+    git_time.restore_mtime_from_git(repo)
+    assert _mtimes(repo) == {"old.txt": 1000, "sub/dir/changed.txt": 2000, "link": 1000}
+    # Only the new commit should have been walked
+    assert walked_revisions[-1] == (f"{first}..{second}",)
+
+    # Nothing needs to be walked for an unchanged HEAD
+    del walked_revisions[:]
+    os.utime(first_path, (0, 0))
+    git_time.restore_mtime_from_git(repo)
+    assert _mtimes(repo)["sub/dir/changed.txt"] == 2000
+    assert walked_revisions == []
+
+    assert {
+        name: (object_type, mtime) for name, object_type, mtime in git_time.determine_mtime_from_git(repo)
+    } == {
+        "old.txt": (git_time.GitObjectType.regular_file, 1000),
+        "sub/dir/changed.txt": (git_time.GitObjectType.regular_file, 2000),
+        "link": (git_time.GitObjectType.symlink, 1000),
+    }
+
+
+def test_restore_mtime_after_history_rewrite(repo, walked_revisions):
+    git_time.restore_mtime_from_git(repo)
+
+    # Replace the cached commit with an unrelated one
+    repo.index.remove(("removed.txt",), working_tree=True)
+    git.Commit.create_from_tree(
+        repo,
+        repo.index.write_tree(),
+        "Rewritten history",
+        parent_commits=[],
+        head=True,
+        author_date="3000 +0000",
+        commit_date="3000 +0000",
+    )
+
+    git_time.restore_mtime_from_git(repo)
+    assert _mtimes(repo) == {"old.txt": 3000, "sub/dir/changed.txt": 3000, "link": 3000}
+    assert walked_revisions[-1] == (repo.head.commit.hexsha,)
+
+
+def test_restore_mtime_after_merge(repo, tmp_path):
+    base = repo.head.commit
+    changed = Path(repo.working_tree_dir) / "sub/dir/changed.txt"
+    changed.write_text("mainline")
+    repo.index.add(("sub/dir/changed.txt",))
+    _commit(repo, "Mainline change", 3000)
+    git_time.restore_mtime_from_git(repo)
+
+    # A side branch with an older change to the same file
+    mainline = repo.head.reference
+    side = repo.create_head("side", base)
+    repo.head.reference = side
+    repo.head.reset(index=True, working_tree=True)
+    changed.write_text("side")
+    repo.index.add(("sub/dir/changed.txt",))
+    side_commit = _commit(repo, "Side change", 2000)
+
+    repo.head.reference = mainline
+    repo.head.reset(index=True, working_tree=True)
+    repo.git.merge(side_commit, strategy_option="ours", no_edit=True, env={
+        "GIT_AUTHOR_DATE": "@4000 +0000",
+        "GIT_COMMITTER_DATE": "@4000 +0000",
+        "GIT_AUTHOR_NAME": "Hopic Test",
+        "GIT_AUTHOR_EMAIL": "hopic@example.com",
+        "GIT_COMMITTER_NAME": "Hopic Test",
+        "GIT_COMMITTER_EMAIL": "hopic@example.com",
+    })
+    git_time.restore_mtime_from_git(repo)
+    incremental = _mtimes(repo)
+
+    with git.Repo.clone_from(repo.working_tree_dir, tmp_path / "fresh") as fresh:
+        git_time.restore_mtime_from_git(fresh)
+        assert incremental == _mtimes(fresh)
+    assert incremental["sub/dir/changed.txt"] == 3000
+
+
+def test_cached_describe(repo, monkeypatch):
+    describes = []
+
+    def describe(self, *args, **kwargs):
+        describes.append(args)
+        return self._call_process("describe", *args, **kwargs)
+    monkeypatch.setattr(git.Git, "describe", describe, raising=False)
+
+    repo.create_tag("1.0.0")
+    assert git_time.determine_git_version(repo) == git_time.GitVersion(
+        tag_name="1.0.0", commit_count=0, commit_hash=repo.head.commit.hexsha[:git_time._git_abbrev_len],
+    )
+    assert len(describes) == 1
+
+    # Dirty state doesn't come from the cache
+    (Path(repo.working_tree_dir) / "old.txt").write_text("modified")
+    assert git_time.determine_git_version(repo).dirty
+    assert len(describes) == 1
+
+    repo.index.add(("old.txt",))
+    _commit(repo, "Second commit", 2000)
+    gitversion = git_time.determine_git_version(repo)
+    assert (gitversion.tag_name, gitversion.commit_count, gitversion.dirty) == ("1.0.0", 1, False)
+    assert len(describes) == 2
+
+    repo.create_tag("1.0.1")
+    gitversion = git_time.determine_git_version(repo)
+    assert (gitversion.tag_name, gitversion.commit_count) == ("1.0.1", 0)
+    assert len(describes) == 3
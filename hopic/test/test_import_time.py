@@ -0,0 +1,163 @@
+# Copyright (c) 2021 - 2021 TomTom N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from textwrap import dedent
+import os
+import re
+import subprocess
+import sys
+
+import click
+import git
+import pytest
+
+from .markers import benchmark
+from ..cli.main import main
+
+# Maximum cumulative time, in milliseconds, that importing may take for the tested command lines. These are about twice
+# the time measured on a quiet machine. Scale them with HOPIC_IMPORT_TIME_BUDGET_SCALE on slower machines.
+# Benchmarks are excluded from the default test run, because parallel test execution slows imports down by an order of
+# magnitude. Use `pytest -m benchmark` to execute them.
+_budget_scale = float(os.environ.get("HOPIC_IMPORT_TIME_BUDGET_SCALE", 1))
+STARTUP_IMPORT_TIME_BUDGET_MS = 250 * _budget_scale
+GETINFO_IMPORT_TIME_BUDGET_MS = 600 * _budget_scale
+
+_importtime_re = re.compile(r"^import time:\s+(?P<self>\d+)\s+\|\s+(?P<cumulative>\d+)\s+\|(?P<indent>\s*)(?P<module>\S+)$")
+
+_heavy_modules = (
+    "commisery",
+    "docker",
+    "git",
+    "hopic.cli.build",
+    "hopic.cli.commands",
+    "hopic.cli.extensions",
+    "hopic.config_reader",
+    "hopic.credentials",
+    "keyring",
+    "pkg_resources",
+    "typeguard",
+    "yaml",
+)
+
+
+@pytest.fixture
+def workspace(tmp_path):
+    (tmp_path / "hopic-ci-config.yaml").write_text(
+        dedent(
+            """\
+            phases:
+              a:
+                x:
+                  - echo x
+            """
+        )
+    )
+    with git.Repo.init(tmp_path) as repo:
+        repo.index.add(("hopic-ci-config.yaml",))
+        repo.index.commit(message="Initial commit")
+    return tmp_path
+
+
+def import_times(*args, cwd):
+    result = subprocess.run(
+        (sys.executable, "-X", "importtime", "-m", "hopic", *args),
+        cwd=str(cwd),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    assert result.returncode == 0, result.stderr.decode()
+
+    times = {}
+    total = 0
+    for line in result.stderr.decode().splitlines():
+        m = _importtime_re.match(line)
+        if not m:
+            continue
+        times[m.group("module")] = int(m.group("cumulative"))
+        # Only top-level imports, others are included in the cumulative time of those
+        if len(m.group("indent")) == 1:
+            total += int(m.group("cumulative"))
+    return times, total / 1000
+
+
+@pytest.mark.parametrize("args", (
+    ("--version",),
+    ("--help",),
+))
+def test_startup_without_heavy_imports(tmp_path, args):
+    times, _ = import_times(*args, cwd=tmp_path)
+
+    assert "hopic.cli.main" in times
+    assert not frozenset(_heavy_modules) & frozenset(times)
+
+
+def test_getinfo_imports(workspace):
+    times, _ = import_times("getinfo", cwd=workspace)
+
+    assert "hopic.config_reader" in times
+    # Only needed for installing extensions and serving respectively
+    for module in ("pkg_resources", "hopic.cli.serve"):
+        assert module not in times
+
+
+@benchmark
+@pytest.mark.parametrize("args, budget_ms", (
+    (("--version",), STARTUP_IMPORT_TIME_BUDGET_MS),
+    (("--help",), STARTUP_IMPORT_TIME_BUDGET_MS),
+    (("getinfo",), GETINFO_IMPORT_TIME_BUDGET_MS),
+))
+def test_import_time_budget(workspace, args, budget_ms):
+    _, total_ms = import_times(*args, cwd=workspace)
+    assert total_ms <= budget_ms
+
+
+def test_lazy_commands_complete():
+    """
+    Every subcommand should be registered for lazy loading.
+    """
+
+    ctx = click.Context(main)
+    commands = {name: main.get_command(ctx, name) for name in main.list_commands(ctx)}
+    assert all(commands.values())
+
+    from ..cli import (
+        build,
+        commands as cli_commands,
+        extensions,
+        serve,
+    )
+    implemented = {
+        cmd
+        for module in (build, cli_commands, extensions, serve)
+        for cmd in vars(module).values()
+        if isinstance(cmd, click.Command) and cmd is not main
+    }
+    subcommands = {
+        subcmd
+        for cmd in implemented
+        if isinstance(cmd, click.MultiCommand)
+        for subcmd in cmd.commands.values()
+    }
+    implemented = {cmd.name for cmd in implemented - subcommands}
+    assert implemented == set(commands)
+
+
+def test_lazy_commands_help():
+    """
+    Commands that aren't imported yet are described by the same short help as their implementation.
+    """
+
+    ctx = click.Context(main)
+    for name, (_, short_help) in main.lazy_commands.items():
+        assert main.get_command(ctx, name).get_short_help_str(limit=sys.maxsize) == short_help
@@ -16,16 +16,23 @@
 
 import functools
 import json
+import logging
 import os
+from pathlib import Path
 import re
+import signal
 import subprocess
 import sys
+import time
 from textwrap import dedent
 
 import git
 import pytest
 
-from .. import credentials
+from .. import (
+    credentials,
+    git_bundle,
+)
 from ..build import HopicGitInfo
 from ..cli import utils
 from ..errors import VersionBumpMismatchError, VersioningError
@@ -1933,3 +1940,291 @@ def test_merge_to_non_publishable_branch(run_hopic):
             "merge-change-request", "--source-remote", run_hopic.toprepo, "--source-ref", pr_branch, "--title", "chore: not interesting"),
     )
     assert result.exit_code == 0
+
+
+def test_merge_in_shallow_clone(run_hopic, tmp_path):
+    with git.Repo.init(run_hopic.toprepo, expand_vars=False) as repo:
+        (run_hopic.toprepo / "hopic-ci-config.yaml").write_text(
+            dedent(
+                """\
+                version:
+                  tag: true
+                  bump: no
+                """
+            )
+        )
+        repo.index.add(("hopic-ci-config.yaml",))
+        base_commit = repo.index.commit(message="chore: initial commit", **_commitargs)
+        repo.create_tag("1.0.0", ref=base_commit)
+
+        for n in range(5):
+            (run_hopic.toprepo / "counter.txt").write_text(f"{n}")
+            repo.index.add(("counter.txt",))
+            target_commit = repo.index.commit(message=f"chore: count to {n}", **_commitargs)
+            with repo.git.custom_environment(
+                GIT_AUTHOR_NAME=_author.name, GIT_AUTHOR_EMAIL=_author.email, GIT_COMMITTER_NAME=_author.name, GIT_COMMITTER_EMAIL=_author.email,
+            ):
+                repo.git.notes("add", "-m", f"count {n}", str(target_commit), ref="hopic/master")
+
+        # Branch off before the tip of the clone's history
+        repo.head.reference = repo.create_head("something-useful", base_commit)
+        repo.head.reset(index=True, working_tree=True)
+        (run_hopic.toprepo / "something.txt").write_text("usable")
+        repo.index.add(("something.txt",))
+        source_commit = repo.index.commit(message="feat: add something useful", **_commitargs)
+
+    # Local clones ignore --depth, so use a URL
+    remote = run_hopic.toprepo.as_uri()
+    (result,) = run_hopic(
+        ("checkout-source-tree", "--target-remote", remote, "--target-ref", "master", "--clone-depth", "1", "--clone-filter", "blob:none"),
+    )
+    assert result.exit_code == 0
+    workspace = tmp_path / "rundir"
+    with git.Repo(workspace) as repo:
+        assert (Path(repo.git_dir) / "shallow").exists()
+        assert list(repo.iter_commits()) == [target_commit]
+        assert "1.0.0" not in repo.tags
+        # Notes aren't affected by the depth of the fetched history
+        assert len(list(repo.iter_commits("refs/notes/hopic/master"))) == 5
+
+    (result,) = run_hopic(
+        ("prepare-source-tree", "--author-name", _author.name, "--author-email", _author.email,
+            "merge-change-request", "--source-remote", remote, "--source-ref", "something-useful"),
+    )
+    assert result.exit_code == 0
+    submit_commit, version = result.stdout.splitlines()[-2:]
+    assert version.startswith("1.0.1-7+g")
+    with git.Repo(workspace) as repo:
+        assert repo.commit(submit_commit).parents == (target_commit, source_commit)
+        assert repo.tags["1.0.0"].commit == base_commit
+
+
+@pytest.mark.parametrize("tag_on_target", (True, False))
+def test_bundle_excludes_fetched_tags(run_hopic, tmp_path, tag_on_target):
+    with git.Repo.init(run_hopic.toprepo, expand_vars=False) as repo:
+        (run_hopic.toprepo / "hopic-ci-config.yaml").write_text(
+            dedent(
+                """\
+                version:
+                  bump: no
+                """
+            )
+        )
+        repo.index.add(("hopic-ci-config.yaml",))
+        repo.index.commit(message="chore: initial commit", **_commitargs)
+        repo.git.branch("master", move=True)
+
+        # Released history that isn't part of the target branch
+        repo.head.reference = repo.create_head("release")
+        (run_hopic.toprepo / "big.txt").write_text("".join(f"{n}\n" for n in range(10000)))
+        repo.index.add(("big.txt",))
+        released_commit = repo.index.commit(message="feat: something big", **_commitargs)
+        repo.create_tag("1.0.0")
+
+        repo.head.reference = repo.create_head("something-useful")
+        repo.head.reset(index=True, working_tree=True)
+        (run_hopic.toprepo / "small.txt").write_text("small\n")
+        repo.index.add(("small.txt",))
+        repo.index.commit(message="feat: something small", **_commitargs)
+
+    def delete_tag_on_target():
+        if not tag_on_target:
+            with git.Repo(run_hopic.toprepo) as repo:
+                repo.delete_tag("1.0.0")
+
+    transfer_bundle = tmp_path / "transfer.bundle"
+    (*_, result) = run_hopic(
+        command("checkout-source-tree", target_remote=run_hopic.toprepo, target_ref="master"),
+        # Fetched by this checkout, but other checkouts of the target won't get it anymore
+        delete_tag_on_target,
+        command(
+            "prepare-source-tree",
+            author_name=_author.name,
+            author_email=_author.email,
+            author_date=f"@{_git_time}",
+            commit_date=f"@{_git_time}",
+            bundle=transfer_bundle,
+            bundle_compression=1,
+        )
+        + command(
+            "merge-change-request",
+            source_remote=run_hopic.toprepo,
+            source_ref="something-useful",
+            change_request="42",
+            title="feat: something small",
+        ),
+        rundir=tmp_path / "rundir-orig",
+    )
+    assert result.exit_code == 0
+
+    prerequisites, refs = git_bundle.read_header(transfer_bundle)
+    assert (released_commit.hexsha in prerequisites) == tag_on_target
+    assert "refs/bundle/heads/master" in refs
+
+    (*_, result) = run_hopic(
+        command("checkout-source-tree", target_remote=run_hopic.toprepo, target_ref="master"),
+        command("unbundle", transfer_bundle),
+        rundir=tmp_path / "rundir-unbundle",
+    )
+    assert result.exit_code == 0
+
+
+def test_unbundle_reuse_checkout(run_hopic, tmp_path):
+    with git.Repo.init(run_hopic.toprepo, expand_vars=False) as repo:
+        (run_hopic.toprepo / "hopic-ci-config.yaml").write_text(
+            dedent(
+                """\
+                version:
+                  bump: no
+                """
+            )
+        )
+        repo.index.add(("hopic-ci-config.yaml",))
+        repo.index.commit(message="chore: initial commit", **_commitargs)
+        repo.git.branch("master", move=True)
+
+        repo.head.reference = repo.create_head("something-useful")
+        (run_hopic.toprepo / "useful.txt").write_text("useful\n")
+        repo.index.add(("useful.txt",))
+        repo.index.commit(message="feat: something useful", **_commitargs)
+
+    transfer_bundle = tmp_path / "transfer.bundle"
+    (*_, result) = run_hopic(
+        command("checkout-source-tree", target_remote=run_hopic.toprepo, target_ref="master"),
+        command(
+            "prepare-source-tree",
+            author_name=_author.name,
+            author_email=_author.email,
+            author_date=f"@{_git_time}",
+            commit_date=f"@{_git_time}",
+            bundle=transfer_bundle,
+        )
+        + command(
+            "merge-change-request",
+            source_remote=run_hopic.toprepo,
+            source_ref="something-useful",
+            change_request="42",
+            title="feat: something useful",
+        ),
+        rundir=tmp_path / "rundir-orig",
+    )
+    assert result.exit_code == 0
+
+    rundir = tmp_path / "rundir-unbundle"
+    (*_, result) = run_hopic(
+        command("checkout-source-tree", target_remote=run_hopic.toprepo, target_ref="master", clean=True),
+        command("unbundle", transfer_bundle),
+        rundir=rundir,
+    )
+    assert result.exit_code == 0
+
+    # Output of an earlier phase
+    (rundir / "output.txt").write_text("output\n")
+
+    (result,) = run_hopic(command("unbundle", transfer_bundle, reuse_checkout=True), rundir=rundir)
+    assert result.exit_code == 0
+    assert (rundir / "output.txt").exists()
+    assert any(msg.startswith("reusing existing checkout of ") for _, msg in result.logs)
+
+    # Modified tracked files prevent reusing the checkout
+    (rundir / "useful.txt").write_text("modified\n")
+    (result,) = run_hopic(command("unbundle", transfer_bundle, reuse_checkout=True), rundir=rundir)
+    assert result.exit_code == 0
+    assert (rundir / "useful.txt").read_text() == "useful\n"
+    assert not (rundir / "output.txt").exists()
+
+
+def test_foreach_concurrent_checkout(run_hopic, tmp_path):
+    with git.Repo.init(run_hopic.toprepo, expand_vars=False) as repo:
+        (run_hopic.toprepo / "hopic-ci-config.yaml").write_text(
+            dedent(
+                """\
+                version:
+                  bump: no
+
+                phases:
+                  build:
+                    test:
+                      - foreach: SOURCE_COMMIT
+                        foreach-jobs: 3
+                        foreach-checkout: yes
+                        sh: sh -c 'cat something.txt && test "$(cat something.txt)" != bad'
+                """
+            )
+        )
+        repo.index.add(("hopic-ci-config.yaml",))
+        repo.index.commit(message="chore: initial commit", **_commitargs)
+        repo.git.branch("master", move=True)
+
+        repo.head.reference = repo.create_head("something-useful")
+        contents = {}
+        for content in ("first", "bad", "last"):
+            (run_hopic.toprepo / "something.txt").write_text(f"{content}\n")
+            repo.index.add(("something.txt",))
+            contents[repo.index.commit(message=f"feat: add {content} thing", **_commitargs).hexsha] = content
+
+    (*_, result) = run_hopic(
+        command("checkout-source-tree", target_remote=run_hopic.toprepo, target_ref="master"),
+        command("prepare-source-tree", author_name=_author.name, author_email=_author.email)
+        + command("merge-change-request", source_remote=run_hopic.toprepo, source_ref="something-useful"),
+        ("--trace", tmp_path / "trace.jsonl", "build"),
+    )
+    assert result.exit_code == 1
+
+    # Output is in the order of the commits, regardless of the order in which they finish
+    ordered_commits = [msg.split("=", 1)[1].rstrip(":") for _, msg in result.logs if msg.startswith("output for SOURCE_COMMIT=")]
+    assert set(ordered_commits) == contents.keys()
+    assert result.stdout.splitlines() == [contents[commit] for commit in ordered_commits]
+
+    bad_commit = next(commit for commit, content in contents.items() if content == "bad")
+    errors = [msg for level, msg in result.logs if level == logging.ERROR]
+    assert f"Command for SOURCE_COMMIT={bad_commit} fatally terminated with exit code 1" in errors
+    assert (tmp_path / "rundir" / "something.txt").read_text() == "last\n"
+    assert len(git.Repo(tmp_path / "rundir").git.worktree("list", "--porcelain").split("\n\n")) == 1
+
+    # Resource usage of concurrently executing commands cannot be told apart
+    events = [json.loads(line) for line in (tmp_path / "trace.jsonl").read_text().splitlines()]
+    commands = [event["args"] for event in events if event["cat"] == "command" and event["args"].get("foreach")]
+    assert sorted(command["exit_status"] for command in commands) == [0, 0, 1]
+    assert not any("user_cpu" in command for command in commands)
+
+
+def test_foreach_concurrent_terminated(run_hopic, tmp_path):
+    with git.Repo.init(run_hopic.toprepo, expand_vars=False) as repo:
+        (run_hopic.toprepo / "hopic-ci-config.yaml").write_text(
+            dedent(
+                f"""\
+                version:
+                  bump: no
+
+                phases:
+                  build:
+                    test:
+                      - foreach: SOURCE_COMMIT
+                        foreach-jobs: 2
+                        # Only the first item to start terminates Hopic, while it's running
+                        sh: sh -c 'mkdir {tmp_path / "terminated"} 2>/dev/null && kill -TERM {os.getpid()}; sleep 60'
+                """
+            )
+        )
+        repo.index.add(("hopic-ci-config.yaml",))
+        repo.index.commit(message="chore: initial commit", **_commitargs)
+        repo.git.branch("master", move=True)
+
+        repo.head.reference = repo.create_head("something-useful")
+        for name in ("first", "second", "third"):
+            (run_hopic.toprepo / f"{name}.txt").write_text(f"{name}\n")
+            repo.index.add((f"{name}.txt",))
+            repo.index.commit(message=f"feat: add {name} thing", **_commitargs)
+
+    start = time.monotonic()
+    (*_, result) = run_hopic(
+        command("checkout-source-tree", target_remote=run_hopic.toprepo, target_ref="master"),
+        command("prepare-source-tree", author_name=_author.name, author_email=_author.email)
+        + command("merge-change-request", source_remote=run_hopic.toprepo, source_ref="something-useful"),
+        command("build"),
+    )
+
+    assert result.exit_code == 128 + signal.SIGTERM
+    # Neither the running nor the pending items got waited for
+    assert time.monotonic() - start < 30
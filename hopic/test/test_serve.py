@@ -0,0 +1,150 @@
+# Copyright (c) 2021 - 2021 TomTom N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from textwrap import dedent
+import json
+import os
+import subprocess
+import sys
+import time
+
+import git
+import pytest
+
+from ..errors import UnknownPhaseError
+
+
+@pytest.fixture
+def workspace(tmp_path):
+    workspace = tmp_path / "workspace"
+    workspace.mkdir()
+    (workspace / "hopic-ci-config.yaml").write_text(
+        dedent(
+            """\
+            phases:
+              a:
+                x:
+                  - echo x
+            """
+        )
+    )
+    with git.Repo.init(workspace) as repo:
+        repo.index.add(("hopic-ci-config.yaml",))
+        repo.index.commit(
+            message="Initial commit",
+            author=git.Actor("Hopic Test", "hopic@example.com"),
+            committer=git.Actor("Hopic Test", "hopic@example.com"),
+        )
+    return workspace
+
+
+@pytest.fixture
+def server(tmp_path, workspace):
+    socket_path = tmp_path / "hopic.sock"
+    log_path = tmp_path / "server.log"
+    with open(log_path, "wb") as log_file:
+        proc = subprocess.Popen(
+            (sys.executable, "-m", "hopic", "--verbosity=DEBUG", "--workspace", str(workspace), "serve", "--socket", str(socket_path), "--idle-timeout", "60"),
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+        )
+    try:
+        deadline = time.monotonic() + 30
+        while not socket_path.exists():
+            assert proc.poll() is None, log_path.read_text()
+            assert time.monotonic() < deadline, "server didn't start listening in time"
+            time.sleep(0.05)
+        yield socket_path, log_path
+    finally:
+        proc.terminate()
+        proc.wait()
+    assert not socket_path.exists()
+
+
+def run_client(socket_path, workspace, *args, python_args=()):
+    return subprocess.run(
+        (sys.executable, *python_args, "-m", "hopic", *args),
+        cwd=str(workspace),
+        env=dict(os.environ, HOPIC_SERVE_SOCKET=str(socket_path)),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+
+def test_forward(server, workspace):
+    socket_path, log_path = server
+
+    result = run_client(socket_path, workspace, "getinfo")
+    assert result.returncode == 0, result.stderr.decode()
+    assert json.loads(result.stdout) == {"a": {"x": {}}}
+    assert "executing request in process" in log_path.read_text()
+
+    result = run_client(socket_path, workspace, "build", "--phase=nonexistent")
+    assert result.returncode == UnknownPhaseError.exit_code
+    assert b"nonexistent" in result.stderr
+
+
+def test_reuse_server_state(server, workspace):
+    socket_path, log_path = server
+
+    result = run_client(socket_path, workspace, "--verbosity=DEBUG", "getinfo")
+    assert result.returncode == 0, result.stderr.decode()
+    assert json.loads(result.stdout) == {"a": {"x": {}}}
+    assert b"reusing configuration and version determined by server" in result.stderr
+
+    result = run_client(socket_path, workspace, "--verbosity=DEBUG", "--publishable-version", "getinfo")
+    assert result.returncode == 0, result.stderr.decode()
+    assert b"reusing configuration and version determined by server" not in result.stderr
+
+
+def test_forward_without_importing_dependencies(server, workspace):
+    socket_path, log_path = server
+
+    result = run_client(socket_path, workspace, "getinfo", python_args=("-X", "importtime"))
+    assert result.returncode == 0, result.stderr.decode()
+    imported = {
+        line.split("|")[-1].strip()
+        for line in result.stderr.decode().splitlines()
+        if line.startswith("import time:")
+    }
+    assert "hopic.client" in imported
+    assert not {"click", "git", "hopic.cli"} & imported
+
+
+def test_restart_on_config_change(server, workspace):
+    socket_path, log_path = server
+
+    result = run_client(socket_path, workspace, "getinfo")
+    assert json.loads(result.stdout) == {"a": {"x": {}}}
+
+    (workspace / "hopic-ci-config.yaml").write_text(
+        dedent(
+            """\
+            phases:
+              b:
+                y:
+                  - echo y
+            """
+        )
+    )
+    result = run_client(socket_path, workspace, "getinfo")
+    assert result.returncode == 0, result.stderr.decode()
+    assert json.loads(result.stdout) == {"b": {"y": {}}}
+    assert "restarting server" in log_path.read_text()
+
+
+def test_fallback_without_server(tmp_path, workspace):
+    result = run_client(tmp_path / "nonexistent.sock", workspace, "getinfo")
+    assert result.returncode == 0, result.stderr.decode()
+    assert json.loads(result.stdout) == {"a": {"x": {}}}
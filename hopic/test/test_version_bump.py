@@ -193,3 +193,31 @@ def test_bump_skipped_when_no_bumpable_commits(run_hopic):
         logging.ERROR,
         "Version bumping requested, but the version policy 'conventional-commits' decided not to bump from '0.0.1-1+gee3642c057a2af'",
     ) in result.logs
+
+
+@pytest.mark.parametrize('parallel', (False, True))
+def test_parse_commit_range(parallel, monkeypatch, tmp_path):
+    from ..cli import commands
+
+    if parallel:
+        monkeypatch.setattr(commands, '_PARALLEL_PARSE_THRESHOLD', 1)
+        monkeypatch.setattr(commands, '_PARALLEL_PARSE_CHUNK_SIZE', 2)
+        monkeypatch.setattr(commands.os, 'cpu_count', lambda: 2)
+
+    messages = (
+        'fix: first\n\nWith a body.\n',
+        'feat: café\n',
+        'chore: trailing\n\nAcked-by: Alice Reviewer <alice@example.net>\n',
+        'feat!: break\n\nBREAKING CHANGE: everything\n',
+    )
+    with git.Repo.init(tmp_path, expand_vars=False) as repo:
+        base = repo.index.commit(message='chore: initial commit', **_commitargs)
+        for message in messages:
+            repo.index.commit(message=message, **_commitargs)
+
+        parsed = list(commands.parse_commit_range(repo, base, repo.head.commit, {'policy': 'conventional-commits'}))
+        expected = list(git.Commit.list_items(repo, f"{base}..{repo.head.commit}"))
+
+    assert [msg.hexsha for msg in parsed] == [commit.hexsha for commit in expected]
+    assert [msg.full_subject for msg in parsed] == [commit.message.splitlines()[0] for commit in expected]
+    assert [msg.has_breaking_change() for msg in parsed] == [True, False, False, False]
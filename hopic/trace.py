@@ -0,0 +1,136 @@
+# Copyright (c) 2021 - 2021 TomTom N.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Machine readable trace of the time spent, and resources used, by Hopic and the commands it executes.
+
+Every line of a trace file is a JSON object with a complete event in Chrome's trace event format. Lines get appended
+with a single write, to allow concurrently executing Hopic processes, e.g. variants built in parallel, to share a
+trace file. Wrapping the lines in a JSON array, e.g. with ``jq --slurp .``, produces a file that trace viewers accept.
+
+This module deliberately only imports modules from the standard library, such that tracing doesn't add to the startup
+time of commands that don't need Hopic's dependencies.
+"""
+
+from contextlib import contextmanager
+import json
+import os
+import resource
+import subprocess
+import threading
+import time
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    Optional,
+)
+
+from .types import PathLike
+
+_fd: Optional[int] = None
+
+
+def enable(path: PathLike) -> None:
+    """
+    Starts appending trace events to the given file.
+    """
+
+    global _fd
+    disable()
+    _fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND | os.O_CLOEXEC, 0o666)
+
+
+def disable() -> None:
+    global _fd
+    if _fd is not None:
+        os.close(_fd)
+        _fd = None
+
+
+def enabled() -> bool:
+    return _fd is not None
+
+
+def _emit(name: str, cat: str, start: float, duration: float, args: Dict[str, Any]) -> None:
+    if _fd is None:
+        return
+    event = {
+        "name": name,
+        "cat": cat,
+        "ph": "X",
+        "ts": int(start * 1e6),
+        "dur": int(duration * 1e6),
+        "pid": os.getpid(),
+        "tid": threading.get_ident(),
+        "args": args,
+    }
+    os.write(_fd, (json.dumps(event, default=str) + "\n").encode("UTF-8"))
+
+
+@contextmanager
+def span(name: str, cat: str = "hopic", **args: Any) -> Iterator[Dict[str, Any]]:
+    """
+    Traces the time spent in the context.
+
+    Yields the event's arguments, to allow adding to them while in the context. Exceptions leaving the context get
+    recorded as an 'error' argument.
+    """
+
+    if _fd is None:
+        yield args
+        return
+
+    start = time.time()
+    start_monotonic = time.monotonic()
+    try:
+        yield args
+    except BaseException as exc:
+        args["error"] = type(exc).__name__
+        raise
+    finally:
+        _emit(name, cat, start, time.monotonic() - start_monotonic, args)
+
+
+@contextmanager
+def command(name: str, *, resource_usage: bool = True, **args: Any) -> Iterator[Dict[str, Any]]:
+    """
+    Traces an external command that gets waited for in the context, along with the resources used by it.
+
+    Resource usage is that of all child processes that terminated while in the context. Of the memory usage only
+    increases of the maximum resident set size of all children can be attributed to this command, so it's only
+    recorded when it increased. Disable resource_usage when other children may terminate in the meantime.
+    """
+
+    with span(name, "command", **args) as args:
+        if _fd is None:
+            yield args
+            return
+
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        try:
+            yield args
+        except subprocess.CalledProcessError as exc:
+            args["exit_status"] = exc.returncode
+            raise
+        else:
+            args["exit_status"] = 0
+        finally:
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            if resource_usage:
+                args["user_cpu"] = round(after.ru_utime - before.ru_utime, 6)
+                args["system_cpu"] = round(after.ru_stime - before.ru_stime, 6)
+                if after.ru_maxrss > before.ru_maxrss:
+                    # Linux reports this in KiB
+                    args["max_rss_kib"] = after.ru_maxrss
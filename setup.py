@@ -59,7 +59,7 @@
     },
     entry_points='''
       [console_scripts]
-      hopic=hopic.cli.main:main
+      hopic=hopic.client:main
     ''',
     zip_safe=True,
     url='https://github.com/tomtom-international/hopic',
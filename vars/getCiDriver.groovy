@@ -467,6 +467,7 @@ class ModalityRequest extends ChangeRequest {
 
   @Override
   public Map getinfo(String cmd) {
+    // Needed to prepare the source tree, so before the execution graph can be retrieved from the prepared tree
     if (this.info == null) {
       this.info = steps.readJSON(text: steps.sh(
         script: "${cmd} getinfo --modality=${shell_quote(modality)}",
@@ -543,6 +544,7 @@ class CiDriver {
   private may_submit_result  = null
   private may_publish_result = null
   private pip_constraints    = null
+  private build_info         = null
   private virtualenvs        = [:]
   private config_file
   private bitbucket_api_credential_id  = null
@@ -1099,19 +1101,14 @@ SSH_ASKPASS_REQUIRE=force SSH_ASKPASS='''
     return true
   }
 
-  private Map get_ci_locks(cmd, is_publishable_change) {
+  private Map get_ci_locks(is_publishable_change) {
     def locks = ['global': [], 'from-phase': [:]]
     if (!is_publishable_change) {
       return locks
     } else {
       locks['global'].push(this.get_lock_name())
     }
-    def config = steps.readJSON(text: steps.sh(
-      script: "${cmd} show-config",
-      label: 'Hopic (internal): retrieving additional CI lock names',
-      returnStdout: true,
-    ))
-    def all_locks = config.getOrDefault('ci-locks', []).findAll { lock ->
+    def all_locks = this.build_info.getOrDefault('ci-locks', []).findAll { lock ->
       if (lock['lock-on-change'] == 'always' || 
         (lock['lock-on-change'] == 'new-version-only' && this.is_new_version())) {
           return true
@@ -1443,7 +1440,8 @@ SSH_ASKPASS_REQUIRE=force SSH_ASKPASS='''
         }
       }
 
-      // Meta-data retrieval needs to take place on the executing node to ensure environment variable expansion happens properly
+      // Meta-data retrieval needs to take place on the executing node to ensure environment variable expansion happens properly.
+      // For this reason the execution graph retrieved by 'getinfo --all' only contains the fields needed for scheduling.
       def meta = steps.readJSON(text: steps.sh(
           script: "${cmd} getinfo --phase=" + shell_quote(phase) + ' --variant=' + shell_quote(variant),
           label: "Hopic: retrieving configuration for phase '${phase}', variant '${variant}'",
@@ -1747,11 +1745,14 @@ SSH_ASKPASS_REQUIRE=force SSH_ASKPASS='''
               returnStdout: true,
           ).replaceAll(/(?m)^[A-Za-z0-9-_.]+ *@.+$/, "") // Remove any URL constraints, as adding support for those has proven troublesome
 
-          def phases = steps.readJSON(text: steps.sh(
-              script: "${cmd} getinfo",
+          // Retrieve all meta-data at once, instead of separately per kind, and share it with all parallel branches
+          this.build_info = steps.readJSON(text: steps.sh(
+              script: "${cmd} getinfo --all",
               label: 'Hopic: retrieving execution graph',
               returnStdout: true,
-            )).collectEntries { phase, variants ->
+            ))
+
+          def phases = this.build_info['phases'].collectEntries { phase, variants ->
             [
               (phase): variants.collectEntries { variant, meta ->
                 [
@@ -1766,11 +1767,7 @@ SSH_ASKPASS_REQUIRE=force SSH_ASKPASS='''
             ]
           }
 
-          def submit_meta = steps.readJSON(text: steps.sh(
-              script: "${cmd} getinfo --post-submit",
-              label: 'Hopic (internal): running post submit',
-              returnStdout: true,
-            ))
+          def submit_meta = this.build_info['post-submit']
 
           def is_publishable = this.has_publishable_change()
 
@@ -1788,7 +1785,7 @@ SSH_ASKPASS_REQUIRE=force SSH_ASKPASS='''
             this.change.notify_build_result(get_job_name(), steps.env.CHANGE_TARGET, steps.env.GIT_COMMIT, 'STARTING', exclude_branches_filled_with_pr_branch_discovery)
           }
 
-          return [phases, is_publishable, submit_meta, get_ci_locks(cmd, is_publishable)]
+          return [phases, is_publishable, submit_meta, get_ci_locks(is_publishable)]
         }
       }
 
@@ -1846,14 +1843,8 @@ SSH_ASKPASS_REQUIRE=force SSH_ASKPASS='''
         if (artifactoryBuildInfo) {
           assert this.nodes : "When we have artifactory build info we expect to have execution nodes that it got produced on"
           this.on_build_node { cmd ->
-            def config = steps.readJSON(text: steps.sh(
-                script: "${cmd} show-config",
-                label: 'Hopic (internal): determine Artifactory promotion configuration',
-                returnStdout: true,
-              ))
-
             artifactoryBuildInfo.each { server_id, buildInfo ->
-              def promotion_config = config.getOrDefault('artifactory', [:]).getOrDefault('promotion', [:]).getOrDefault(server_id, [:])
+              def promotion_config = this.build_info.getOrDefault('artifactory', [:]).getOrDefault('promotion', [:]).getOrDefault(server_id, [:])
 
               def server = steps.Artifactory.server server_id
               server.publishBuildInfo(buildInfo)